@@ -1,41 +1,80 @@
+"""Drop AM epochs with another tone less than 1.7 s before or after them.
+
+Run this after the pipeline has written the epochs (`python drop_epochs_isi.py --jobs N`).
+The original epochs are kept as `*_no-dropped-epo.fif`; files that were already
+processed are skipped, and files re-written by the pipeline are processed again.
+"""
+
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import mne
+import numpy as np
 
 from utils import tasks
 
 bids_root = Path("/storage/badbaby-redux/bids-data")
 deriv_root = bids_root / "derivatives" / "mne-bids-pipeline"
 task = tasks["am"]
-fpaths = deriv_root.rglob(f"**/sub-*_ses-?_task-{task}_epo.fif")
+isi_limits = (-1.7, 1.7)  # seconds
 
 
-def drop_epochs_with_short_isi(epochs: mne.Epochs, event: str) -> mne.Epochs:
-    """Use metadata about the relative timing of prev/next trials to drop epochs."""
-    kwargs = dict(
-        events=epochs.events, event_id=epochs.event_id, sfreq=epochs.info["sfreq"]
-    )
-    # we have to do this twice, once for pre-stim times and once for post-stim times,
-    # due to the limitation of `make_metadata` of only keeping one `amtone` event per
-    # epoch window. Thus `tmin`, `tmax`, and `keep_(first|last)` differ here:
-    metadata_bef, ev_bef, evid_bef = mne.epochs.make_metadata(
-        tmin=-1.7, tmax=0, keep_first=event, **kwargs
-    )
-    metadata_aft, ev_aft, evid_aft = mne.epochs.make_metadata(
-        tmin=0.0, tmax=1.7, keep_last=event, **kwargs
-    )
-    drop_bef = metadata_bef.loc[metadata_bef[event] < 0]
-    drop_aft = metadata_aft.loc[metadata_aft[event] > 0]
-    drop_ix = sorted(set(drop_bef.index) | set(drop_aft.index))
-    epochs.drop(drop_ix, reason="short_ISI")
+def short_isi_mask(events, event_code, sfreq, tmin=isi_limits[0], tmax=isi_limits[1]):
+    """Find the events that have an ``event_code`` event within (tmin, tmax) of them.
+
+    Windows are in samples, and inclusive, exactly as in ``mne.epochs.make_metadata``
+    (so the stop sample is one past ``tmax``).
+    """
+    samples = events[:, 0]
+    times = np.sort(samples[events[:, 2] == event_code])
+    start = samples + int(round(tmin * sfreq))
+    stop = samples + int(round(tmax * sfreq)) + 1
+    n_before = np.searchsorted(times, samples, "left") - np.searchsorted(times, start, "left")
+    n_after = np.searchsorted(times, stop, "right") - np.searchsorted(times, samples, "right")
+    return (n_before > 0) | (n_after > 0)
 
+
+def drop_epochs_with_short_isi(epochs: mne.Epochs, event: str) -> mne.Epochs:
+    """Use the relative timing of prev/next trials to drop epochs."""
+    mask = short_isi_mask(epochs.events, epochs.event_id[event], epochs.info["sfreq"])
+    epochs.drop(np.flatnonzero(mask), reason="short_ISI")
     return epochs
 
 
-for fpath in fpaths:
+def drop_from_file(fpath):
+    """Drop the short-ISI epochs of one file (keeping a backup of the original)."""
     backup_name = fpath.with_name(fpath.name.replace("_epo.fif", "_no-dropped-epo.fif"))
-    if not backup_name.exists():
-        fpath.rename(backup_name)
-    epo = mne.read_epochs(backup_name)
+    if fpath.exists():
+        epo = mne.read_epochs(fpath, preload=False)
+        if any("short_ISI" in reasons for reasons in epo.drop_log):
+            return f"{fpath.name}: already done"
+        # (re-)written by the pipeline, so it's the new original
+        fpath.replace(backup_name)
+    epo = mne.read_epochs(backup_name, preload=False)
+    n_epochs = len(epo)
     epo = drop_epochs_with_short_isi(epo, "amtone")
-    epo.save(fpath)
+    epo.save(fpath, overwrite=True)
+    return f"{fpath.name}: dropped {n_epochs - len(epo)} of {n_epochs} epochs"
+
+
+def run_files(fpaths, n_jobs):
+    """Process the files (serially or on a process pool), yielding messages in order."""
+    if n_jobs == 1:
+        yield from map(drop_from_file, fpaths)
+        return
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        yield from pool.map(drop_from_file, fpaths)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop AM epochs with a short ISI")
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=1, help="Number of files to process in parallel"
+    )
+    args = parser.parse_args()
+    fpaths = sorted(deriv_root.rglob(f"**/sub-*_ses-?_task-{task}_epo.fif"))
+    for message in run_files(fpaths, n_jobs=args.jobs):
+        print(message)
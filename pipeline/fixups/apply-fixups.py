@@ -0,0 +1,185 @@
+"""Apply the repairs listed in fixups.yaml to the BIDS tree, in one parallel pass.
+
+Directories are scanned (and matching files fixed) on a thread pool. Files are
+rewritten atomically, and files that are already fixed are left alone. Every change is
+recorded in a journal (in `fixup-journal/<timestamp>/`, with the original files), so
+the last run can be reverted with `--undo`.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from fnmatch import fnmatch
+from pathlib import Path
+from threading import Lock
+
+import yaml
+
+parser = argparse.ArgumentParser(description="Apply fixups.yaml to the BIDS tree")
+parser.add_argument(
+    "--jobs", "-j", type=int, default=8, help="Number of threads to scan / fix with"
+)
+parser.add_argument(
+    "--dry-run", action="store_true", help="report what would change, then stop"
+)
+parser.add_argument(
+    "--undo", action="store_true", help="revert the changes of the last run"
+)
+args = parser.parse_args()
+
+# (like the prep-dataset scripts, $BADBABY_ROOT points this at another tree)
+root = Path(os.environ.get("BADBABY_ROOT", "/storage/badbaby-redux")).resolve()
+bids_root = root / "bids-data"
+journal_root = root / "fixup-journal"
+with open(Path(__file__).resolve().parent / "fixups.yaml") as fid:
+    rules = yaml.safe_load(fid)
+
+
+# ############ #
+# RULE ACTIONS #
+# ############ #
+def rename_tsv_values(text, rule, path):
+    """Replace values in one column of a TSV file."""
+    lines = text.split("\n")
+    column = lines[0].split("\t").index(rule["column"])
+    for ix, line in enumerate(lines[1:], start=1):
+        if not line:
+            continue
+        fields = line.split("\t")
+        fields[column] = rule["values"].get(fields[column], fields[column])
+        lines[ix] = "\t".join(fields)
+    return "\n".join(lines)
+
+
+def set_cfg_field(text, rule, path):
+    """Set the value of a ``field = value`` line of a config file."""
+    value = rule["value"].format(parent=path.parent.name)
+    pattern = rf"^(\s*{re.escape(rule['field'])}\s*=[ \t]*).*$"
+    text, n_subs = re.subn(pattern, lambda match: match[1] + value, text, flags=re.M)
+    assert n_subs == 1, f"expected one `{rule['field']}` in {path}, found {n_subs}"
+    return text
+
+
+rewriters = {"tsv-rename": rename_tsv_values, "cfg-field": set_cfg_field}
+
+
+# ######## #
+# THE PASS #
+# ######## #
+def matching_rules(path):
+    """Get the indices of the rules that apply to a file."""
+    rel = path.relative_to(bids_root)
+    return [
+        ix
+        for ix, rule in enumerate(rules)
+        if (rule["under"] == "." or rel.is_relative_to(rule["under"]))
+        and fnmatch(path.name, rule["name"])
+    ]
+
+
+def scan(directory):
+    """List the subdirectories of a directory, and the files in it that need fixing."""
+    subdirs, matches = list(), list()
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(Path(entry.path))
+            elif entry.is_file(follow_symlinks=False):
+                ixs = matching_rules(Path(entry.path))
+                if ixs:
+                    matches.append((Path(entry.path), ixs))
+    return subdirs, matches
+
+
+def fix(path, ixs):
+    """Apply the rules to one file. Returns (rule index, changed?) pairs."""
+    rel = path.relative_to(bids_root)
+    backup = journal_dir / "backups" / rel
+    deleting = [ix for ix in ixs if rules[ix]["kind"] == "delete"]
+    if deleting:
+        if not args.dry_run:
+            backup.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, backup)
+            record(rules[deleting[0]], "delete", rel)
+        return [(ix, ix in deleting[:1]) for ix in ixs]
+    old_text = text = path.read_text()
+    outcome = list()
+    for ix in ixs:
+        new_text = rewriters[rules[ix]["kind"]](text, rules[ix], path)
+        outcome.append((ix, new_text != text))
+        text = new_text
+    if text != old_text and not args.dry_run:
+        # keep the original (by hardlinking it), then swap in the new version
+        backup.parent.mkdir(parents=True, exist_ok=True)
+        os.link(path, backup)
+        tmp_file = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_file.write_text(text)
+        shutil.copymode(path, tmp_file)
+        os.replace(tmp_file, path)
+        record(rules[ixs[0]], "rewrite", rel)
+    return outcome
+
+
+journal_lock = Lock()
+
+
+def record(rule, action, rel):
+    """Add a change to the journal (as it happens, so a crashed run can be undone)."""
+    entry = dict(action=action, path=str(rel), rule=rule["description"])
+    with journal_lock, open(journal_dir / "journal.jsonl", "a") as fid:
+        fid.write(json.dumps(entry) + "\n")
+
+
+def undo(journal_dir):
+    """Put back the original files of a run (newest change first)."""
+    journal = journal_dir / "journal.jsonl"
+    entries = [json.loads(line) for line in journal.read_text().splitlines()]
+    for entry in reversed(entries):
+        path = bids_root / entry["path"]
+        os.replace(journal_dir / "backups" / entry["path"], path)
+        print(f"restored {entry['path']} ({entry['action']}: {entry['rule']})")
+    shutil.rmtree(journal_dir)
+
+
+if args.undo:
+    journals = sorted(journal_root.glob("*/journal.jsonl"))
+    if not journals:
+        raise SystemExit("no fixup journal to undo")
+    undo(journals[-1].parent)
+    raise SystemExit
+
+journal_dir = journal_root / datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+if not args.dry_run:
+    journal_dir.mkdir(parents=True)
+
+# scan directories and fix files on the same pool, so it's one pass over the tree
+counts = [dict(changed=0, unchanged=0) for _ in rules]
+with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+    pending = {pool.submit(scan, bids_root)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            result = future.result()
+            if isinstance(result, tuple):  # from `scan`
+                subdirs, matches = result
+                pending |= {pool.submit(scan, subdir) for subdir in subdirs}
+                pending |= {pool.submit(fix, *match) for match in matches}
+            else:  # from `fix`
+                for ix, changed in result:
+                    counts[ix]["changed" if changed else "unchanged"] += 1
+
+verb = "would change" if args.dry_run else "changed"
+for rule, count in zip(rules, counts):
+    print(
+        f"{rule['description']}: {verb} {count['changed']} files, "
+        f"{count['unchanged']} already fixed (left alone)"
+    )
+if not args.dry_run:
+    if (journal_dir / "journal.jsonl").is_file():
+        print(f"journal: {journal_dir} (undo with --undo)")
+    else:
+        journal_dir.rmdir()
@@ -4,12 +4,16 @@ from pathlib import Path
 
 import mne
 import numpy as np
+import pandas as pd
 
 from utils import tasks
 
 ecgpath = Path("../ecg-mags.yaml").resolve()
 with open(ecgpath) as fid:
     ecgs = yaml.safe_load(fid)
+# ranked by `score-ecg-mags.py` (which fills in the unambiguous ones)
+candidates_path = ecgpath.with_name("ecg-mag-candidates.csv")
+candidates = pd.read_csv(candidates_path) if candidates_path.is_file() else None
 
 indir = Path(".").resolve()
 infiles = indir.glob("*.fif")
@@ -20,25 +24,28 @@ pattern = rf"(?P<sub>sub-\d{{3}})_(?P<ses>ses-[abc])_task-{task}_proc-filt_raw.f
 for infile in infiles:
     res = re.match(pattern, infile.name)
     sub, ses = res.groups()
+    key = f"{sub}_{ses}"
     # skip ones we've already done
-    if ecgs[sub][ses] is not None:
+    if ecgs.get(key) is not None:
         continue
+    if candidates is not None:
+        these = candidates.loc[candidates["recording"] == key]
+        print(f"{key} candidates:\n{these.to_string(index=False)}")
     # load the raw and plot MAGs
     raw = mne.io.read_raw_fif(infile, verbose=False)
     raw.info["bads"] = []
     fig = raw.plot(picks="mag", block=True)
     # use the one marked as bad as the ECG channel
     mag = np.array(raw.info["bads"]).item()
-    ecgs[sub][ses] = mag
+    ecgs[key] = mag
     print(f"assigning {mag} to {sub} {ses}")
 
 # log progress
 done = 0
 total = 0
-for sub, sess in ecgs.items():
-    for ses, mag in sess.items():
-        total += 1
-        done += 0 if mag is None else 1
+for key, mag in ecgs.items():
+    total += 1
+    done += 0 if mag is None else 1
 print(f"{done} / {total} done")
 
 with open(ecgpath, "w") as fid:
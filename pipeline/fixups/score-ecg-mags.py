@@ -0,0 +1,154 @@
+"""Rank the magnetometers of each AM recording by how much cardiac signal they carry.
+
+For each `proc-filt` AM recording, the magnetometer data are read a chunk at a time.
+Each channel's QRS-band energy envelope is autocorrelated, and the channel is scored
+by the autocorrelation peak at plausible (infant) heart rates. The top candidates are
+written to `ecg-mag-candidates.csv` (next to `ecg-mags.yaml`). The best channel is
+filled into `ecg-mags.yaml` when its confidence is high enough (and the entry is still
+empty), so `choose-ecg-mag.py` only needs to open the ambiguous recordings.
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import mne
+import numpy as np
+import pandas as pd
+import yaml
+from scipy.ndimage import uniform_filter1d
+from scipy.signal import butter, sosfiltfilt
+
+from utils import tasks
+
+parser = argparse.ArgumentParser(description="Rank MAGs by cardiac signal")
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=os.cpu_count(),
+    help="Number of recordings to score in parallel",
+)
+parser.add_argument(
+    "--top-k", type=int, default=3, help="Number of candidates to list per recording"
+)
+parser.add_argument(
+    "--min-confidence",
+    type=float,
+    default=0.5,
+    help="Fill in ecg-mags.yaml when the top candidate is at least this confident",
+)
+args = parser.parse_args()
+
+# config
+qrs_band = (10.0, 30.0)  # Hz
+smooth_seconds = 0.05  # envelope smoothing
+heart_rate_range = (80, 220)  # beats per minute (infants)
+chunk_seconds = 60.0
+
+# paths
+deriv_root = Path("/storage/badbaby-redux/bids-data/derivatives/mne-bids-pipeline")
+ecgpath = Path(__file__).resolve().parents[1] / "ecg-mags.yaml"
+candidates_path = ecgpath.with_name("ecg-mag-candidates.csv")
+task = tasks["am"]
+pattern = rf"(?P<sub>sub-\d{{3}})_(?P<ses>ses-[abc])_task-{task}_proc-filt_raw.fif"
+
+
+def cardiac_scores(fname):
+    """Score each magnetometer by the periodicity of its QRS-band envelope.
+
+    Returns the channel names, their scores (peak autocorrelation at heart-rate lags),
+    and the heart rate (in bpm) at each channel's peak.
+    """
+    raw = mne.io.read_raw_fif(fname, preload=False, verbose=False)
+    sfreq = raw.info["sfreq"]
+    picks = mne.pick_types(raw.info, meg="mag", exclude=())
+    ch_names = [raw.ch_names[pick] for pick in picks]
+    sos = butter(4, qrs_band, btype="bandpass", fs=sfreq, output="sos")
+    width = max(int(round(smooth_seconds * sfreq)), 1)
+    min_lag = int(sfreq * 60 / heart_rate_range[1])
+    max_lag = int(np.ceil(sfreq * 60 / heart_rate_range[0]))
+    n_chunk = int(chunk_seconds * sfreq)
+    acf_sum = 0
+    n_chunks = 0
+    for start in range(0, raw.n_times, n_chunk):
+        data = raw.get_data(picks=picks, start=start, stop=start + n_chunk)
+        if data.shape[1] < 4 * max_lag:
+            break
+        # QRS-band energy envelope (like Pan-Tompkins), z-scored per channel
+        env = sosfiltfilt(sos, data, axis=1) ** 2
+        env = uniform_filter1d(env, width, axis=1)
+        env -= env.mean(axis=1, keepdims=True)
+        env /= np.maximum(env.std(axis=1, keepdims=True), np.finfo(float).tiny)
+        # autocorrelation (via FFT) up to the longest heartbeat
+        n_fft = 2 ** int(np.ceil(np.log2(2 * env.shape[1])))
+        spec = np.fft.rfft(env, n_fft, axis=1)
+        acf = np.fft.irfft(np.abs(spec) ** 2, n_fft, axis=1)[:, : max_lag + 1]
+        acf_sum = acf_sum + acf / acf[:, :1]
+        n_chunks += 1
+    if not n_chunks:
+        raise RuntimeError(f"{fname.name} is too short to score")
+    acf = acf_sum[:, min_lag:] / n_chunks
+    best_lag = acf.argmax(axis=1)
+    scores = acf[np.arange(len(ch_names)), best_lag]
+    heart_rates = 60 * sfreq / (best_lag + min_lag)
+    return ch_names, scores, heart_rates
+
+
+def score_file(fname):
+    """Rank the MAGs of one recording; confidence is how much the best one stands out."""
+    ch_names, scores, heart_rates = cardiac_scores(fname)
+    order = np.argsort(scores)[::-1]
+    typical = np.median(scores)
+    confidence = (scores[order[0]] - typical) / max(1 - typical, np.finfo(float).eps)
+    sub, ses = re.match(pattern, fname.name).groups()
+    return [
+        dict(
+            recording=f"{sub}_{ses}",
+            rank=rank + 1,
+            channel=ch_names[ix],
+            score=scores[ix],
+            heart_rate=heart_rates[ix],
+            confidence=confidence if rank == 0 else np.nan,
+        )
+        for rank, ix in enumerate(order[: args.top_k])
+    ]
+
+
+def run_files(fnames, n_jobs):
+    """Score the files (serially or on a process pool), yielding results in order."""
+    if n_jobs == 1:
+        yield from map(score_file, fnames)
+        return
+    # fork (not spawn) so that workers don't re-run this script's top-level code
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        yield from pool.map(score_file, fnames)
+
+
+fnames = sorted(
+    fname for fname in deriv_root.rglob("*_proc-filt_raw.fif") if re.match(pattern, fname.name)
+)
+candidates = pd.DataFrame(sum(run_files(fnames, n_jobs=args.jobs), []))
+candidates.round(3).to_csv(candidates_path, index=False)
+
+# fill in the confident ones (never overwriting a choice that's already there)
+with open(ecgpath) as fid:
+    ecgs = yaml.safe_load(fid)
+top = candidates.loc[candidates["rank"] == 1]
+confident = top["confidence"] >= args.min_confidence
+n_filled = 0
+for row in top.loc[confident].itertuples():
+    if ecgs.get(row.recording) is None:
+        ecgs[row.recording] = row.channel
+        n_filled += 1
+        print(f"assigning {row.channel} to {row.recording} (confidence {row.confidence:.2f})")
+for row in top.loc[~confident].itertuples():
+    print(f"ambiguous: {row.recording} (best is {row.channel}, confidence {row.confidence:.2f})")
+print(f"{len(top)} recordings scored; {n_filled} filled in, {(~confident).sum()} ambiguous")
+
+with open(ecgpath, "w") as fid:
+    yaml.safe_dump(ecgs, fid, default_flow_style=False)
@@ -0,0 +1,231 @@
+"""Anonymize a copy of a raw FIF file by patching its header tags in place.
+
+``write_raw_bids(..., anonymize=...)`` decodes and rewrites all of a file's data, just
+to change a few measurement-info tags. Here the file is cloned instead (sharing its
+data blocks, on filesystems that support reflinks) and only the tags that
+``mne.io.anonymize_info`` changes are rewritten: dates and ID structs are shifted
+(with the machine IDs zeroed), and subject, experimenter, project, and device strings
+are replaced with placeholders. Fields the source doesn't have are not added (so
+unlike a rewrite, a file without an experimenter or description doesn't gain one).
+
+A tag whose new value doesn't fit where the old one was is moved to the end of the
+file. The old bytes are zeroed either way, and the tag directory and the ``next``
+pointers are updated, so readers see the tags in their original order.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+import struct
+from pathlib import Path
+
+import mne
+import numpy as np
+from mne._fiff.open import fiff_open
+from mne.io.constants import FIFF
+from mne.utils import object_diff
+
+FICLONE = 0x40049409  # from <linux/fs.h>
+DATE_NONE = (0, 2**31 - 1)
+# what `mne.io.anonymize_info` puts in place of identifying strings
+default_str = "mne_anonymize"
+default_desc = "Anonymized using a time shift to preserve age at acquisition"
+# (block, tag kind): new value (None removes the tag)
+_replacements = {
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_FIRST_NAME): default_str,
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_MIDDLE_NAME): default_str,
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_LAST_NAME): default_str,
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_HIS_ID): "0",
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_ID): 0,
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_SEX): 0,
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_WEIGHT): 0,
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_HEIGHT): 0,
+    (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_HAND): None,
+    (FIFF.FIFFB_MEAS_INFO, FIFF.FIFF_EXPERIMENTER): default_str,
+    (FIFF.FIFFB_MEAS_INFO, FIFF.FIFF_DESCRIPTION): default_desc,
+    (FIFF.FIFFB_MEAS_INFO, FIFF.FIFF_PROJ_ID): 0,
+    (FIFF.FIFFB_MEAS_INFO, FIFF.FIFF_PROJ_NAME): default_str,
+    (FIFF.FIFFB_MEAS_INFO, FIFF.FIFF_UTC_OFFSET): None,
+    (FIFF.FIFFB_PROCESSING_RECORD, FIFF.FIFF_EXPERIMENTER): default_str,
+    (FIFF.FIFFB_HELIUM, FIFF.FIFF_ORIG_FILE_GUID): default_str,
+    (FIFF.FIFFB_DEVICE, FIFF.FIFF_DEVICE_SERIAL): default_str,
+    (FIFF.FIFFB_DEVICE, FIFF.FIFF_DEVICE_SITE): default_str,
+}
+# blocks whose FIFF_MEAS_DATE is shifted
+_dated_blocks = (
+    FIFF.FIFFB_MEAS_INFO,
+    FIFF.FIFFB_PROCESSING_RECORD,
+    FIFF.FIFFB_HELIUM,
+    FIFF.FIFFB_MNE_ANNOTATIONS,
+)
+
+
+def clone_file(source, target):
+    """Copy a file, sharing its data blocks with the source where possible.
+
+    Tries a reflink (copy-on-write clone), and falls back to a regular (in-kernel)
+    copy. Returns ``"reflink"`` or ``"copy"``.
+    """
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except OSError as err:
+            if err.errno not in (
+                errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS
+            ):
+                raise
+    shutil.copyfile(source, target)  # (streamed by the kernel, with sendfile)
+    return "copy"
+
+
+def _shift_stamp(data, dtype, seconds):
+    """Shift a (secs, usecs) timestamp back, unless it's the "no date" placeholder."""
+    stamp = np.frombuffer(data, dtype).astype(np.float64 if dtype == ">f8" else np.int64)
+    if dtype == ">i4" and tuple(stamp[-2:]) == DATE_NONE:
+        return data
+    stamp[-2] -= seconds
+    if dtype == ">i4" and not -(2**31) <= stamp[-2] < 2**31:
+        raise ValueError(f"daysback is too large to store the shifted date {stamp}")
+    return stamp.astype(dtype).tobytes()
+
+
+def _may_change(block, tag):
+    """Check (from its header alone) whether a tag is one that anonymizing can change."""
+    return (
+        tag.type == FIFF.FIFFT_ID_STRUCT
+        or (block, tag.kind) in _replacements
+        or (tag.kind == FIFF.FIFF_MEAS_DATE and block in _dated_blocks)
+        or (block, tag.kind) == (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_BIRTH_DAY)
+    )
+
+
+def _new_data(block, tag, data, daysback):
+    """Get the anonymized data of a tag (``data`` if unchanged, None to remove it)."""
+    if tag.type == FIFF.FIFFT_ID_STRUCT:  # version, machid[2], secs, usecs
+        stamp = np.frombuffer(_shift_stamp(data, ">i4", daysback * 86400), ">i4").copy()
+        stamp[1:3] = 0
+        return stamp.tobytes()
+    if tag.kind == FIFF.FIFF_MEAS_DATE and block in _dated_blocks:
+        dtype = {FIFF.FIFFT_INT: ">i4", FIFF.FIFFT_DOUBLE: ">f8"}.get(tag.type)
+        if dtype is None or len(data) != 2 * np.dtype(dtype).itemsize:
+            raise ValueError(f"Can't shift a meas date tag of type {tag.type}")
+        return _shift_stamp(data, dtype, daysback * 86400)
+    if (block, tag.kind) == (FIFF.FIFFB_SUBJECT, FIFF.FIFF_SUBJ_BIRTH_DAY):
+        if tag.type != FIFF.FIFFT_JULIAN or len(data) != 4:
+            raise ValueError(f"Can't shift a birthday tag of type {tag.type}")
+        return np.array(np.frombuffer(data, ">i4") - daysback, ">i4").tobytes()
+    if (block, tag.kind) not in _replacements:
+        return data
+    value = _replacements[block, tag.kind]
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    return bytes(len(data))  # a zero, whether it's an int or a float
+
+
+def _walk(tree, block=0):
+    """Yield ``(block, tag)`` for all the tags in a FIF tree."""
+    for tag in tree["directory"] or ():
+        yield block, tag
+    for child in tree["children"]:
+        yield from _walk(child, child["block"])
+
+
+def anonymize_fif(fname, daysback):
+    """Anonymize a raw FIF file in place, patching only the tags that change.
+
+    Returns the number of tags patched.
+    """
+    fid, tree, directory = fiff_open(Path(fname))
+    fid.close()
+    with open(fname, "r+b") as fid:
+        header = struct.Struct(">iIii")
+        # the directory (if any) is a tag of (kind, type, size, pos) entries, pointed
+        # to by the tag after the file ID
+        _, _, size, next_ = header.unpack(fid.read(header.size))
+        fid.seek(header.size + size if next_ == 0 else next_)
+        kind, _, _, _ = header.unpack(fid.read(header.size))
+        assert kind == FIFF.FIFF_DIR_POINTER, kind
+        (dir_pos,) = struct.unpack(">i", fid.read(4))
+        entries = dict()
+        if dir_pos > 0:
+            fid.seek(dir_pos)
+            _, dir_type, dir_size, _ = header.unpack(fid.read(header.size))
+            if dir_type == FIFF.FIFFT_DIR_ENTRY_STRUCT and dir_size == 16 * len(directory):
+                entries = {
+                    tag.pos: dir_pos + header.size + 16 * ix
+                    for ix, tag in enumerate(directory)
+                }
+        end = fid.seek(0, os.SEEK_END)
+        n_patched = 0
+        for block, tag in list(_walk(tree)):
+            # (the data buffers etc. are never read)
+            if not _may_change(block, tag):
+                continue
+            fid.seek(tag.pos)
+            kind, type_, size, next_ = header.unpack(fid.read(header.size))
+            data = fid.read(size)
+            new = _new_data(block, tag, data, daysback)
+            if new == data:
+                continue
+            n_patched += 1
+            # where the next tag is (so that a shorter or moved tag can point to it)
+            next_pos = tag.pos + header.size + size if next_ == 0 else next_
+            entry = None if tag.pos not in entries else entries[tag.pos]
+            fid.seek(tag.pos + header.size)
+            fid.write(bytes(size))  # whatever happens, the old value is gone
+            if new is not None and len(new) <= size:
+                # in place (pointing past any slack at the end)
+                fid.seek(tag.pos)
+                this_next = next_ if len(new) == size else next_pos
+                fid.write(header.pack(kind, type_, len(new), this_next) + new)
+                new_entry = (kind, type_, len(new), tag.pos)
+            else:
+                # leave an empty tag that points to the new one (if any) at the end
+                fid.seek(tag.pos)
+                if new is None:
+                    fid.write(header.pack(FIFF.FIFF_NOP, FIFF.FIFFT_VOID, 0, next_pos))
+                    new_entry = (FIFF.FIFF_NOP, FIFF.FIFFT_VOID, 0, tag.pos)
+                else:
+                    fid.write(header.pack(FIFF.FIFF_NOP, FIFF.FIFFT_VOID, 0, end))
+                    fid.seek(end)
+                    fid.write(header.pack(kind, type_, len(new), next_pos) + new)
+                    new_entry = (kind, type_, len(new), end)
+                    end += header.size + len(new)
+            if entry is not None:
+                fid.seek(entry)
+                fid.write(struct.pack(">iIii", *new_entry))
+    return n_patched
+
+
+def anonymized_clone(raw, fname, daysback, **read_raw_kw):
+    """Clone the file of ``raw`` to ``fname``, and anonymize it there.
+
+    ``raw`` itself is left alone. The result is checked against ``raw.anonymize``: a
+    ``ValueError`` is raised (and ``fname`` removed) unless the clone reads back with
+    the same info, so it's only for files whose info hasn't been changed in memory.
+    Returns how the file was cloned (``"reflink"`` or ``"copy"``).
+    """
+    if len(raw.filenames) != 1:
+        raise ValueError("Split files can't be cloned")
+    try:
+        method = clone_file(raw.filenames[0], fname)
+        anonymize_fif(fname, daysback)
+        expected = raw.copy().anonymize(daysback=daysback).info
+        info = mne.io.read_raw_fif(fname, **read_raw_kw).info
+        # (placeholders are written over existing fields, but never added)
+        for key in ("experimenter", "description"):
+            if raw.info[key] is None:
+                with expected._unlock():
+                    expected[key] = None
+        keys = sorted(set(expected) | set(info))
+        diff = [key for key in keys if object_diff(expected.get(key), info.get(key))]
+        if diff:
+            raise ValueError(f"the clone's info would differ in {', '.join(diff)}")
+    except Exception:
+        Path(fname).unlink(missing_ok=True)
+        raise
+    return method
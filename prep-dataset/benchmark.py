@@ -0,0 +1,247 @@
+"""Time the prep-dataset steps on a synthetic cohort (no access to the real data needed).
+
+A cohort is written with `synthetic.py` (into a temporary folder, or into ``--root``,
+where it's reused on later runs), and the scripts are pointed at it with
+``$BADBABY_ROOT`` (and at a private cache with ``$BADBABY_CACHE``). Benchmarks:
+
+- parse-events-{am,ids,mmn}: the STIM channel parsers of score.py, over all files
+- tab-catalog: indexing the expyfun TAB files from scratch
+- find-matching-tabs: matching every file's events to its TAB file
+- catalog-data-completeness (cold / warm header cache)
+- find-surrogate-erms (by date / by spectrum, cold cache)
+- suggest-prebads: scoring the channels of all files (cold cache)
+- bidsify-unit: converting one (subject, session, task) unit, anatomy included (and
+  with ``--copy-free``)
+
+Each benchmark runs ``--repeat`` times; the results (all times, plus min and median,
+in seconds) are written as JSON to ``--output``, along with the cohort's size and the
+library versions.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description="Benchmark the prep-dataset scripts")
+parser.add_argument(
+    "--root", type=Path, help="Where to write (or find) the cohort (default: temp dir)"
+)
+parser.add_argument("--subjects", type=int, default=3, help="Number of subjects")
+parser.add_argument(
+    "--seconds", type=float, default=30.0, help="Duration of each recording"
+)
+parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark")
+parser.add_argument(
+    "--jobs", "-j", type=int, default=1, help="--jobs for the scripts that have it"
+)
+parser.add_argument("--only", nargs="+", metavar="NAME", help="Run only these")
+parser.add_argument(
+    "--output",
+    type=Path,
+    default=Path("qc") / "benchmark.json",
+    help="Where to write the results",
+)
+args = parser.parse_args()
+
+# the cohorts (and their caches): the full one, and a one-unit one for bidsify.py
+base = args.root.resolve() if args.root else Path(tempfile.mkdtemp(prefix="badbaby-"))
+cohort_root, unit_root, cache = base / "cohort", base / "unit", base / "cache"
+scripts = Path(__file__).resolve().parent
+os.environ["BADBABY_ROOT"] = str(cohort_root)
+os.environ["BADBABY_CACHE"] = str(cache)
+
+# (these read $BADBABY_ROOT and $BADBABY_CACHE when imported)
+import mne
+import mne_bids
+import numpy as np
+import score
+from synthetic import write_cohort
+from utils import read_info_cached
+
+results = list()
+
+
+def benchmark(name, run, setup=None, **extra):
+    """Time ``run()`` (after ``setup()``, untimed) ``--repeat`` times."""
+    if args.only and name not in args.only:
+        return
+    times = list()
+    for _ in range(args.repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    results.append(
+        dict(
+            name=name,
+            min=min(times),
+            median=statistics.median(times),
+            times=times,
+            **extra,
+        )
+    )
+    print(f"{name:<32} {min(times):8.3f} s (min) {statistics.median(times):8.3f} s (median)")
+
+
+def script(name, *script_args, root=cohort_root):
+    """Get a function that runs a prep-dataset script on a cohort."""
+    env = os.environ | dict(BADBABY_ROOT=str(root))
+    command = [sys.executable, str(scripts / name), *map(str, script_args)]
+
+    def run():
+        proc = subprocess.run(
+            command, cwd=root / "prep-dataset", env=env, capture_output=True, text=True
+        )
+        if proc.returncode:
+            sys.exit(f"{' '.join(command)} failed:\n{proc.stderr}")
+
+    return run
+
+
+def clear(*paths):
+    """Get a function that deletes cache folders / outputs."""
+
+    def run():
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return run
+
+
+# write the cohorts (unless they're there already)
+start = time.perf_counter()
+if not (cohort_root / "data").is_dir():
+    write_cohort(cohort_root, n_subjects=args.subjects, seconds=args.seconds)
+if not (unit_root / "data").is_dir():
+    write_cohort(
+        unit_root, n_subjects=1, sessions="a", kinds=["am", "erm"], anat=True,
+        seconds=args.seconds,
+    )
+raw_files = sorted((cohort_root / "data").rglob("*_raw.fif"))
+exp_files = [fname for fname in raw_files if not fname.name.endswith("_erm_raw.fif")]
+print(f"cohort: {len(raw_files)} raw files in {base} ({time.perf_counter() - start:.1f} s)")
+
+# the STIM channel parsers (on warm header caches)
+infos = {fname: read_info_cached(fname) for fname in exp_files}
+tasks = {fname: fname.name.split("_")[2] for fname in exp_files}
+
+
+def parse_events(fname):
+    """Parse a file's events, the way bidsify.py does."""
+    task = tasks[fname]
+    parse = score.parse_mmn_events if task == "mmn" else score.custom_extract_expyfun_events
+    return parse(fname, offset=score.EVENT_OFFSETS[task], info=infos[fname])[0]
+
+
+for task in ("am", "ids", "mmn"):
+    fnames = [fname for fname in exp_files if tasks[fname] == task]
+    benchmark(
+        f"parse-events-{task}",
+        lambda fnames=fnames: list(map(parse_events, fnames)),
+        n_files=len(fnames),
+    )
+events = {fname: parse_events(fname) for fname in exp_files}
+
+# TAB files: index them, then match each file's events
+tab_files = list(score.tab_dir.glob("*.tab"))
+benchmark(
+    "tab-catalog",
+    score.refresh_tab_catalog,
+    setup=lambda: score.tab_catalog_file.unlink(missing_ok=True),
+    n_files=len(tab_files),
+)
+
+
+def match_tabs():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for fname, these_events in events.items():
+            subj, session = fname.name[4:7], fname.name[7]
+            score.find_matching_tabs(
+                these_events, subj, session, tasks[fname], infos[fname]["meas_date"],
+                logfile=Path(tmpdir) / "log.txt",
+            )
+
+
+score.get_tab_catalog()
+benchmark("find-matching-tabs", match_tabs, n_files=len(events))
+
+# the catalog and surrogate-ERM scripts
+catalog = script("catalog-data-completeness.py", "combined", "--jobs", args.jobs)
+benchmark(
+    "catalog-data-completeness-cold",
+    catalog,
+    setup=clear(cache / "info"),
+    n_files=len(raw_files),
+)
+benchmark("catalog-data-completeness-warm", catalog, n_files=len(raw_files))
+if not (cohort_root / "prep-dataset" / "qc" / "erm-missing-from-data.csv").is_file():
+    catalog()  # (the input of the ERM search)
+benchmark(
+    "find-surrogate-erms",
+    script("find-surrogate-erms.py"),
+    setup=clear(cache / "info"),
+)
+benchmark(
+    "find-surrogate-erms-spectral",
+    script("find-surrogate-erms.py", "--spectral"),
+    setup=clear(cache / "info", cache / "psd-erm", cache / "psd-prestim"),
+)
+benchmark(
+    "suggest-prebads",
+    script("suggest-prebads.py", "--jobs", args.jobs),
+    setup=clear(cache / "prebad-stats"),
+    n_files=len(raw_files),
+)
+
+# one bidsify.py unit, from scratch
+benchmark(
+    "bidsify-unit",
+    script("bidsify.py", "101", "--jobs", args.jobs, root=unit_root),
+    setup=clear(
+        unit_root / "bids-data", cache / "info", cache / "sha256", cache / "anat-manifests"
+    ),
+    n_files=1,
+)
+benchmark(
+    "bidsify-unit-copy-free",
+    script("bidsify.py", "101", "--jobs", args.jobs, "--copy-free", root=unit_root),
+    setup=clear(
+        unit_root / "bids-data", cache / "info", cache / "sha256", cache / "anat-manifests"
+    ),
+    n_files=1,
+)
+
+output = dict(
+    cohort=dict(
+        root=str(base),
+        n_subjects=args.subjects,
+        seconds=args.seconds,
+        n_raw_files=len(raw_files),
+        n_bytes=sum(fname.stat().st_size for fname in raw_files),
+    ),
+    repeat=args.repeat,
+    jobs=args.jobs,
+    platform=dict(
+        python=platform.python_version(),
+        machine=platform.machine(),
+        n_cpus=os.cpu_count(),
+        mne=mne.__version__,
+        mne_bids=mne_bids.__version__,
+        numpy=np.__version__,
+    ),
+    results=results,
+)
+args.output.parent.mkdir(parents=True, exist_ok=True)
+args.output.write_text(json.dumps(output, indent=1))
+print(f"results written to {args.output}")
+if not args.root:
+    shutil.rmtree(base)
@@ -1,13 +1,22 @@
 """Create BIDS folder structure for "badbaby" data."""
 
 import argparse
+import fcntl
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 from pathlib import Path
+from tempfile import TemporaryDirectory
 from warnings import filterwarnings
 
 import mne
 import numpy as np
 import pandas as pd
 import yaml
+from mne.io.constants import FIFF
 from mne_bids import (
     BIDSPath,
     get_anat_landmarks,
@@ -18,14 +27,25 @@ from mne_bids import (
     write_meg_crosstalk,
     write_raw_bids,
 )
+from anonymize import anonymized_clone
 from score import (
     EVENT_OFFSETS,
     custom_extract_expyfun_events,
     find_matching_tabs,
+    get_tab_catalog,
     parse_mmn_events,
 )
 
-from utils import hardlink, tasks
+from utils import (
+    cache_dir,
+    file_key,
+    link_files,
+    refit_hpi_cached,
+    root,
+    sha256,
+    stage,
+    tasks,
+)
 
 verify_events_against_tab_files = True
 
@@ -64,8 +84,22 @@ parser = argparse.ArgumentParser(
     description="Create BIDS folder structure for badbaby data",
 )
 parser.add_argument("SUBJECTS", type=str, nargs="*", help="Subject IDs to process")
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of (subject, session, task) units to convert in parallel",
+)
+parser.add_argument(
+    "--copy-free",
+    action="store_true",
+    help="Clone the FIF files (reflinks, where possible) and anonymize only their "
+    "headers, instead of rewriting them",
+)
 args = parser.parse_args()
 subjects_to_process = tuple(args.SUBJECTS)
+n_jobs = args.jobs
 for si, subj in enumerate(subjects_to_process):
     try:
         int(subj)
@@ -74,7 +108,6 @@ for si, subj in enumerate(subjects_to_process):
 overwrite = bool(subjects_to_process)  # allow overwriting if specific subjects given
 
 # path stuff
-root = Path("/storage/badbaby-redux").resolve()
 orig_data = root / "data"
 bids_root = root / "bids-data"
 cal_dir = root / "calibration"
@@ -110,8 +143,6 @@ event_mappings = dict(
 
 read_raw_kw = dict(allow_maxshield="yes", preload=False)
 
-df = None
-
 # load the list of bad channels ("prebads") that were noted during acquisition
 with open(prep_dir / "prebads.yaml") as fid:
     prebads = yaml.safe_load(fid)
@@ -120,11 +151,366 @@ with open(prep_dir / "prebads.yaml") as fid:
 with open(prep_dir / "refit-options.yml", "r") as fid:
     refit_options = yaml.load(fid, Loader=yaml.SafeLoader)
 
-# we write MRI data once per subj, but we need a raw file loaded in order to properly
-# write the `trans` information. Use a signal variable to avoid writing more than once.
-last_anat_written = None
 
-# classify raw files by "task" from the filenames
+@contextmanager
+def shared_sidecar_lock():
+    """Serialize MNE-BIDS calls that rewrite files shared across units.
+
+    ``write_raw_bids`` and friends do read-modify-write on ``participants.tsv``,
+    ``scans.tsv``, and the (shared) empty-room recordings, so parallel workers must not
+    run them concurrently.
+    """
+    with open(outdir / ".bidsify.lock", "w") as fid:
+        fcntl.flock(fid, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fid, fcntl.LOCK_UN)
+
+
+def write_raw_bids_copy_free(raw, erm, bids_path, **kwargs):
+    """Write a run (and its ERM) like ``write_raw_bids``, but with cloned FIF files.
+
+    The sidecars are written by ``write_raw_bids`` from the anonymized raws (so they're
+    the same as those of a regular export), and the files are anonymized clones of the
+    originals (see `anonymize.py`). If a file can't be cloned (e.g. its info was
+    changed by a refit), the run is written the regular way. Returns a description of
+    what was done. Call it with the `shared_sidecar_lock` held.
+    """
+    raws = [raw.copy().anonymize(daysback=DAYSBACK)]
+    targets = [bids_path.fpath]
+    if erm is not None:
+        raws.append(erm.copy().anonymize(daysback=DAYSBACK))
+        er_session = raws[-1].info["meas_date"].strftime("%Y%m%d")
+        er_path = bids_path.copy().update(
+            subject="emptyroom", session=er_session, task="noise", run=None
+        )
+        targets.append(er_path.fpath)
+    clones = list()
+    try:
+        for this_raw, target in zip([raw, erm], targets):
+            target.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+            method = anonymized_clone(this_raw, tmp_file, DAYSBACK, **read_raw_kw)
+            clones.append((tmp_file, target, method))
+        outcome = ", ".join(f"{target.name} ({method})" for _, target, method in clones)
+    except ValueError as err:
+        for tmp_file, *_ in clones:
+            tmp_file.unlink()
+        clones = list()
+        outcome = f"rewritten, as {err}"
+    # remove earlier exports first (else `write_raw_bids` loads the data to replace them)
+    for target in targets:
+        target.unlink(missing_ok=True)
+    try:
+        write_raw_bids(
+            raw=raws[0],
+            bids_path=bids_path,
+            empty_room=raws[1] if erm is not None else None,
+            anonymize=None,  # (done already)
+            symlink=bool(clones),  # (the links are replaced by the clones below)
+            **kwargs,
+        )
+        for tmp_file, target, _ in clones:
+            tmp_file.replace(target)
+    finally:
+        for tmp_file, *_ in clones:
+            tmp_file.unlink(missing_ok=True)
+    return outcome
+
+
+def anat_inputs(full_subj, compound_subj_name, info):
+    """Describe what an anatomy export depends on (by content, not by timestamp).
+
+    That's every file of the scaled MRI (T1, trans, BEM, source spaces, ...), plus the
+    digitized fiducials that the T1 landmarks are computed from.
+    """
+    anat_dir = mri_dir / full_subj
+    files = {
+        str(path.relative_to(anat_dir)): sha256(path)
+        for path in sorted(anat_dir.rglob("*"))
+        if path.is_file()
+    }
+    fiducials = [
+        [int(dig["ident"]), np.round(dig["r"], 9).tolist()]
+        for dig in info["dig"] or list()
+        if dig["kind"] == FIFF.FIFFV_POINT_CARDINAL
+    ]
+    return dict(subject=compound_subj_name, files=files, fiducials=fiducials)
+
+
+def anat_is_current(manifest_file, inputs):
+    """Check an anatomy export's manifest against its inputs and outputs."""
+    if not manifest_file.is_file():
+        return False
+    manifest = json.loads(manifest_file.read_text())
+    return manifest["inputs"] == inputs and all(
+        Path(item[0]).is_file() and list(file_key(item[0])) == item
+        for item in manifest["outputs"]
+    )
+
+
+def write_subject_anat(subj, session, full_subj, task_code, info, bids_path):
+    """Write the (surrogate) MRI of one subject/session in the BIDS derivatives tree.
+
+    Skipped when neither the inputs nor the outputs changed since the last (verified)
+    export, per the manifest in ``prep-dataset/cache/anat-manifests``.
+    """
+    # Since we have separate MRIs for different sessions (they're months apart, and
+    # these are infants), we need to rename the subject folder (and some of the files)
+    # to use a compound "subject" name like `sub-XXX_ses-Y`
+    compound_subj_name = f"sub-{subj}_ses-{session}"
+    anat_path = bids_root / "derivatives" / "freesurfer" / "subjects" / compound_subj_name
+    # handle cases where one task was done on a different day
+    if len(full_subj.split("_")) > 2:
+        compound_subj_name = f"{compound_subj_name}_task-{task_code}"
+        anat_path = anat_path.with_name(compound_subj_name)
+    manifest_file = cache_dir / "anat-manifests" / f"{compound_subj_name}.json"
+    inputs = anat_inputs(full_subj, compound_subj_name, info)
+    if anat_is_current(manifest_file, inputs):
+        print(f"↳ {compound_subj_name} anatomy unchanged since last verified; skipped")
+        return
+    # (redoing a stale export: `rescale-coreg.py` rewrites the scaled MRI as new files,
+    # so the old links have to be replaced, and any files since dropped removed)
+    redo = overwrite or manifest_file.is_file()
+    links = list()
+    for dirpath, dirnames, filenames in (mri_dir / full_subj).walk():
+        for dirname in dirnames:
+            # adjust "subject" name when it's the foldername
+            dirname_out = dirname.replace(full_subj, compound_subj_name)
+            (anat_path / dirname_out).mkdir(parents=True, exist_ok=True)
+        for fname in filenames:
+            # adjust "subject" name when it's incorporated into filenames
+            # (e.g. for the trans- and BEM files)
+            fname_out = fname.replace(full_subj, compound_subj_name)
+            target = anat_path / dirpath.relative_to(mri_dir / full_subj) / fname_out
+            links.append((dirpath / fname, target))
+    result = link_files(links, replace=redo)
+    if result["conflict"]:
+        raise RuntimeError(
+            f"{len(result['conflict'])} files in {anat_path} aren't links to the "
+            f"scaled MRI (e.g. {result['conflict'][0][1].name}); rerun for just this "
+            "subject to replace them"
+        )
+    if manifest_file.is_file():
+        targets = {str(target) for _, target in links}
+        for fname, *_ in json.loads(manifest_file.read_text())["outputs"]:
+            if Path(fname).is_relative_to(anat_path) and fname not in targets:
+                Path(fname).unlink(missing_ok=True)
+    # now use MNE-BIDS to (re)write the T1, so we can get the side
+    # effect of converting the trans file to a JSON sidecar
+    t1_fname = mri_dir / full_subj / "mri" / "T1.mgz"
+    trans = mne.read_trans(anat_path / f"{compound_subj_name}_trans.fif")
+    landmarks = get_anat_landmarks(
+        image=t1_fname,
+        info=info,
+        trans=trans,
+        fs_subject=compound_subj_name,
+        fs_subjects_dir=anat_path.parent,
+    )
+    mri_path = BIDSPath(root=bids_root, subject=subj, session=session)
+    nii_file = write_anat(
+        image=t1_fname,
+        bids_path=mri_path,
+        landmarks=landmarks,
+        overwrite=redo,
+    )
+    # make sure our written trans is identical to numerical precision
+    trans_bids = get_head_mri_trans(
+        bids_path,
+        t1_bids_path=nii_file,
+        fs_subject=compound_subj_name,
+        fs_subjects_dir=anat_path.parent,
+    )
+    assert trans["to"] == trans_bids["to"]
+    assert trans["from"] == trans_bids["from"]
+    np.testing.assert_allclose(
+        trans["trans"], trans_bids["trans"], atol=1e-6,
+    )
+    # make a copy of the source space using the filename that
+    # MNE-BIDS-Pipeline prefers and the subject_his_id set correctly
+    # (otherwise forward modeling reasonably complains)
+    src_in = anat_path / "bem" / f"{compound_subj_name}-oct-6-src.fif"
+    src_out = anat_path / "bem" / f"{compound_subj_name}-oct6-src.fif"
+    assert src_in.is_file()
+    if redo:
+        src_out.unlink(missing_ok=True)  # from the previous export
+    assert not src_out.is_file()
+    src = mne.read_source_spaces(src_in)
+    for s in src:
+        s["subject_his_id"] = compound_subj_name
+    mne.write_source_spaces(src_out, src, overwrite=True)
+    # record what we verified, so that unchanged anatomy isn't re-exported next time
+    outputs = [
+        *(path for path in anat_path.rglob("*") if path.is_file()),
+        nii_file.fpath,
+        nii_file.copy().update(extension=".json").fpath,
+    ]
+    manifest = dict(
+        inputs=inputs,
+        outputs=sorted(list(file_key(path)) for path in outputs),
+        verified=datetime.now().isoformat(timespec="seconds"),
+    )
+    manifest_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = manifest_file.with_suffix(f".{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=1))
+    tmp_file.replace(manifest_file)
+
+
+def convert_unit(unit):
+    """Convert one (subject, session, task) recording to BIDS.
+
+    Log messages are returned rather than written, so that the parent process can
+    write them in a deterministic order no matter how many workers are running.
+    """
+    subj = unit["subj"]
+    session = unit["session"]
+    full_subj = unit["full_subj"]
+    task_code = unit["task_code"]
+    raw_file = unit["raw_file"]
+    erm_file = unit["erm_file"]
+    task_name = tasks[task_code]
+    erm_msgs = list(unit["erm_msgs"])
+    result = dict(erm_log="", score_log="", df=None)
+    if unit["erm_corrupted"]:
+        result["erm_log"] = "".join(erm_msgs)
+        return result
+    this_bids_path = bids_path.copy().update(subject=subj, session=session)
+    labels = dict(subject=subj, session=session, task=task_code)
+    # load the data
+    print(f"Processing {subj}{session} {task_name} from {raw_file.parent} ...")
+    with stage("header-read", **labels):
+        raw = mne.io.read_raw_fif(raw_file, **read_raw_kw)
+    # get the prebads
+    subj_key = f"sub-{subj}"
+    sess_key = f"ses-{session}"
+    these_bads = prebads[subj_key][sess_key][task_name]
+    erm_bads = prebads[subj_key][sess_key]["ERM"]
+    # check for ERM / data file meas_date match
+    raw_meas_date = raw.info["meas_date"]
+    erm = None
+    if erm_file:
+        # load the (possibly experiment-specific) ERM
+        with stage("header-read-erm", **labels):
+            erm = mne.io.read_raw_fif(erm_file, **read_raw_kw)
+        erm_meas_date = erm.info["meas_date"]
+        if erm_meas_date.date() != raw_meas_date.date():
+            erm_msgs.append(
+                f"meas_date mismatch: {erm_file.name} "
+                f"({erm_meas_date.date()}) vs. {raw_file.name} "
+                f"({raw_meas_date.date()})\n"
+            )
+        # no data files have EEG, so expunge EEG channels from ERMs to avoid
+        # error in `maxwell_filter_prepare_emptyroom` when copying montage
+        if "eeg" in erm:
+            n_eeg = len(erm.get_channel_types(picks="eeg"))
+            erm_msgs.append(
+                f"montage mismatch: dropping {n_eeg} EEG channels from "
+                f"{erm_file.name}\n"
+            )
+            picks = list(set(erm.get_channel_types(unique=True)) - set(["eeg"]))
+            erm.pick(picks)
+    result["erm_log"] = "".join(erm_msgs)
+    # parse the events from the STIM channels
+    score_func = (
+        parse_mmn_events
+        if task_code == "mmn"
+        else custom_extract_expyfun_events
+    )
+    with stage("event-parse", **labels):
+        events, orig_events = score_func(
+            raw_file, offset=EVENT_OFFSETS[task_code], info=raw.info
+        )
+    if verify_events_against_tab_files:
+        # `find_matching_tabs` appends to a logfile, so give it a private one
+        with TemporaryDirectory() as tmpdir, stage("tab-match", **labels):
+            unit_score_log = Path(tmpdir) / score_log.name
+            unit_score_log.touch()
+            result["df"] = find_matching_tabs(
+                events, subj, session, task_code, raw_meas_date, logfile=unit_score_log
+            )
+            result["score_log"] = unit_score_log.read_text()
+    # fix dev_head_t if needed
+    refit_option = refit_options.get(raw_file.name, {})
+    if refit_option.get("refit", False):
+        # (shares the cache with check-dev-head-t.py, so usually no refitting happens)
+        with stage("refit", **labels):
+            refit_hpi_cached(raw_file, refit_option, info=raw.info, verbose=True)
+    # write the raw data in the BIDS folder tree
+    this_bids_path.update(task=task_name)
+    # (the wait for the lock is not part of the stage)
+    with shared_sidecar_lock(), stage("write-raw-bids", **labels):
+        if args.copy_free:
+            outcome = write_raw_bids_copy_free(
+                raw,
+                erm,
+                this_bids_path,
+                events=events,
+                event_id=event_mappings[task_code] | generic_events,
+                overwrite=True,
+            )
+            print(f"↳ {subj}{session} {task_name} FIF files: {outcome}")
+        else:
+            write_raw_bids(
+                raw=raw,
+                events=events,
+                event_id=event_mappings[task_code] | generic_events,
+                bids_path=this_bids_path,
+                empty_room=erm,
+                anonymize=dict(daysback=DAYSBACK),
+                overwrite=True,
+            )
+    # write the (surrogate) MRI in the BIDS derivatives tree. We need a raw file loaded
+    # in order to properly write the `trans` information, so this happens along with
+    # the first unit of each subject/session.
+    if unit["write_mri"]:
+        with stage("anat-export", **labels):
+            write_subject_anat(
+                subj, session, full_subj, task_code, raw.info, this_bids_path
+            )
+    with shared_sidecar_lock():
+        # write the bad channels
+        if these_bads:
+            mark_channels(
+                bids_path=this_bids_path,
+                ch_names=these_bads,
+                status="bad",
+                descriptions="prebad",
+            )
+        if erm_bads:
+            assert erm is not None
+            erm_path = this_bids_path.find_empty_room(use_sidecar_only=True)
+            mark_channels(
+                bids_path=erm_path,
+                ch_names=erm_bads,
+                status="bad",
+                descriptions="prebad",
+            )
+        # write the fine-cal and crosstalk files (once per subject/session)
+        cal_path = BIDSPath(root=bids_root, subject=subj, session=session)
+        write_meg_calibration(cal_dir / "sss_cal.dat", bids_path=cal_path)
+        write_meg_crosstalk(cal_dir / "ct_sparse.fif", bids_path=cal_path)
+    # print progress message to terminal
+    print(f"↳ {subj}{session} {task_name} completed with {len(events): >3} events")
+    return result
+
+
+def run_units(units, n_jobs):
+    """Convert the units (serially or on a process pool), yielding results in order."""
+    if n_jobs == 1:
+        yield from map(convert_unit, units)
+        return
+    # fork (not spawn) so that workers inherit the config above without re-running
+    # this script's top-level code
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        yield from pool.map(convert_unit, units)
+
+
+# classify raw files by "task" from the filenames, and plan one conversion unit per
+# (subject, session, task)
+units = list()
+anat_planned = set()
 unprocessed = sorted(subjects_to_process)
 for data_folder in sorted(orig_data.rglob("bad_*/raw_fif/")):
     # extract the subject ID
@@ -144,12 +530,11 @@ for data_folder in sorted(orig_data.rglob("bad_*/raw_fif/")):
     if subjects_to_process:
         if subj in unprocessed:
             unprocessed.remove(subj)
-    bids_path.update(subject=subj, session=session)
 
     # look for ERM files
     erm_files = list(data_folder.glob("*_erm_raw.fif"))
 
-    # classify the raw files by task, and write them to the BIDS folder
+    # classify the raw files by task
     for raw_file in sorted(data_folder.iterdir()):
         if raw_file.name in bad_files:
             continue
@@ -164,14 +549,7 @@ for data_folder in sorted(orig_data.rglob("bad_*/raw_fif/")):
                 continue
             if task_code not in ("am", "mmn"):  # not doing "ids" for now
                 continue
-            # load the data
-            print(f"Processing {subj}{session} {task_name} from {data_folder} ...")
-            raw = mne.io.read_raw_fif(raw_file, **read_raw_kw)
-            # get the prebads
-            subj_key = f"sub-{subj}"
-            sess_key = f"ses-{session}"
-            these_bads = prebads[subj_key][sess_key][task_name]
-            erm_bads = prebads[subj_key][sess_key]["ERM"]
+            erm_msgs = list()
             # check for experiment-specific ERM file
             task_specific_erm = list(filter(lambda f: task_code in f.name, erm_files))
             assert len(task_specific_erm) in (0, 1)
@@ -183,180 +561,56 @@ for data_folder in sorted(orig_data.rglob("bad_*/raw_fif/")):
                 assert erm_file in erm_files, erm_files
             # no ERM file found
             else:
-                with open(erm_log, "a") as fid:
-                    fid.write(f"No ERM file found for {full_subj} {task_code}\n")
+                erm_msgs.append(f"No ERM file found for {full_subj} {task_code}\n")
                 erm_file = None
-                erm = None
-            # check for ERM / data file meas_date match
-            raw_meas_date = raw.info["meas_date"]
-            if erm_file:
-                # make sure we're not hit by a bad file
-                if erm_file.name in bad_files:
-                    with open(erm_log, "a") as fid:
-                        fid.write(
-                            f"ERM file found for {full_subj} {task_code}, "
-                            f"but the file ({erm_file.name}) is corrupted\n"
-                        )
-                    break
-                # load the (possibly experiment-specific) ERM
-                erm = mne.io.read_raw_fif(erm_file, **read_raw_kw)
-                erm_meas_date = erm.info["meas_date"]
-                if erm_meas_date.date() != raw_meas_date.date():
-                    with open(erm_log, "a") as fid:
-                        msg = (
-                            f"meas_date mismatch: {erm_file.name} "
-                            f"({erm_meas_date.date()}) vs. {raw_file.name} "
-                            f"({raw_meas_date.date()})\n"
-                        )
-                        fid.write(msg)
-                # no data files have EEG, so expunge EEG channels from ERMs to avoid
-                # error in `maxwell_filter_prepare_emptyroom` when copying montage
-                if "eeg" in erm:
-                    n_eeg = len(erm.get_channel_types(picks="eeg"))
-                    with open(erm_log, "a") as fid:
-                        msg = (
-                            f"montage mismatch: dropping {n_eeg} EEG channels from "
-                            f"{erm_file.name}\n"
-                        )
-                        fid.write(msg)
-                    picks = list(set(erm.get_channel_types(unique=True)) - set(["eeg"]))
-                    erm.pick(picks)
-            # parse the events from the STIM channels
-            score_func = (
-                parse_mmn_events
-                if task_code == "mmn"
-                else custom_extract_expyfun_events
-            )
-            events, orig_events = score_func(raw_file, offset=EVENT_OFFSETS[task_code])
-            if verify_events_against_tab_files:
-                this_df = find_matching_tabs(
-                    events, subj, session, task_code, raw_meas_date, logfile=score_log
+            # make sure we're not hit by a bad file
+            erm_corrupted = erm_file is not None and erm_file.name in bad_files
+            if erm_corrupted:
+                erm_msgs.append(
+                    f"ERM file found for {full_subj} {task_code}, "
+                    f"but the file ({erm_file.name}) is corrupted\n"
                 )
-                if df is None:
-                    df = this_df
-                else:
-                    df = pd.concat((df, this_df), axis="index", ignore_index=True)
-            # fix dev_head_t if needed
-            refit_option = refit_options.get(raw_file.name, {}).copy()
-            if refit_option.pop("refit", False):
-                kwargs = dict(locs=False, amplitudes=False, dist_limit=0.01, colinearity_limit=0.01, verbose=True)
-                kwargs.update(refit_option)
-                mne.chpi.refit_hpi(raw.info, **kwargs)
-            # write the raw data in the BIDS folder tree
-            bids_path.update(task=task_name)
-            write_raw_bids(
-                raw=raw,
-                events=events,
-                event_id=event_mappings[task_code] | generic_events,
-                bids_path=bids_path,
-                empty_room=erm,
-                anonymize=dict(daysback=DAYSBACK),
-                overwrite=True,
-            )
-            # write the (surrogate) MRI in the BIDS derivatives tree. Since we have
-            # separate MRIs for different sessions (they're months apart, and these are
-            # infants), we need to rename the subject folder (and some of the files) to
-            # use a compound "subject" name like `sub-XXX_ses-Y`
+            # we write MRI data once per subj/session, with the first unit that
+            # actually gets written
             anat_to_write = (subj, session)
-            compound_subj_name = f"sub-{subj}_ses-{session}"
-            if last_anat_written != anat_to_write:
-                # update our signal variable
-                last_anat_written = anat_to_write
-
-                anat_path = (
-                    bids_root
-                    / "derivatives"
-                    / "freesurfer"
-                    / "subjects"
-                    / compound_subj_name
-                )
-                # handle cases where one task was done on a different day
-                if len(full_subj.split("_")) > 2:
-                    compound_subj_name = f"{compound_subj_name}_task-{task_code}"
-                    anat_path = anat_path.with_name(compound_subj_name)
-                    anat_to_write = (*anat_to_write, task_code)
-                for dirpath, dirnames, filenames in (mri_dir / full_subj).walk():
-                    for dirname in dirnames:
-                        # adjust "subject" name when it's the foldername
-                        dirname_out = dirname.replace(full_subj, compound_subj_name)
-                        (anat_path / dirname_out).mkdir(parents=True, exist_ok=True)
-                    for fname in filenames:
-                        # adjust "subject" name when it's incorporated into filenames
-                        # (e.g. for the trans- and BEM files)
-                        fname_out = fname.replace(full_subj, compound_subj_name)
-                        target = (
-                            anat_path
-                            / dirpath.relative_to(mri_dir / full_subj)
-                            / fname_out
-                        )
-                        hardlink(source=dirpath / fname, target=target, dry_run=False)
-                # now use MNE-BIDS to (re)write the T1, so we can get the side
-                # effect of converting the trans file to a JSON sidecar
-                t1_fname = mri_dir / full_subj / "mri" / "T1.mgz"
-                trans = mne.read_trans(anat_path / f"{compound_subj_name}_trans.fif")
-                landmarks = get_anat_landmarks(
-                    image=t1_fname,
-                    info=raw.info,
-                    trans=trans,
-                    fs_subject=compound_subj_name,
-                    fs_subjects_dir=anat_path.parent,
-                )
-                mri_path = BIDSPath(root=bids_root, subject=subj, session=session)
-                nii_file = write_anat(
-                    image=t1_fname,
-                    bids_path=mri_path,
-                    landmarks=landmarks,
-                    overwrite=overwrite,
-                )
-                # make sure our written trans is identical to numerical precision
-                trans_bids = get_head_mri_trans(
-                    bids_path,
-                    t1_bids_path=nii_file,
-                    fs_subject=compound_subj_name,
-                    fs_subjects_dir=anat_path.parent,
+            write_mri = not erm_corrupted and anat_to_write not in anat_planned
+            if write_mri:
+                anat_planned.add(anat_to_write)
+            units.append(
+                dict(
+                    subj=subj,
+                    session=session,
+                    full_subj=full_subj,
+                    task_code=task_code,
+                    raw_file=raw_file,
+                    erm_file=erm_file,
+                    erm_corrupted=erm_corrupted,
+                    erm_msgs=erm_msgs,
+                    write_mri=write_mri,
                 )
-                assert trans["to"] == trans_bids["to"]
-                assert trans["from"] == trans_bids["from"]
-                np.testing.assert_allclose(
-                    trans["trans"], trans_bids["trans"], atol=1e-6,
-                )
-                # make a copy of the source space using the filename that
-                # MNE-BIDS-Pipeline prefers and the subject_his_id set correctly
-                # (otherwise forward modeling reasonably complains)
-                src_in = anat_path / "bem" / f"{compound_subj_name}-oct-6-src.fif"
-                src_out = anat_path / "bem" / f"{compound_subj_name}-oct6-src.fif"
-                assert src_in.is_file()
-                assert not src_out.is_file()
-                src = mne.read_source_spaces(src_in)
-                for s in src:
-                    s["subject_his_id"] = compound_subj_name
-                mne.write_source_spaces(src_out, src, overwrite=True)
-
-            # write the bad channels
-            if these_bads:
-                mark_channels(
-                    bids_path=bids_path,
-                    ch_names=these_bads,
-                    status="bad",
-                    descriptions="prebad",
-                )
-            if erm_bads:
-                assert erm is not None
-                erm_path = bids_path.find_empty_room(use_sidecar_only=True)
-                mark_channels(
-                    bids_path=erm_path,
-                    ch_names=erm_bads,
-                    status="bad",
-                    descriptions="prebad",
-                )
-            # write the fine-cal and crosstalk files (once per subject/session)
-            cal_path = BIDSPath(root=bids_root, subject=subj, session=session)
-            write_meg_calibration(cal_dir / "sss_cal.dat", bids_path=cal_path)
-            write_meg_crosstalk(cal_dir / "ct_sparse.fif", bids_path=cal_path)
-            # print progress message to terminal
-            print(f"↳ completed with {len(events): >3} events")
+            )
+            if erm_corrupted:
+                break
 if unprocessed:
     raise RuntimeError(f"Some subjects were not processed: {unprocessed}")
 
+# refresh the TAB file index once, up front, so the workers can share it
+if verify_events_against_tab_files:
+    get_tab_catalog()
+
+# run the conversions. Logs and the FIF-to-TAB match table are gathered here (in unit
+# order) so the output doesn't depend on `--jobs`
+df = None
+for result in run_units(units, n_jobs=n_jobs):
+    for log, text in ((erm_log, result["erm_log"]), (score_log, result["score_log"])):
+        if text and log in logs:
+            with open(log, "a") as fid:
+                fid.write(text)
+    if result["df"] is not None:
+        if df is None:
+            df = result["df"]
+        else:
+            df = pd.concat((df, result["df"]), axis="index", ignore_index=True)
+
 if verify_events_against_tab_files and not subjects_to_process:
     df.to_csv(outdir / "log-of-fif-to-tab-matches.csv")
@@ -1,6 +1,4 @@
 import argparse
-import re
-from collections import defaultdict
 from contextlib import redirect_stdout
 from functools import partial
 from io import StringIO
@@ -8,17 +6,23 @@ from pathlib import Path
 from shutil import copyfileobj
 
 import pandas as pd
-from mne.io import read_info
+import yaml
+
+from inventory import KINDS, build_inventory, inventory_path, presence_table
+from utils import root
 
 # arg parsing
 parser = argparse.ArgumentParser(prog="")
 parser.add_argument("datadir", choices=("combined", "server", "local", "erm"))
+parser.add_argument(
+    "--jobs", "-j", type=int, default=1, help="Number of FIF headers to read in parallel"
+)
 args = parser.parse_args()
 
 # where to look for the data
 paths = dict(combined="data", server="server-data", local="local-data", erm="data")
 which_data = paths[args.datadir]
-root = Path("/storage/badbaby-redux").resolve() / which_data
+data_dir = root / which_data
 
 # where to write logs etc.
 outdir = Path("qc").resolve()  # where summary files will be written
@@ -28,70 +32,51 @@ errfile = StringIO()
 add_to_log = redirect_stdout(logfile)
 add_to_err = redirect_stdout(errfile)
 
-# get subject IDs
-subj_dirs = sorted(root.glob("bad*"))
-subj_ids = [x.name.lstrip("bad_") for x in subj_dirs]
-# what kinds of data files do we expect?
-expected_files = {
-    "mmn_raw.fif": [],
-    "am_raw.fif": [],
-    "ids_raw.fif": [],
-    "erm_raw.fif": [],
-}
-pattern = rf"bad_\d{{3}}[ab]?_.*({'|'.join(expected_files)})$"
-# loop over subject folders, and tally which of the expected file types we find
-for _dir in subj_dirs:
-    df_row = defaultdict(lambda: False)
-    # handle the one bad folder name in local data
-    subdir = "raw_fif" if (_dir / "raw_fif").is_dir() else "151007"
-    for _fname in (_dir / subdir).iterdir():
-        for _kind in expected_files:
-            df_row[_kind] |= _fname.name.endswith(_kind)
-        # special case: this one we name `raw2` on purpose
-        if not re.match(pattern, _fname.name):
-            with add_to_err:
-                print(f"unexpected file: {_fname}")
-    for _kind, value in df_row.items():
-        expected_files[_kind].append(value)
-# aggregate results into a dataframe
-result = pd.DataFrame(data=expected_files, index=subj_ids)
-result.columns = [re.split(r"_|\.", x)[0] for x in result.columns]
-
-# get meas_dates to ensure we have ERMs on the correct days
-dates_df = pd.DataFrame([], columns=result.columns)
-for tup in result.itertuples():
-    _fpath = root / f"bad_{tup.Index}" / "raw_fif"
-    for kind in dates_df.columns:
-        if getattr(tup, kind):  # skip if file not available
-            _fname = f"bad_{tup.Index}_{kind}_raw.fif"
-            info = read_info(_fpath / _fname, verbose=False)
-            dates_df.loc[tup.Index, kind] = info["meas_date"].date()
-
-# get date mismatches between experimental runs and ERMs
-matches_df = pd.DataFrame(
-    {
-        col: dates_df[col].eq(dates_df["erm"])
-        for col in dates_df.drop(columns="erm").columns
-    }
+# surrogate ERMs linked by an earlier `link-surrogate-erms.py` run aren't part of the
+# combined data yet (i.e., only the files that `make-hardlinks.py` put there are)
+surrogates = list()
+if args.datadir == "combined":
+    hardlinked = set()
+    for fname in ("files-from-local.yaml", "files-from-server.yaml"):
+        with open(fname, "r") as fid:
+            hardlinked.update(yaml.load(fid, Loader=yaml.SafeLoader).values())
+    surrogates = [
+        fname
+        for fname in data_dir.glob("bad_*/raw_fif/*erm_raw.fif")
+        if str(fname) not in hardlinked
+    ]
+
+# scan the data folder (one row per file), and save the inventory
+inventory = build_inventory(data_dir, n_jobs=args.jobs, exclude=surrogates)
+# (after linking ERMs, don't clobber the tables that the ERM search was based on)
+csv_suffix = "-after-linking-erms" if args.datadir == "erm" else ""
+inventory.to_parquet(inventory_path(which_data, csv_suffix), index=False)
+with add_to_err:
+    for fname in inventory.loc[~inventory["expected"], "path"]:
+        print(f"unexpected file: {fname}")
+
+# tally which of the expected file types each subject folder has
+result = presence_table(inventory)
+
+# save the dates of experimental runs without a same-day ERM. Also captures exp files
+# where ERM is missing entirely.
+erm_mismatches = inventory.loc[inventory["erm_match"].eq(False)].sort_values(
+    "task", key=lambda task: task.map(KINDS.index), kind="stable"
+)
+erm_mismatches = pd.DataFrame(
+    dict(
+        subj=erm_mismatches["subject"],
+        exp=erm_mismatches["task"],
+        date=erm_mismatches["meas_date"].dt.date,
+    )
+).sort_values("subj", kind="stable")
+erm_mismatches.to_csv(
+    outdir / f"erm-missing-from-{which_data}{csv_suffix}.csv", index=False
 )
-# save the dates of mismatches. Also captures exp files where ERM is missing entirely.
-erm_mismatches = list()
-for subj in matches_df.index:
-    for exp in matches_df.columns:
-        exp_date = dates_df.loc[subj, exp]
-        erm_date = dates_df.loc[subj, "erm"]
-        if (
-            ~matches_df.loc[subj, exp]
-            and not pd.isna(exp_date)  # no experimental recording for that subj
-        ):
-            this_row = dict(subj=subj, exp=exp, date=exp_date)
-            erm_mismatches.append(pd.DataFrame(this_row, index=[0]))
-erm_mismatches = pd.concat(erm_mismatches, ignore_index=True)
-erm_mismatches.to_csv(outdir / f"erm-missing-from-{which_data}.csv", index=False)
 
 # print some summary output
 total = f"Total sessions: {result.shape[0]}"
-table = result.sum().to_frame().T.to_string(index=False)
+table = result[KINDS].sum().to_frame().T.to_string(index=False)
 line = "-" * max(len(total), len(table.split("\n")[0]))
 
 with add_to_log:
@@ -102,17 +87,12 @@ with add_to_log:
     print(line)
     print()
 
-# split subj and session identifiers
-result["subj"] = result.index.str.slice(0, 3).astype(int)
-session = result.index.str.slice(3)  # may be "" for some subj-sessions
-# fill in session "c" for missing session IDs (timepoints not strictly at 2mo or 6mo)
-result["session"] = session.where(cond=session.astype(bool), other="c")
 result.reset_index(drop=True, inplace=True)
 # save dataframe to disk now, while data is still in "raw" (unaggregated) form
-result.to_csv(outdir / f"files-in-{which_data}.csv")
+result.to_csv(outdir / f"files-in-{which_data}{csv_suffix}.csv")
 
 # remap the boolean column values to session codes "a" or "b" or "c"
-columns = ["mmn", "am", "ids", "erm"]
+columns = list(KINDS)
 for column in columns:
     result[column] = result["session"].where(cond=result[column], other="")
 # aggregate to show which subjs/conds have data from both sessions
@@ -1,31 +1,144 @@
 """Check dev_head_t for badbaby data.
 
-After running this function, prep-dataset/dev-head-t-report.html will be created.
-Manually inspect this file, and decide which refits should actually be used during
-bidsify.py. Set ``refit: True`` for those subjects in prep-dataset/refit-options.yml.
+After running this function, prep-dataset/qc/dev-head-t.csv will list, for every file,
+the HPI coil order, how far a refit moves the dev_head_t, and how far the dev_head_t is
+from identity (plus which of those exceed the thresholds). With ``--render``,
+prep-dataset/dev-head-t-report.html will also be created, with the sensor alignment
+(before and after refitting) of the flagged files (or just the files named after
+``--render``). Manually inspect these, and decide which refits should actually be used
+during bidsify.py. Set ``refit: True`` for those subjects in
+prep-dataset/refit-options.yml.
+
+Refits run in parallel with ``--jobs N`` and are cached per file (and per set of
+refit options), so after tweaking refit-options.yml only the affected files are refit.
+Files are added to the report in batches; an interrupted run picks up where it left
+off (use ``--restart`` to rewrite every report entry).
 """
 
-from pathlib import Path
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import mne
+import pandas as pd
 import yaml
-from utils import tasks
+from utils import (
+    file_key,
+    read_info_cached,
+    refit_hpi_cached,
+    refit_kwargs,
+    root,
+    stage,
+    tasks,
+)
+
+parser = argparse.ArgumentParser(description="Check dev_head_t for badbaby data")
+parser.add_argument(
+    "--jobs", "-j", type=int, default=1, help="Number of files to refit in parallel"
+)
+parser.add_argument(
+    "--render",
+    nargs="*",
+    metavar="FILE",
+    help="Plot the alignment of the flagged files (or of the given files) in the report",
+)
+parser.add_argument(
+    "--max-refit-delta",
+    nargs=2,
+    type=float,
+    default=(20, 15),
+    metavar=("DEG", "MM"),
+    help="Flag refits that move the dev_head_t more than this",
+)
+parser.add_argument(
+    "--max-identity-delta",
+    nargs=3,
+    type=float,
+    default=(65, 20, 120),
+    metavar=("DEG", "MIN_MM", "MAX_MM"),
+    help="Flag dev_head_t farther than this from identity (or too close to it)",
+)
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=20,
+    help="Number of files to add to the report between saves",
+)
+parser.add_argument(
+    "--restart", action="store_true", help="Rewrite report entries already written"
+)
+args = parser.parse_args()
 
-root = Path("/storage/badbaby-redux").resolve()
 orig_data = root / "data"
 outdir = root / "prep-dataset" / "qc"
 with open(outdir.parent / "bad-files.yaml", "r") as fid:
     bad_files = yaml.load(fid, Loader=yaml.SafeLoader)
 with open(outdir.parent / "refit-options.yml", "r") as fid:
     refit_options = yaml.load(fid, Loader=yaml.SafeLoader)
+table_file = outdir / "dev-head-t.csv"
 report_file = outdir / "dev-head-t-report.h5"
+# which files are already in the report (and for which refit)
+progress_file = report_file.with_suffix(".progress.json")
 subjects_dir = root / "anat"
 check_runs = set()  # "bad_317a_mmn_raw.fif".split())
 
+
+def refit_unit(unit):
+    """Refit the dev_head_t of one file (via the on-disk cache shared with bidsify)."""
+    labels = dict(subject=unit["subj"], session=unit["session"], task=unit["task"])
+    try:
+        with stage("refit", **labels):
+            return refit_hpi_cached(
+                unit["raw_file"], unit["refit_option"], verbose=unit["verbose"]
+            )
+    except Exception:
+        print(f"Refit failed for {unit['raw_file'].name} with {unit['refit_option']=}:")
+        raise
+
+
+def run_units(func, units, n_jobs):
+    """Process the units (serially or on a process pool), yielding results in order."""
+    if n_jobs == 1:
+        yield from map(func, units)
+        return
+    # fork (not spawn) so that workers inherit the config above without re-running
+    # this script's top-level code
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        yield from pool.map(func, units)
+
+
+def alignment_figures(entry):
+    """Plot the sensor alignment before and after the refit."""
+    subject, task = entry["subject"], entry["task"]
+    figs = list()
+    try:
+        trans = mne.read_trans(
+            subjects_dir / f"{subject}_{task}" / f"{subject}_{task}_trans.fif"
+        )
+    # ...if it doesn't exist, the non-task-specific is the correct one
+    except FileNotFoundError:
+        trans = mne.read_trans(subjects_dir / subject / f"{subject}_trans.fif")
+        plot_subject = subject
+    else:
+        plot_subject = f"{subject}_{task}"
+    for this_info in (entry["info"], entry["new_info"]):
+        fig = mne.viz.create_3d_figure(bgcolor="w", size=(800, 800))
+        mne.viz.plot_alignment(this_info, trans, subject=plot_subject, subjects_dir=subjects_dir, coord_frame="meg", fig=fig, dig=True)
+        figs.append(fig)
+    return figs
+
+
 data_folders = sorted(orig_data.rglob("bad_*/raw_fif/"))
 all_files = set(sum((list(file.name for file in data_folder.iterdir()) for data_folder in data_folders), []))
 missing = set(refit_options) - set(all_files)
 assert missing == set(), f"refit-options.yml has subjects not in all_files: {missing}"
+
+# plan one refit per file (and note HPI coil order mismatches along the way)
+units = list()
 for data_folder in data_folders:
     # extract the subject ID
     subject = data_folder.parts[-2]
@@ -39,7 +152,6 @@ for data_folder in data_folders:
     # BIDS requires subj to be a string, but cast to int as a failsafe first
     subj = str(int(subj[:3]))
     erm_files = list(data_folder.glob("*_erm_raw.fif"))
-    nl = "\n"
     last_order = None
     for raw_file in sorted(data_folder.iterdir()):
         if raw_file.name in bad_files:
@@ -58,7 +170,7 @@ for data_folder in data_folders:
         task = task[0]
         refit_option = refit_options.get(raw_file.name, {}).copy()
         refit_option.pop("refit", None)  # remove 'refit' key if present
-        info = mne.io.read_info(raw_file)
+        info = read_info_cached(raw_file)
         why = list()
         assert len(info["hpi_results"]) == 1
         this_order = info["hpi_results"][-1]["order"]
@@ -67,64 +179,129 @@ for data_folder in data_folders:
         # N.B: A lot of these will be false alarms b/c Neuromag software doesn't seem
         # to reliably choose the order of the 2 coils that were not used for fitting
         # the dev_head_t, so two of the five can swap somewhat often
-        if not np.array_equal(this_order, last_order):
+        order_mismatch = not np.array_equal(this_order, last_order)
+        if order_mismatch:
             why.append(f"order mismatch  {this_order} != {last_order}")
-            print(f"{nl}{raw_file.name.ljust(30)} {why[-1]}")
-            nl = ""
         verbose = raw_file.name in check_runs
         if verbose:
             print(raw_file.name)
-        kwargs = dict(locs=False, amplitudes=False, dist_limit=0.01, colinearity_limit=0.01, verbose=verbose)
-        kwargs.update(refit_option)
-        try:
-            new_info = mne.chpi.refit_hpi(info.copy(), **kwargs)
-        except Exception:
-            print(f"Refit failed for {raw_file.name} with {refit_option=}:")
-            raise
-        ang_d, dist_d = mne.transforms.angle_distance_between_rigid(
-            info["dev_head_t"]["trans"],
-            new_info["dev_head_t"]["trans"],
-            angle_units="deg",
-            distance_units="mm",
+        units.append(
+            dict(
+                raw_file=raw_file,
+                subject=subject,
+                subj=subj,
+                session=session,
+                task=task,
+                refit_option=refit_option,
+                info=info,
+                order=this_order,
+                order_mismatch=order_mismatch,
+                why=why,
+                verbose=verbose,
+            )
         )
-        print_name = raw_file.name.ljust(30)
-        if ang_d > 20 or dist_d > 15:  # 20 deg or 1.5 cm
-            why.append(f"refit delta      {ang_d:5.1f}° {dist_d:5.1f} mm")
-            print(f"{nl}{print_name} {why[-1]}")
-            nl = ""
-        ang_i, dist_i = mne.transforms.angle_distance_between_rigid(
-            info["dev_head_t"]["trans"], angle_units="deg", distance_units="mm"
-        )
-        if ang_i > 65 or dist_i < 20 or dist_i > 120:
-            why.append(f"identity delta   {ang_i:5.1f}° {dist_i:5.1f} mm")
-            print(f"{nl}{print_name} {why[-1]}")
-            nl = ""
-        if why:
-            if verbose:
+
+# refit, then compare all the transforms at once
+refits = list(run_units(refit_unit, units, n_jobs=args.jobs))
+new_dev_head_ts = [refit["dev_head_t"] for refit in refits]
+dev_head_t = np.array([unit["info"]["dev_head_t"]["trans"] for unit in units])
+new_dev_head_t = np.array([trans["trans"] for trans in new_dev_head_ts])
+dev_head_t, new_dev_head_t = dev_head_t.reshape(-1, 4, 4), new_dev_head_t.reshape(-1, 4, 4)
+ang_d, dist_d = mne.transforms.angle_distance_between_rigid(
+    dev_head_t, new_dev_head_t, angle_units="deg", distance_units="mm"
+)
+ang_i, dist_i = mne.transforms.angle_distance_between_rigid(
+    dev_head_t, angle_units="deg", distance_units="mm"
+)
+max_ang_d, max_dist_d = args.max_refit_delta
+max_ang_i, min_dist_i, max_dist_i = args.max_identity_delta
+table = pd.DataFrame(
+    dict(
+        file=[unit["raw_file"].name for unit in units],
+        subject=[unit["subject"] for unit in units],
+        task=[unit["task"] for unit in units],
+        order=[" ".join(map(str, unit["order"])) for unit in units],
+        order_mismatch=[unit["order_mismatch"] for unit in units],
+        refit_angle=ang_d,
+        refit_distance=dist_d,
+        identity_angle=ang_i,
+        identity_distance=dist_i,
+        # worst goodness of fit of the coils used for the refit (numbered from 1)
+        refit_goodness=[
+            refit["hpi_results"][-1]["goodness"][refit["hpi_results"][-1]["used"] - 1].min()
+            for refit in refits
+        ],
+        refit=[refit_options.get(unit["raw_file"].name, {}).get("refit", False) for unit in units],
+    )
+)
+# N.B.: "order mismatch" flags are often false alarms (see above)
+table["refit_delta"] = (table["refit_angle"] > max_ang_d) | (table["refit_distance"] > max_dist_d)
+table["identity_delta"] = (
+    (table["identity_angle"] > max_ang_i)
+    | (table["identity_distance"] < min_dist_i)
+    | (table["identity_distance"] > max_dist_i)
+)
+table["flagged"] = table[["order_mismatch", "refit_delta", "identity_delta"]].any(axis=1)
+table.round(2).to_csv(table_file, index=False)
+
+# summarize the flagged files
+last_subject = None
+for unit, row in zip(units, table.itertuples()):
+    if row.subject != last_subject:
+        nl = "\n"
+        last_subject = row.subject
+    why = list(unit["why"])
+    if row.refit_delta:
+        why.append(f"refit delta      {row.refit_angle:5.1f}° {row.refit_distance:5.1f} mm")
+    if row.identity_delta:
+        why.append(f"identity delta   {row.identity_angle:5.1f}° {row.identity_distance:5.1f} mm")
+    for line in why:
+        print(f"{nl}{row.file.ljust(30)} {line}")
+        nl = ""
+    unit["why"] = why
+print(f"\n{table['flagged'].sum()} of {len(table)} files flagged; see {table_file}")
+if args.render is None:
+    raise SystemExit
+
+# plot the alignment of the selected files (before and after the refit) in the report,
+# a batch at a time, skipping the ones already there from a previous run
+missing = set(args.render) - set(table["file"])
+assert missing == set(), f"--render got files that weren't checked: {missing}"
+selected = table["file"].isin(args.render) if args.render else table["flagged"]
+to_render = list()
+for unit, new_trans, is_selected in zip(units, new_dev_head_ts, selected):
+    if not is_selected:
+        continue
+    new_info = unit["info"].copy()
+    new_info["dev_head_t"] = new_trans
+    # identify the report entry by what went into it
+    key = json.dumps([list(file_key(unit["raw_file"])), refit_kwargs(unit["refit_option"]), unit["why"]])
+    key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    print_name = unit["raw_file"].name.ljust(30)
+    to_render.append(unit | dict(new_info=new_info, print_name=print_name, key=key))
+done = dict()
+if progress_file.is_file() and report_file.is_file() and not args.restart:
+    done = json.loads(progress_file.read_text())
+todo = [entry for entry in to_render if done.get(entry["raw_file"].name) != entry["key"]]
+print(f"{len(to_render)} files selected; adding {len(todo)} to the report")
+for start in range(0, len(todo), args.batch_size):
+    batch = todo[start : start + args.batch_size]
+    with mne.report.open_report(report_file, title="check-dev-head-t report") as report:
+        for entry in batch:
+            if entry["verbose"]:
                 input("Press Enter to continue...")
             # Generate report figures
-            figs = list()
-            try:
-                trans = mne.read_trans(
-                    subjects_dir / f"{subject}_{task}" / f"{subject}_{task}_trans.fif"
-                )
-            # ...if it doesn't exist, the non-task-specific is the correct one
-            except FileNotFoundError:
-                trans = mne.read_trans(subjects_dir / subject / f"{subject}_trans.fif")
-                plot_subject = subject
-            else:
-                plot_subject = f"{subject}_{task}"
-            for this_info in (info, new_info):
-                fig = mne.viz.create_3d_figure(bgcolor="w", size=(800, 800))
-                mne.viz.plot_alignment(this_info, trans, subject=plot_subject, subjects_dir=subjects_dir, coord_frame="meg", fig=fig, dig=True)
-                figs.append(fig)
-            with mne.report.open_report(report_file, title="check-dev-head-t report") as report:
-                report.add_html(
-                    "<br>".join(why), title=f"{print_name} info", section=subject, replace=True,
-                )
-                report.add_figure(
-                    figs, title=f"{print_name} alignment", section=subject, replace=True,
-                )
-                report.save(report_file.with_suffix(".html"), overwrite=True, open_browser=False)
+            figs = alignment_figures(entry)
+            report.add_html(
+                "<br>".join(entry["why"]), title=f"{entry['print_name']} info", section=entry["subject"], replace=True,
+            )
+            report.add_figure(
+                figs, title=f"{entry['print_name']} alignment", section=entry["subject"], replace=True,
+            )
             for fig in figs:
                 mne.viz.close_3d_figure(fig)
+        report.save(report_file.with_suffix(".html"), overwrite=True, open_browser=False)
+    done.update({entry["raw_file"].name: entry["key"] for entry in batch})
+    tmp_file = progress_file.with_suffix(f".{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(done, indent=1, sort_keys=True))
+    tmp_file.replace(progress_file)
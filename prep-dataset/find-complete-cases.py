@@ -1,6 +1,6 @@
-import pandas as pd
+from inventory import read_presence_table
 
-df = pd.read_csv("qc/files-in-data.csv", header=0, index_col=0)
+df = read_presence_table("data")
 
 complete_cases = (
     df.drop(columns=["ids", "erm"])
@@ -0,0 +1,78 @@
+"""Find FIF files with identical content in the rsync'd source trees.
+
+Writes ``qc/fif-duplicates.csv`` (groups of files with identical content) and
+``qc/fif-name-conflicts.csv`` (files that share a name but differ in content).
+`select-files-from-server.py` uses the former to skip redundant copies.
+
+Only files whose size matches some other file's size can be duplicates, so only those
+get hashed. Hashes are cached by path/inode/size/mtime, so re-running after an rsync
+only hashes new or changed files.
+"""
+
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from utils import root, sha256
+
+parser = argparse.ArgumentParser(description="Find duplicate FIF files by content")
+parser.add_argument(
+    "--jobs", "-j", type=int, default=1, help="Number of files to hash in parallel"
+)
+args = parser.parse_args()
+
+# path stuff
+trees = ("local-data", "server-data")
+outdir = Path("qc").resolve()
+outdir.mkdir(exist_ok=True)
+
+
+def hash_files(fnames, n_jobs):
+    """Hash the files (serially or on a process pool), in order."""
+    if n_jobs == 1:
+        return list(map(sha256, fnames))
+    # fork (not spawn) so that workers don't re-run this script's top-level code
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        return list(pool.map(sha256, fnames, chunksize=4))
+
+
+# catalog every FIF file in both trees
+df = pd.DataFrame(
+    dict(path=sorted(fname for tree in trees for fname in (root / tree).rglob("*.fif")))
+)
+df["name"] = df["path"].map(lambda path: path.name)
+df["size"] = df["path"].map(lambda path: path.stat().st_size)
+# only hash files that could have a duplicate
+needs_hash = df["size"].duplicated(keep=False)
+print(f"{len(df)} FIF files; hashing {needs_hash.sum()} that share their size")
+df["sha256"] = pd.Series(
+    hash_files(df.loc[needs_hash, "path"].tolist(), n_jobs=args.jobs),
+    index=df.index[needs_hash],
+    dtype=object,
+)
+# files with a unique size have unique content; give them a unique ID
+df["content"] = df["sha256"].fillna(df["path"].map(str))
+df["path"] = df["path"].map(lambda path: str(path.relative_to(root)))
+
+# groups of identical files
+dups = df.loc[df["content"].duplicated(keep=False)].copy()
+dups["group"] = dups.groupby("content", sort=False).ngroup()
+dups = dups.sort_values(["group", "path"])
+dups[["group", "sha256", "size", "path"]].to_csv(
+    outdir / "fif-duplicates.csv", index=False
+)
+
+# same name, different content
+n_contents = df.groupby("name")["content"].transform("nunique")
+conflicts = df.loc[n_contents > 1].sort_values(["name", "path"])
+conflicts[["name", "sha256", "size", "path"]].to_csv(
+    outdir / "fif-name-conflicts.csv", index=False
+)
+
+n_groups = dups["group"].nunique()
+print(f"{len(dups)} files in {n_groups} groups of identical files")
+print(f"{conflicts['name'].nunique()} names shared by files with different content")
@@ -1,28 +1,126 @@
+import argparse
 import re
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
 from contextlib import redirect_stdout
-from datetime import date
+from datetime import date, timedelta
 from io import StringIO
 from pathlib import Path
 from shutil import copyfileobj
+from warnings import filterwarnings
 
+import mne
 import numpy as np
 import pandas as pd
-from mne.io import read_info
 from mne.utils import set_log_level
+from scipy.signal import welch
+import yaml
+
+from score import read_stim_data
+from utils import cached, read_info_cached, root
+
+parser = argparse.ArgumentParser(description="Find surrogate ERMs where we lack one")
+parser.add_argument(
+    "--spectral",
+    action="store_true",
+    help="Rank the ERMs within the date threshold by spectral similarity too",
+)
+args = parser.parse_args()
 
 # config
 set_log_level("WARNING")
 erm_days_threshold = 2  # if no same-day ERM, how many days before/after to look?
+# spectral ranking (with `--spectral`)
+psd_band = (1.0, 45.0)  # Hz (we analyze 0.5-40 Hz)
+psd_seg_seconds = 2.0  # Welch segment length (0.5 Hz resolution)
+psd_chunk_seconds = 60.0  # how much data to read at a time
+min_prestim_seconds = 10.0  # else use the whole recording
+days_weight = 1.0  # score penalty (dB of spectral distance) per day from recording
+# suppress messages about IAS / MaxShield
+filterwarnings(
+    action="ignore",
+    message="This file contains raw Internal Active Shielding data",
+    category=RuntimeWarning,
+    module="mne",
+)
 
 
 def get_meas_date(filepath):
-    info = read_info(filepath)
+    info = read_info_cached(filepath)
     return info["meas_date"].date()
 
 
+def streamed_psd(fname, stop=None):
+    """Compute a Welch PSD, reading ``psd_chunk_seconds`` of data at a time.
+
+    Returns the median (across channels) of the log10 PSD of each MEG channel type, in
+    ``psd_band``.
+    """
+    raw = mne.io.read_raw_fif(fname, allow_maxshield=True, preload=False)
+    sfreq = raw.info["sfreq"]
+    picks = mne.pick_types(raw.info, meg=True, exclude="bads")
+    ch_types = np.array(raw.get_channel_types(picks=picks))
+    n_per_seg = int(round(psd_seg_seconds * sfreq))
+    step = n_per_seg // 2  # 50% overlap
+    n_chunk = step * max(int(round(psd_chunk_seconds * sfreq)) // step, 2)
+    stop = raw.n_times if stop is None else min(stop, raw.n_times)
+    psd_sum = n_segs = 0
+    # chunks overlap by `step`, so that no segment is lost at chunk boundaries
+    for start in range(0, max(stop - step, 1), n_chunk - step):
+        data = raw.get_data(picks=picks, start=start, stop=min(start + n_chunk, stop))
+        if data.shape[1] < n_per_seg:
+            break
+        freqs, psd = welch(data, sfreq, nperseg=n_per_seg, noverlap=n_per_seg - step)
+        k = (data.shape[1] - n_per_seg) // step + 1
+        psd_sum = psd_sum + psd * k
+        n_segs += k
+    in_band = (freqs >= psd_band[0]) & (freqs <= psd_band[1])
+    log_psd = np.log10(psd_sum[:, in_band] / n_segs)
+    return np.array(
+        [np.median(log_psd[ch_types == kind], axis=0) for kind in ("mag", "grad")]
+    )
+
+
+def _erm_psd(fname):
+    return streamed_psd(fname)
+
+
+def _prestim_psd(fname):
+    stim, _, sfreq = read_stim_data(fname)
+    # first sample where any STIM channel is on
+    onsets = [np.flatnonzero(trace)[:1] for trace in stim.values()]
+    stop = min(np.concatenate(onsets), default=None)
+    if stop is not None and stop < min_prestim_seconds * sfreq:
+        stop = None
+    return streamed_psd(fname, stop=stop)
+
+
+psd_params = (psd_band, psd_seg_seconds, psd_chunk_seconds)
+
+
+def get_erm_psd(fname):
+    return cached("psd-erm", fname, _erm_psd, params=psd_params)
+
+
+def get_prestim_psd(fname):
+    params = (*psd_params, min_prestim_seconds)
+    return cached("psd-prestim", fname, _prestim_psd, params=params)
+
+
+def spectral_distance(psd_1, psd_2):
+    """RMS difference (in dB) of two PSDs, averaged over channel types."""
+    return np.sqrt(np.mean((10 * (psd_1 - psd_2)) ** 2, axis=-1)).mean()
+
+
+def describe_days(n_days):
+    """Describe a (signed) number of days between an ERM and a recording."""
+    if not n_days:
+        return "same-day"
+    _s = "s" if abs(n_days) > 1 else ""
+    return f"{abs(n_days)} day{_s} {'before' if n_days < 0 else 'after'}"
+
+
 # path stuff
-root = Path("/storage/badbaby-redux").resolve()
 ermsource = root / "data"
 subj_dirs = sorted(ermsource.glob("bad_*"))
 
@@ -37,13 +135,20 @@ missing_erms = pd.read_csv(
     outdir / "erm-missing-from-data.csv", header=0, index_col=False
 )
 
+# the files that `make-hardlinks.py` put in ./data (so that surrogates linked by an
+# earlier `link-surrogate-erms.py` run aren't taken for the recipients' own ERMs)
+hardlinked = set()
+for fname in ("files-from-local.yaml", "files-from-server.yaml"):
+    with open(fname, "r") as fid:
+        hardlinked.update(yaml.load(fid, Loader=yaml.SafeLoader).values())
+
 available_erms = defaultdict(list)
 pattern = r".*_erm(_raw)?.fif$"
 # catalog what dates we have ERMs for
 for _dir in subj_dirs:
     # see if there's an ERM recorded specifically for this project
     for _fname in (_dir / "raw_fif").iterdir():
-        if re.match(pattern, _fname.name):
+        if re.match(pattern, _fname.name) and str(_fname) in hardlinked:
             # don't rely on the datestring in the folder; load the file metadata
             scan_date = get_meas_date(_fname)
             available_erms[scan_date].append(_fname)
@@ -52,6 +157,8 @@ for _fname in (root / "extra-data").iterdir():
     if re.match(pattern, _fname.name):
         scan_date = get_meas_date(_fname)
         available_erms[scan_date].append(_fname)
+# sorted index of ERM dates, for finding the nearest ones
+erm_dates = sorted(available_erms)
 
 matched_erm_dates = list()
 missing_erm_dates = list()
@@ -59,45 +166,62 @@ missing_erm_dates = list()
 # look for date matches for sessions missing ERMs
 for _, (subj_id, exp, target_date) in missing_erms.iterrows():
     target_date = date.fromisoformat(target_date)
-    if target_date in available_erms:
-        matching_erm = available_erms[target_date][0].name
+    # nearest ERM date (before or after; ties go to the earlier one)
+    ix = bisect_left(erm_dates, target_date)
+    nearest_date = min(
+        erm_dates[max(ix - 1, 0) : ix + 1], key=lambda day: abs(day - target_date)
+    )
+    n_days = (nearest_date - target_date).days
+    nearest = available_erms[nearest_date][0].name
+    if abs(n_days) > erm_days_threshold:
         with add_to_log:
-            print(f"using {matching_erm} (same-day) as surrogate ERM for {subj_id}")
-        matched_erm_dates.append(
-            pd.DataFrame(
-                dict(date=target_date, recipient=subj_id, exp=exp, donor=matching_erm),
-                index=[0],
+            print(
+                f"no acceptable surrogate ERM for {subj_id}; threshold is "
+                f"{erm_days_threshold} day{'s' if erm_days_threshold > 1 else ''} "
+                f"and nearest is {describe_days(n_days)} ({nearest})"
             )
+        missing_erm_dates.append(target_date)
+        continue
+    row = dict(date=target_date, recipient=subj_id, exp=exp, donor=nearest)
+    row.update(n_days=n_days, psd_distance=np.nan, score=np.nan)
+    if args.spectral:
+        # score every ERM within the threshold, by spectral distance + date distance
+        thresh = timedelta(days=erm_days_threshold)
+        lo = bisect_left(erm_dates, target_date - thresh)
+        hi = bisect_right(erm_dates, target_date + thresh)
+        subj_dir = ermsource / f"bad_{subj_id}" / "raw_fif"
+        raw_fname = subj_dir / f"bad_{subj_id}_{exp}_raw.fif"
+        target_psd = get_prestim_psd(raw_fname)
+        candidates = list()
+        for erm_date in erm_dates[lo:hi]:
+            for erm_fname in available_erms[erm_date]:
+                n_days = (erm_date - target_date).days
+                dist = spectral_distance(target_psd, get_erm_psd(erm_fname))
+                candidates.append(
+                    dict(donor=erm_fname.name, n_days=n_days, psd_distance=dist)
+                )
+                candidates[-1]["score"] = dist + days_weight * abs(n_days)
+        candidates.sort(key=lambda candidate: candidate["score"])
+        row.update(candidates[0])
+        runner_up = (
+            f"; runner-up {candidates[1]['donor']} scored {candidates[1]['score']:.2f}"
+            if len(candidates) > 1
+            else ""
         )
+        with add_to_log:
+            print(
+                f"using {row['donor']} ({describe_days(row['n_days'])}, spectral "
+                f"distance {row['psd_distance']:.2f} dB, score {row['score']:.2f} of "
+                f"{len(candidates)} candidate{'s' if len(candidates) > 1 else ''}"
+                f"{runner_up}) as surrogate ERM for {subj_id}"
+            )
     else:
-        available_erm_dates = np.array(list(available_erms))
-        diffs = available_erm_dates - target_date
-        idx = np.argmin(np.abs(diffs))
-        timedelta = diffs[idx]
-        nearest = available_erms[available_erm_dates[idx]][0].name
-        n_days = np.abs(timedelta.days)
-        _s = "s" if n_days > 1 else ""
-        bef_aft = "before" if np.sign(timedelta.days) < 0 else "after"
-        if n_days <= erm_days_threshold:
-            matched_erm_dates.append(
-                pd.DataFrame(
-                    dict(date=target_date, recipient=subj_id, exp=exp, donor=nearest),
-                    index=[0],
-                )
+        with add_to_log:
+            print(
+                f"using {nearest} ({describe_days(n_days)}) as surrogate ERM for "
+                f"{subj_id}"
             )
-            with add_to_log:
-                print(
-                    f"using {nearest} ({n_days} day{_s} {bef_aft}) "
-                    f"as surrogate ERM for {subj_id}"
-                )
-        else:
-            with add_to_log:
-                print(
-                    f"no acceptable surrogate ERM for {subj_id}; threshold is "
-                    f"{erm_days_threshold} day{'s' if erm_days_threshold > 1 else ''} "
-                    f"and nearest is {n_days} day{_s} {bef_aft} ({nearest})"
-                )
-            missing_erm_dates.append(target_date)
+    matched_erm_dates.append(pd.DataFrame(row, index=[0]))
 
 matched_erm_dates = pd.concat(matched_erm_dates, ignore_index=True)
 matched_erm_dates.sort_values(["recipient", "exp"], inplace=True)
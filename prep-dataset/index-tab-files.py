@@ -0,0 +1,13 @@
+"""Index the expyfun TAB logs (header metadata and decoded trial IDs).
+
+`find_matching_tabs` (in score.py) queries this index instead of re-reading the TAB
+files. It is refreshed automatically (only new or modified files are re-read), so
+running this script is optional; it just front-loads the work.
+"""
+
+from score import refresh_tab_catalog, tab_catalog_file
+
+catalog = refresh_tab_catalog()
+print(f"{len(catalog)} TAB files indexed in {tab_catalog_file}")
+for _, row in catalog.loc[catalog["error"].notna()].iterrows():
+    print(f"    could not parse {row['fname']}: {row['error']}")
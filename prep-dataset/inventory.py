@@ -0,0 +1,128 @@
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from utils import read_info_cached
+
+# path stuff (the same as the scripts that write the other QC tables, which run from
+# the prep-dataset folder)
+outdir = Path("qc").resolve()
+
+# what kinds of data files do we expect? (in the column order of `files-in-*.csv`)
+KINDS = ["mmn", "am", "ids", "erm"]
+expected_pattern = rf"bad_\d{{3}}[ab]?_.*({'|'.join(KINDS)})_raw\.fif$"
+
+_inventory_dtypes = dict(
+    path="string",
+    fname="string",
+    subject="string",  # subject folder ID, e.g. "101a"
+    subj="int64",
+    session="string",
+    task="string",  # <NA> if the file isn't one of the KINDS
+    expected=bool,  # whether the filename is one we expect
+    canonical=bool,  # whether the filename is exactly `bad_{subject}_{task}_raw.fif`
+    meas_date="datetime64[ns, UTC]",
+    size="int64",
+    inode="int64",
+    erm_date="datetime64[ns, UTC]",  # meas_date of the subject folder's ERM
+    erm_match="boolean",  # experimental recording on the same day as the ERM?
+)
+
+
+def inventory_path(which_data, suffix=""):
+    """Get the file that the inventory of a data folder is saved to."""
+    return outdir / f"inventory-of-{which_data}{suffix}.parquet"
+
+
+def _read_meas_date(fname):
+    return read_info_cached(fname)["meas_date"]
+
+
+def build_inventory(data_dir, n_jobs=1, exclude=()):
+    """Scan a data folder once, with one row per file in its subject folders.
+
+    Headers are read (in parallel, if ``n_jobs > 1``) only for the files whose names
+    are exactly ``bad_{subject}_{task}_raw.fif``. Files in ``exclude`` are left out.
+    """
+    exclude = set(map(str, exclude))
+    rows = list()
+    subj_dirs = sorted(path for path in Path(data_dir).glob("bad*") if path.is_dir())
+    for subj_dir in subj_dirs:
+        # handle the one bad folder name in local data
+        subdir = "raw_fif" if (subj_dir / "raw_fif").is_dir() else "151007"
+        subject = subj_dir.name.lstrip("bad_")
+        for fname in sorted((subj_dir / subdir).iterdir()):
+            if str(fname) in exclude:
+                continue
+            stat = fname.stat()
+            task = next(
+                (kind for kind in KINDS if fname.name.endswith(f"{kind}_raw.fif")), None
+            )
+            rows.append(
+                dict(
+                    path=str(fname),
+                    fname=fname.name,
+                    subject=subject,
+                    task=task,
+                    expected=bool(re.match(expected_pattern, fname.name)),
+                    canonical=fname.name == f"bad_{subject}_{task}_raw.fif",
+                    size=stat.st_size,
+                    inode=stat.st_ino,
+                )
+            )
+    inventory = pd.DataFrame(rows)
+    # split subj and session identifiers; session may be "" (timepoints not strictly at
+    # 2mo or 6mo), which we call "c"
+    inventory["subj"] = inventory["subject"].str.slice(0, 3).astype(int)
+    session = inventory["subject"].str.slice(3)
+    inventory["session"] = session.where(session.astype(bool), "c")
+    # read the measurement dates
+    canonical = inventory.loc[inventory["canonical"], "path"].tolist()
+    if n_jobs == 1:
+        meas_dates = list(map(_read_meas_date, canonical))
+    else:
+        mp_context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+            meas_dates = list(pool.map(_read_meas_date, canonical, chunksize=16))
+    inventory["meas_date"] = pd.Series(
+        pd.to_datetime(meas_dates, utc=True),
+        index=inventory.index[inventory["canonical"]],
+    )
+    # pair each experimental recording with the ERM of its subject folder
+    erm_dates = inventory.loc[
+        inventory["canonical"] & inventory["task"].eq("erm")
+    ].set_index("subject")["meas_date"]
+    inventory["erm_date"] = inventory["subject"].map(erm_dates)
+    is_exp = inventory["canonical"] & inventory["task"].ne("erm")
+    same_day = inventory["meas_date"].dt.date == inventory["erm_date"].dt.date
+    inventory["erm_match"] = same_day.where(is_exp, pd.NA)
+    return inventory[list(_inventory_dtypes)].astype(_inventory_dtypes)
+
+
+def presence_table(inventory):
+    """Tabulate which kinds of recording each subject folder has.
+
+    This is the table that's saved as ``files-in-*.csv``: one row per subject folder,
+    with one boolean column per kind of recording, plus ``subj`` and ``session``.
+    """
+    subjects = inventory.drop_duplicates("subject").set_index("subject")
+    table = (
+        inventory.dropna(subset="task")
+        .groupby(["subject", "task"])
+        .size()
+        .unstack()
+        .reindex(index=subjects.index, columns=KINDS)
+        .notna()
+    )
+    table.columns.name = None
+    table["subj"] = subjects["subj"]
+    table["session"] = subjects["session"].astype(object)
+    return table
+
+
+def read_presence_table(which_data="data", suffix=""):
+    """Load a saved inventory and tabulate it (see `presence_table`)."""
+    return presence_table(pd.read_parquet(inventory_path(which_data, suffix)))
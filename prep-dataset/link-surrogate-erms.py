@@ -1,28 +1,29 @@
+import argparse
 from pathlib import Path
-from subprocess import run
 
 import pandas as pd
+import yaml
 
+from utils import link_files, surrogate_erm_links
 
-root = Path("/storage/badbaby-redux").resolve() / "data"
+
+# allow linking only some recipients, e.g. `python link-surrogate-erms.py 101a 205`
+parser = argparse.ArgumentParser(description="Hardlink surrogate ERMs into ./data")
+parser.add_argument("SUBJECTS", type=str, nargs="*", help="Subject IDs to process")
+parser.add_argument(
+    "--replace",
+    action="store_true",
+    help="Relink targets that are a different file (e.g. after a new surrogate choice)",
+)
+args = parser.parse_args()
+subjects_to_process = set(args.SUBJECTS)
 
 df = pd.read_csv(Path("qc") / "erm-surrogates.csv", index_col=False)
+# the files that `make-hardlinks.py` put in ./data
+hardlinked = list()
+for fname in ("files-from-local.yaml", "files-from-server.yaml"):
+    with open(fname, "r") as fid:
+        hardlinked.extend(yaml.load(fid, Loader=yaml.SafeLoader).values())
 
-for _, row in df.iterrows():
-    donor_file = row["donor"]
-    if donor_file.startswith("bad_"):
-        donor = "_".join(donor_file.split("_")[:2])
-        source = root / donor / "raw_fif" / donor_file
-    else:
-        source = root / ".." / "extra-data" / donor_file
-    recip = row["recipient"]
-    target_dir = root / f"bad_{recip}" / "raw_fif"
-    already_has_erm = bool(len(list(target_dir.glob("*erm_raw.fif"))))
-    needs_multiple_erms = (
-        len(df.groupby("recipient").get_group(recip)["date"].unique()) > 1
-    )
-    if already_has_erm or needs_multiple_erms:
-        target = target_dir / f"bad_{recip}_{row['exp']}_erm_raw.fif"
-    else:
-        target = target_dir / f"bad_{recip}_erm_raw.fif"
-    run(["cp", "-ln", "--preserve=all", str(source), str(target)])
+links = surrogate_erm_links(df, hardlinked, recipients=subjects_to_process)
+link_files(links, replace=args.replace)
@@ -1,15 +1,12 @@
 from pathlib import Path
 
-import pandas as pd
+from inventory import read_presence_table
 
 outdir = Path("qc").resolve()
-df = pd.read_csv(outdir / "files-in-data.csv", index_col=0)
+df = read_presence_table("data")
 
+# one line per (subject folder, kind) that has no file, in table order
+missing = df.drop(columns=["subj", "session"]).stack()
+missing = missing.index[~missing.to_numpy()]
 with open(outdir / "files-missing.txt", "w") as fid:
-    for _, row in df.iterrows():
-        subj = row["subj"]
-        session = row["session"] if row["session"] in ("a", "b") else ""
-        for kind in ("mmn", "am", "ids", "erm"):
-            if not row[kind]:
-                fname = f"bad_{subj}{session}_{kind}_raw.fif"
-                fid.write(f"{fname}\n")
+    fid.writelines(f"bad_{subject}_{kind}_raw.fif\n" for subject, kind in missing)
@@ -1,14 +1,26 @@
+import argparse
+import re
 from contextlib import redirect_stdout
 from io import StringIO
 from pathlib import Path
 from shutil import copyfileobj
-from subprocess import run
+
 import yaml
 
-from utils import hardlink
+from utils import link_files, root
+
+# allow (re)linking only some subject folders, e.g. `python make-hardlinks.py 101a 205`
+parser = argparse.ArgumentParser(description="Hardlink the selected files into ./data")
+parser.add_argument("SUBJECTS", type=str, nargs="*", help="Subject IDs to process")
+parser.add_argument(
+    "--replace",
+    action="store_true",
+    help="Relink targets that are a different file (e.g. a re-synced source)",
+)
+args = parser.parse_args()
+subjects_to_process = set(f"bad_{subject}" for subject in args.SUBJECTS)
 
 dry_run = False
-root = Path("/storage/badbaby-redux").resolve()
 
 # logging
 outdir = Path("qc").resolve()
@@ -24,25 +36,38 @@ with open("files-from-server.yaml", "r") as fid:
 mapping = local_files | server_files
 
 # make hardlinks for the FIF files
-for source, target in mapping.items():
-    source = Path(source)
-    target = Path(target)
-    # this guard shouldn't be necessary due to -n flag in hardlink command,
-    # but let's be extra careful:
-    if not target.is_file():
-        hardlink(source, target, dry_run)
-    # don't bother telling me if the filesizes are identical
-    elif source.stat().st_size != target.stat().st_size:
-        with add_to_log:
-            print(
-                f"FILE SIZE MISMATCH: not linking {source.relative_to(root)} to "
-                f"{target.relative_to(root)}"
-            )
-
-if not dry_run:
-    run(["chgrp", "--recursive", "badbaby", str(root / "data")])
-
-with open(outdir / "log-of-hardlinking.txt", "w") as fid:
+if subjects_to_process:
+    mapping = {
+        source: target
+        for source, target in mapping.items()
+        if Path(target).parts[-3] in subjects_to_process
+    }
+result = link_files(
+    mapping.items(), group="badbaby", dry_run=dry_run, replace=args.replace
+)
+# (targets that are already a link to their source aren't conflicts)
+with add_to_log:
+    for source, target in result["replaced"]:
+        print(f"RELINKED: {source.relative_to(root)} to {target.relative_to(root)}")
+    for source, target in result["conflict"]:
+        size_differs = source.stat().st_size != target.stat().st_size
+        print(
+            f"{'FILE SIZE MISMATCH' if size_differs else 'DIFFERENT FILE'}: not linking "
+            f"{source.relative_to(root)} to {target.relative_to(root)}"
+        )
+
+# when only some subjects were processed, keep the log lines of all the other subjects
+log_fname = outdir / "log-of-hardlinking.txt"
+old_lines = list()
+if subjects_to_process and log_fname.is_file():
+    old_lines = [
+        line
+        for line in log_fname.read_text().splitlines(keepends=True)
+        if re.search(r" to data/([^/]+)/", line).group(1) not in subjects_to_process
+    ]
+
+with open(log_fname, "w") as fid:
+    fid.writelines(old_lines)
     logfile.seek(0)
     copyfileobj(logfile, fid)
 logfile.close()
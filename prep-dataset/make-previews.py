@@ -0,0 +1,65 @@
+"""Write low-rate previews of every raw file, for `mark-prebads.py`.
+
+Previews are 80 Hz float32 copies of the data channels, stored in
+``prep-dataset/cache/previews``. They only need rebuilding when a raw file changes, so
+this can be run (e.g. overnight, on all cores) whenever new data arrive.
+"""
+
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from warnings import filterwarnings
+
+from utils import preview_is_current, root, write_preview
+
+parser = argparse.ArgumentParser(description="Write previews for mark-prebads.py")
+parser.add_argument("SUBJECTS", type=str, nargs="*", help="Subject IDs to process")
+parser.add_argument(
+    "--jobs", "-j", type=int, default=1, help="Number of files to process in parallel"
+)
+parser.add_argument(
+    "--force", action="store_true", help="Rewrite previews even if they're up to date"
+)
+args = parser.parse_args()
+subjects_to_process = set(f"bad_{subject}" for subject in args.SUBJECTS)
+
+# path stuff
+raw_files = sorted(
+    raw_file
+    for raw_file in (root / "data").glob("bad_*/raw_fif/*_raw.fif")
+    if not subjects_to_process or raw_file.parts[-3] in subjects_to_process
+)
+todo = [
+    raw_file
+    for raw_file in raw_files
+    if args.force or not preview_is_current(raw_file)
+]
+print(f"{len(raw_files) - len(todo)} previews up to date, {len(todo)} to write")
+
+
+def make_preview(raw_file):
+    """Write one preview (in a worker process)."""
+    # suppress messages about IAS / MaxShield
+    filterwarnings(
+        action="ignore",
+        message="This file contains raw Internal Active Shielding data",
+        category=RuntimeWarning,
+        module="mne",
+    )
+    write_preview(raw_file)
+    return raw_file
+
+
+def make_previews(raw_files, n_jobs):
+    """Write the previews (serially or on a process pool), yielding files in order."""
+    if n_jobs == 1:
+        yield from map(make_preview, raw_files)
+        return
+    # fork (not spawn) so that workers don't re-run this script's top-level code
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        yield from pool.map(make_preview, raw_files)
+
+
+for ix, raw_file in enumerate(make_previews(todo, n_jobs=args.jobs), start=1):
+    print(f"{ix: >4}/{len(todo)} {raw_file.name}")
@@ -7,13 +7,15 @@ import re
 import socket
 import sys
 import yaml
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 from warnings import filterwarnings
 
 import numpy as np
 
 sys.path.insert(0, str(Path(__file__).parent))
-from utils import tasks
+from utils import preview_sfreq, read_preview, tasks
 sys.path.pop(0)
 
 import mne
@@ -26,6 +28,7 @@ del tasks
 
 auto_skip = False
 n_channels = 25
+n_prefetch = 2  # how many upcoming files to load while the current one is plotted
 if len(sys.argv) > 1:
     assert len(sys.argv) == 4, (
         "expected either 0 or 3 command-line arguments (subj, session, task)"
@@ -33,6 +36,8 @@ if len(sys.argv) > 1:
     )
     auto_skip = True
 
+# loading / resampling settings (only used for files that don't have a preview yet;
+# see `make-previews.py`)
 hostname = socket.gethostname()
 resample = 80  # equiv to 40 Hz lowpass
 if hostname == "agelaius":  # drammock's machine
@@ -57,6 +62,8 @@ else:
 
 root = Path(__file__).parent.parent
 prebads_path = root / "prep-dataset" / "prebads.yaml"
+# bads suggested by `suggest-prebads.py` (preloaded for files not yet marked)
+suggestions_path = prebads_path.with_name("prebad-suggestions.yaml")
 raw_files = sorted((root / "data").glob("bad_*/raw_fif/*_raw.fif"))
 assert raw_files
 
@@ -144,8 +151,32 @@ for sub, sess in prebads.items():
 if any_changed:
     save_prebads()
 
+suggestions = dict()
+if suggestions_path.exists():
+    with open(suggestions_path) as fid:
+        suggestions = yaml.safe_load(fid) or dict()
+
+
+def load_raw(infile):
+    """Load, resample, and pre-screen a file (in the background prefetch thread)."""
+    # use the preview from `make-previews.py` if there is one (already at 80 Hz)
+    raw = read_preview(infile)
+    if raw is None:
+        raw = mne.io.read_raw_fif(
+            infile, preload=True, verbose=False, allow_maxshield=True
+        )
+        if resample:
+            raw.resample(resample, n_jobs=n_jobs)
+            assert raw.info["sfreq"] == 80
+    # std of every MEG channel (bads too, as they're not known until it's our turn)
+    meg_picks = mne.pick_types(raw.info, meg=True, eeg=False, exclude=())
+    meg_std = np.std(raw.get_data(picks=meg_picks), axis=1)
+    return raw, dict(zip(np.array(raw.ch_names)[meg_picks], meg_std))
+
+
+# decide the order up front, so the next file(s) can load while one is being marked
 counter = 0
-sub_ses_task = ""
+to_mark = list()
 for ix, infile in enumerate(rev(raw_files)):
     sub, ses, task = match(infile.name)
     # skip session C for now to save time
@@ -159,6 +190,29 @@ for ix, infile in enumerate(rev(raw_files)):
         else:
             print(f"Skipped {counter} files, starting with {' '.join(sys.argv[1:])}")
             auto_skip = False
+    to_mark.append((ix, infile))
+
+
+def is_marked(pos):
+    """Check whether a file in `to_mark` already has bads (so may well be skipped)."""
+    sub, ses, task = match(to_mark[pos][1].name)
+    return prebads[sub][ses][task] is not None
+
+
+prefetcher = ThreadPoolExecutor(max_workers=1)  # one at a time, in order
+loading = dict()  # position in `to_mark` → Future of `load_raw`
+sub_ses_task = ""
+for pos, (ix, infile) in enumerate(to_mark):
+    sub, ses, task = match(infile.name)
+    # start loading this file and the next ones that aren't marked yet (if not already
+    # started); marked ones are only loaded if the annotator doesn't skip them, so that
+    # skipping a run of them doesn't leave the next file queued behind wasted loads
+    upcoming = (
+        next_pos for next_pos in range(pos, len(to_mark)) if not is_marked(next_pos)
+    )
+    for next_pos in islice(upcoming, 1 + n_prefetch):
+        if next_pos not in loading:
+            loading[next_pos] = prefetcher.submit(load_raw, to_mark[next_pos][1])
     # option to skip ones already marked / annotated
     this_prebads = prebads[sub][ses][task]
     sub_ses_task = f"{sub} {ses} {task}"
@@ -169,13 +223,12 @@ for ix, infile in enumerate(rev(raw_files)):
             continue
     else:
         print(f"{prefix} no existing bads")
-    # load the raw
-    print("  loading...", end="", flush=True)
-    raw = mne.io.read_raw_fif(infile, preload=True, verbose=False, allow_maxshield=True)
-    if resample:
-        print("  resampling...")
-        raw.resample(resample, n_jobs=n_jobs)
-        assert raw.info["sfreq"] == 80
+    # get the (loaded / resampled) raw; a marked file wasn't prefetched, so it's loaded
+    # here rather than behind the prefetches of the files after it
+    future = loading.pop(pos, None)
+    if future is None or not future.done():
+        print("  loading...", end="", flush=True)
+    raw, meg_std = load_raw(infile) if future is None else future.result()
     annot_fname = Path("annots") / f"{sub}_{ses}_task-{task}_annot.fif"
     # add any already-created annotations
     if annot_fname.exists():
@@ -188,14 +241,22 @@ for ix, infile in enumerate(rev(raw_files)):
     # TODO: Run through 190 (sub-308) with this enabled
     # Automatically find some flat channels (though they can still go flat
     # partway through, usually this is accompanied by a bad jump or something visible)
-    meg_picks = mne.pick_types(raw.info, meg=True, eeg=False, exclude="bads")
     new_flat = [
-        raw.ch_names[meg_picks[fl]]
-        for fl in np.where(np.std(raw.get_data(picks=meg_picks), axis=1) < 1e-14)[0]
+        ch for ch, std in meg_std.items() if ch not in raw.info["bads"] and std < 1e-14
     ]
     if new_flat:
         print(f"  found {new_flat=}...", end="")
         raw.info["bads"].extend(new_flat)
+    # and the suggested ones (for the annotator to confirm, or un-mark)
+    if this_prebads is None:
+        suggested = suggestions.get(sub, dict()).get(ses, dict()).get(task) or dict()
+        suggested = {
+            ch: why for ch, why in suggested.items()
+            if ch in raw.ch_names and ch not in raw.info["bads"]
+        }
+        for ch, why in suggested.items():
+            print(f"\n  suggested {ch}: {why}", end="")
+        raw.info["bads"].extend(suggested)
     print("  plotting...", end="", flush=True)
     fig = raw.plot(
         picks="data",
@@ -207,7 +268,7 @@ for ix, infile in enumerate(rev(raw_files)):
         n_channels=n_channels,
         show_scalebars=False,
         overview_mode="channels",
-        lowpass=40 if not resample else None,
+        lowpass=40 if raw.info["sfreq"] > preview_sfreq else None,
         use_opengl=True,
         clipping=None,
     )
@@ -223,6 +284,8 @@ for ix, infile in enumerate(rev(raw_files)):
     resp = input(f"{prefix} assigned bads {chs}. Continue? [Y/n] ")
     if len(resp) and resp.lower()[0] != "y":
         break
+# don't wait for files we won't look at
+prefetcher.shutdown(wait=False, cancel_futures=True)
 
 # log overall progress
 done = 0
@@ -0,0 +1,342 @@
+"""Incrementally rebuild ./data and the QC tables (an alternative to `make all`).
+
+Each stage of the Makefile pipeline is listed below, along with the files it reads and
+writes, grouped by subject folder. The input fingerprints and output manifests of every
+stage are recorded after it runs, so that a rerun only redoes the subjects whose inputs
+changed (or whose outputs were modified / deleted). Stages that can work on a subset
+of subjects are passed just those subjects; stages that aggregate over the whole
+dataset are rerun if any subject changed. Use `--rsync` to pull new data first, and
+`--dry-run` to see what would be redone.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+from subprocess import run
+
+import pandas as pd
+import yaml
+
+from utils import cache_dir, root, surrogate_erm_links
+
+parser = argparse.ArgumentParser(description="Incrementally rebuild ./data and ./qc")
+parser.add_argument("--rsync", action="store_true", help="rsync both data sources first")
+parser.add_argument(
+    "--dry-run", action="store_true", help="report what would be redone, then stop"
+)
+args = parser.parse_args()
+
+# path stuff
+prep_dir = Path(__file__).resolve().parent
+qc_dir = prep_dir / "qc"
+state_file = cache_dir / "rebuild-state.json"
+
+GLOBAL = "*"  # key for inputs/outputs that don't belong to any one subject
+
+
+def file_items(paths):
+    """Describe files by path, size, and mtime (``None`` for missing files)."""
+    items = list()
+    for path in sorted(map(Path, paths)):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            items.append((str(path), None))
+        else:
+            items.append((str(path), stat.st_size, stat.st_mtime_ns))
+    return items
+
+
+def fingerprint(items):
+    """Hash a (JSON-serializable) description of a stage's inputs."""
+    return hashlib.sha1(json.dumps(items, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def outputs_intact(manifest):
+    """Check that outputs are still the ones we recorded (present and unmodified)."""
+    return all([tuple(item)] == file_items([item[0]]) for item in manifest)
+
+
+def subject_of(path):
+    """Get the subject folder name from a ``data/bad_*/raw_fif/*.fif`` path."""
+    return Path(path).parts[-3]
+
+
+# ########################## #
+# INPUTS / OUTPUTS OF STAGES #
+# ########################## #
+def source_tree_inputs(tree):
+    """Every file in the rsync'd source tree, by subject folder."""
+    inputs = {GLOBAL: list()}
+    for subj_dir in sorted((root / tree).glob("bad_*")):
+        inputs[subj_dir.name] = file_items(
+            path for path in subj_dir.rglob("*") if path.is_file()
+        )
+    return inputs
+
+
+def duplicates_inputs():
+    """Every file in both rsync'd source trees, by subject folder."""
+    inputs = source_tree_inputs("local-data")
+    for subj, items in source_tree_inputs("server-data").items():
+        inputs[subj] = inputs.get(subj, list()) + items
+    return inputs
+
+
+def server_selection_inputs():
+    """The server source tree, plus what was selected from local (and duplicates)."""
+    inputs = source_tree_inputs("server-data")
+    inputs[GLOBAL] = file_items(
+        [prep_dir / "files-from-local.yaml", qc_dir / "fif-duplicates.csv"]
+    )
+    return inputs
+
+
+def get_mapping():
+    """Get the combined source → target mapping written by `select-files-from-*.py`."""
+    mapping = dict()
+    for fname in ("files-from-local.yaml", "files-from-server.yaml"):
+        with open(prep_dir / fname, "r") as fid:
+            mapping.update(yaml.load(fid, Loader=yaml.SafeLoader))
+    return mapping
+
+
+def hardlink_inputs():
+    """Source files (and their targets) of the hardlinks, by target subject folder."""
+    inputs = {GLOBAL: list()}
+    for source, target in sorted(get_mapping().items()):
+        inputs.setdefault(subject_of(target), list()).extend(
+            [target] + file_items([source])
+        )
+    return inputs
+
+
+def hardlink_outputs():
+    """Hardlinked files, by subject folder."""
+    outputs = dict()
+    for target in get_mapping().values():
+        outputs.setdefault(subject_of(target), list()).append(target)
+    return outputs
+
+
+def linked_data_inputs(erm_only=False):
+    """The hardlinked files (i.e., not any surrogate ERMs), by subject folder."""
+    inputs = {GLOBAL: list()}
+    for subj, targets in hardlink_outputs().items():
+        if erm_only:
+            targets = [target for target in targets if "_erm" in Path(target).name]
+        inputs[subj] = file_items(targets)
+    return inputs
+
+
+def surrogate_erm_inputs():
+    """ERM files to choose from, plus the table of what's missing."""
+    inputs = linked_data_inputs(erm_only=True)
+    inputs[GLOBAL] = file_items(
+        [qc_dir / "erm-missing-from-data.csv", *(root / "extra-data").iterdir()]
+    )
+    return inputs
+
+
+def read_surrogates():
+    """Load the table of surrogate ERMs (recipient IDs lack the ``bad_`` prefix)."""
+    df = pd.read_csv(qc_dir / "erm-surrogates.csv", index_col=False, dtype=str)
+    return df.assign(recipient="bad_" + df["recipient"])
+
+
+def link_erm_inputs():
+    """Rows of the surrogate ERM table, by recipient subject folder."""
+    inputs = {GLOBAL: list()}
+    for recipient, rows in read_surrogates().groupby("recipient"):
+        inputs[recipient] = rows.to_numpy().tolist()
+    return inputs
+
+
+def link_erm_outputs():
+    """Surrogate ERMs to link into the data folders, by subject folder."""
+    surrogates = pd.read_csv(qc_dir / "erm-surrogates.csv", index_col=False, dtype=str)
+    outputs = {f"bad_{recip}": list() for recip in surrogates["recipient"].unique()}
+    for _, target in surrogate_erm_links(surrogates, get_mapping().values()):
+        outputs[subject_of(target)].append(target)
+    return outputs
+
+
+def data_folder_inputs():
+    """Everything in the data folders (after linking ERMs), by subject folder."""
+    inputs = {GLOBAL: list()}
+    for subj_dir in sorted((root / "data").glob("bad_*")):
+        inputs[subj_dir.name] = file_items((subj_dir / "raw_fif").iterdir())
+    return inputs
+
+
+def qc_files(*names):
+    """Make an output function for stage outputs that aren't specific to a subject."""
+    return lambda: {GLOBAL: [qc_dir / name for name in names]}
+
+
+# `per_subject` stages accept subject IDs on the command line (e.g. `101a`), and (like
+# `make clean`) their outputs that are no longer expected are deleted first
+stages = (
+    dict(
+        name="find-duplicates",
+        command=["find-duplicates.py"],
+        inputs=duplicates_inputs,
+        outputs=qc_files("fif-duplicates.csv", "fif-name-conflicts.csv"),
+        per_subject=False,
+    ),
+    dict(
+        name="select-files-from-local",
+        command=["select-files-from-local.py"],
+        inputs=lambda: source_tree_inputs("local-data"),
+        outputs=lambda: {GLOBAL: [prep_dir / "files-from-local.yaml"]},
+        per_subject=False,
+    ),
+    dict(
+        name="select-files-from-server",
+        command=["select-files-from-server.py"],
+        inputs=server_selection_inputs,
+        outputs=lambda: {GLOBAL: [prep_dir / "files-from-server.yaml"]},
+        per_subject=False,
+    ),
+    dict(
+        name="make-hardlinks",
+        command=["make-hardlinks.py", "--replace"],
+        inputs=hardlink_inputs,
+        outputs=hardlink_outputs,
+        per_subject=True,
+    ),
+    dict(
+        name="catalog-combined",
+        command=["catalog-data-completeness.py", "combined"],
+        inputs=linked_data_inputs,
+        outputs=qc_files(
+            "inventory-of-data.parquet",
+            "files-in-data.csv",
+            "erm-missing-from-data.csv",
+            "summary-of-combined-data.txt",
+            "unexpected-files-of-combined-data.txt",
+        ),
+        per_subject=False,
+    ),
+    dict(
+        name="find-surrogate-erms",
+        command=["find-surrogate-erms.py"],
+        inputs=surrogate_erm_inputs,
+        outputs=qc_files(
+            "erm-surrogates.csv", "log-of-surrogate-erms.txt", "erm-missing-dates.txt"
+        ),
+        per_subject=False,
+    ),
+    dict(
+        name="link-surrogate-erms",
+        command=["link-surrogate-erms.py", "--replace"],
+        inputs=link_erm_inputs,
+        outputs=link_erm_outputs,
+        per_subject=True,
+    ),
+    dict(
+        name="catalog-erm",
+        command=["catalog-data-completeness.py", "erm"],
+        inputs=data_folder_inputs,
+        outputs=qc_files(
+            "inventory-of-data-after-linking-erms.parquet",
+            "files-in-data-after-linking-erms.csv",
+            "erm-missing-from-data-after-linking-erms.csv",
+            "summary-after-linking-erms.txt",
+            "unexpected-files-after-linking-erms.txt",
+        ),
+        per_subject=False,
+    ),
+    dict(
+        name="list-missing-filenames",
+        command=["list-missing-filenames.py"],
+        inputs=lambda: {GLOBAL: file_items([qc_dir / "inventory-of-data.parquet"])},
+        outputs=qc_files("files-missing.txt"),
+        per_subject=False,
+    ),
+)
+
+
+# ########## #
+# RUN STAGES #
+# ########## #
+def save_state(state):
+    """Write the build state atomically."""
+    state_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = state_file.with_suffix(f".{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(state, indent=1, sort_keys=True))
+    tmp_file.replace(state_file)
+
+
+def remove_stale(old, subjects, expected):
+    """Delete the recorded outputs of some subjects that are no longer expected."""
+    expected = set(map(str, sum(expected.values(), [])))
+    for subj in subjects:
+        for path, *_ in old.get(subj, dict()).get("outputs", list()):
+            if path in expected or not os.path.lexists(path):
+                continue
+            print(f"    removing {Path(path).relative_to(root)}")
+            if not args.dry_run:
+                Path(path).unlink()
+                # (and the subject folder, if that was all of it)
+                for folder in Path(path).parents[:2]:
+                    if folder.is_dir() and not any(folder.iterdir()):
+                        folder.rmdir()
+
+
+def run_script(command):
+    """Run one of the prep-dataset scripts (from the prep-dataset folder)."""
+    print(f"    $ python {' '.join(command)}")
+    if not args.dry_run:
+        run([sys.executable, *command], cwd=prep_dir, check=True)
+
+
+if args.rsync and not args.dry_run:
+    run([prep_dir / "rsync-data-from-local-untitled-drive.sh"], check=True)
+    run([prep_dir / "rsync-data-from-server.sh"], check=True)
+
+state = json.loads(state_file.read_text()) if state_file.is_file() else dict()
+
+for stage in stages:
+    name = stage["name"]
+    old = state.get(name, dict())
+    fingerprints = {
+        subj: fingerprint(items) for subj, items in stage["inputs"]().items()
+    }
+    dirty = sorted(
+        subj
+        for subj, fp in fingerprints.items()
+        if subj not in old
+        or old[subj]["inputs"] != fp
+        or not outputs_intact(old[subj]["outputs"])
+    )
+    removed = sorted(set(old) - set(fingerprints))
+    n_skipped = len(fingerprints) - len(dirty)
+    subjects = [subj for subj in dirty if subj != GLOBAL]
+    print(
+        f"{name}: {len(dirty)} changed, {len(removed)} removed, {n_skipped} unchanged"
+        + (f" ({', '.join(subjects)})" if 0 < len(subjects) <= 10 else "")
+    )
+    if not dirty and not removed:
+        continue
+    all_subjects = set(fingerprints) - {GLOBAL}
+    if stage["per_subject"]:
+        remove_stale(old, dirty + removed, stage["outputs"]())
+    if not stage["per_subject"] or (subjects and set(subjects) == all_subjects):
+        run_script(stage["command"])
+    elif subjects:
+        run_script(stage["command"] + [subj.removeprefix("bad_") for subj in subjects])
+    if args.dry_run:
+        # downstream inputs would be stale, so stop here
+        print("(dry run: not checking later stages)")
+        break
+    # record what we just did
+    outputs = stage["outputs"]()
+    state[name] = {
+        subj: dict(inputs=fp, outputs=file_items(outputs.get(subj, list())))
+        for subj, fp in fingerprints.items()
+    }
+    save_state(state)
@@ -7,9 +7,15 @@ license: MIT
 """
 
 import argparse
+import multiprocessing
+import shutil
 import time
+import traceback
 from collections import defaultdict
+from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
+from io import StringIO
 from pathlib import Path
 from yaml import safe_load
 
@@ -18,11 +24,32 @@ from mne.io.constants import FIFF
 import numpy as np
 import pandas as pd
 
+from utils import link_files, read_info_cached, root, stage
+
 parser = argparse.ArgumentParser(
     description="Create scaled anatomies for badbaby data",
 )
 parser.add_argument("SUBJECTS", type=str, nargs="*", help="Subject IDs to process",)
+parser.add_argument(
+    "--jobs",
+    "-j",
+    type=int,
+    default=1,
+    help="Number of subjects (or extra sessions) to scale in parallel",
+)
+parser.add_argument(
+    "--pipeline-only",
+    action="store_true",
+    help="Only scale the files MNE-BIDS-Pipeline needs (see `--materialize`)",
+)
+parser.add_argument(
+    "--materialize",
+    action="store_true",
+    help="Scale whatever a `--pipeline-only` run skipped (no coreg is redone)",
+)
 args = parser.parse_args()
+n_jobs = args.jobs
+pipeline_only = args.pipeline_only
 subjects_to_process = set(f"bad_{subject}" for subject in args.SUBJECTS)
 
 # configurable params
@@ -32,7 +59,6 @@ do_nasion_shift = True
 nasion_shift_xyz = np.array([0, 0, 0.03])  # in meters!
 
 # path stuff
-root = Path("/storage/badbaby-redux").resolve()
 subjects_dir = root / "anat"
 data_dir = root / "data"
 prep_dir = root / "prep-dataset"
@@ -91,20 +117,248 @@ good_fiducials = {
         [55, -4, -29],  # RPA
     ],
 }
-# generate the MRI config files for scaling surrogate MRI to individual
-# subject's digitization points. Then scale the MRI and make the BEM solution.
-subject_break = False
-for subject in subjects:
-    if subject_break:
-        break
-    if subjects_to_process and subject not in subjects_to_process:
-        continue
+
+
+def get_fiducials(surrogate, int_subj, session):
+    """Get our manual fiducials for a surrogate (with the nasion shift, if needed)."""
+    # The default fiducials from the surrogate are awful. Let's fix them
+    # with our manual points
+    fiducials = mne.coreg.get_mni_fiducials(surrogate, subjects_dir=subjects_dir)
+    assert fiducials[0]["ident"] == FIFF.FIFFV_POINT_LPA
+    assert fiducials[1]["ident"] == FIFF.FIFFV_POINT_NASION
+    assert fiducials[2]["ident"] == FIFF.FIFFV_POINT_RPA
+    for fi, f in enumerate(fiducials):
+        f["r"] = np.array(good_fiducials[surrogate][fi]) * 1e-3
+        assert f["r"].shape == (3,), f"{f['r'].shape=}"
+        f["r"].setflags(write=False)
+        del f, fi
+
+    # shift the nasion
+    needs_shift = (
+        str(int_subj) in nasion_sub_ses and session in nasion_sub_ses[str(int_subj)]
+    )
+    if do_nasion_shift and needs_shift:
+        nasion = fiducials[1]  # guaranteed above
+        nasion["r"] = nasion["r"] + nasion_shift_xyz
+        nasion["r"].setflags(write=False)
+        del nasion
+    return fiducials, needs_shift
+
+
+def scale_mri_pipeline_only(subject_from, subject_to, scale, mri_fiducials):
+    """Like ``mne.scale_mri``, but only scale the files that MNE-BIDS-Pipeline needs.
+
+    That's the T1, the 3-layer BEM surfaces, the oct-6 source space, and the fiducials
+    (the trans and BEM solutions are written by the caller). Template files that don't
+    need scaling (curvature, spheres, annotations) are hardlinked instead of copied.
+    Everything else can be filled in later with `materialize_anat`.
+    """
+    dest = subjects_dir / subject_to
+    if dest.exists():
+        shutil.rmtree(dest)
+    for dirname in ("bem", "label", "mri", "surf"):
+        (dest / dirname).mkdir(parents=True)
+    # same as `mne.scale_mri`: isotropic 3-axis scaling is stored as a single scale
+    scale = np.atleast_1d(scale)
+    if scale.shape == (3,) and np.allclose(scale[1:], scale[0]):
+        scale = scale[0]
+    # the other `mne.scale_*` functions get `subject_from` and `scale` from this
+    mne.coreg._write_mri_config(
+        dest / "MRI scaling parameters.cfg", subject_from, subject_to, scale
+    )
+    mne.coreg._scale_mri(subject_to, "T1.mgz", subject_from, scale, subjects_dir)
+    mne.scale_bem(subject_to, "5120-5120-5120-bem", subjects_dir=subjects_dir)
+    mne.scale_source_space(subject_to, "oct-6", subjects_dir=subjects_dir)
+    fiducials = deepcopy(mri_fiducials)
+    for fid in fiducials:
+        fid["r"] = fid["r"] * scale
+    mne.io.write_fiducials(
+        dest / "bem" / f"{subject_to}-fiducials.fif",
+        fiducials,
+        FIFF.FIFFV_COORD_MRI,
+        overwrite=True,
+    )
+    template = subjects_dir / subject_from
+    unscaled = [
+        *(template / "surf").glob("?h.curv"),
+        *(template / "surf").glob("?h.sphere*"),
+        *(template / "label").glob("*.annot"),
+    ]
+    link_files((source, dest / source.relative_to(template)) for source in unscaled)
+
+
+def materialize_anat(unit):
+    """Scale the files of a (`--pipeline-only`) scaled MRI that aren't there yet.
+
+    Scaling follows ``mne.scale_mri`` (using the parameters saved in the subject's
+    ``MRI scaling parameters.cfg``), but existing files are left alone.
+    """
+    subject_to = unit["subject_to"]
+    t0 = time.time()
+    dest = subjects_dir / subject_to
+    cfg = mne.coreg.read_mri_cfg(subject_to, subjects_dir=subjects_dir)
+    subject_from, scale = cfg["subject_from"], cfg["scale"]
+    template = subjects_dir / subject_from
+    paths = mne.coreg._find_mri_paths(subject_from, True, subjects_dir)
+
+    def missing(fname):
+        target = Path(fname.format(subject=subject_to, subjects_dir=subjects_dir))
+        return not target.exists()
+
+    for fname in filter(missing, paths["surf"]):
+        pts, tri = mne.read_surface(
+            fname.format(subject=subject_from, subjects_dir=subjects_dir)
+        )
+        mne.write_surface(
+            fname.format(subject=subject_to, subjects_dir=subjects_dir), pts * scale, tri
+        )
+    for bem_name in paths["bem"]:
+        if bem_name == "head":
+            fname = mne.coreg.head_bem_fname
+        else:
+            fname = mne.coreg.bem_fname.replace("{name}", bem_name)
+        if missing(fname):
+            mne.scale_bem(subject_to, bem_name, subjects_dir=subjects_dir)
+    for fname in map(Path, paths["mri"]):
+        if not (dest / "mri" / fname.name).exists():
+            mne.coreg._scale_mri(
+                subject_to, fname.name, subject_from, scale, subjects_dir
+            )
+    t1_fname = str(template / "mri" / "T1.mgz")
+    for fname in filter(missing, paths["transforms"]):
+        (dest / "mri" / "transforms").mkdir(exist_ok=True)
+        xfm_name = Path(fname).name
+        mne.coreg._scale_xfm(
+            subject_to, xfm_name, t1_fname, subject_from, scale, subjects_dir
+        )
+    duplicates = [
+        Path(fname.format(subject=subject_from, subjects_dir=subjects_dir))
+        for fname in filter(missing, paths["duplicate"])
+    ]
+    (dest / "label").mkdir(exist_ok=True)
+    annots = (template / "label").glob("*.annot")  # existing ones are skipped
+    link_files(
+        [(source, dest / source.relative_to(template)) for source in duplicates]
+        + [(source, dest / "label" / source.name) for source in annots]
+    )
+    mne.scale_labels(subject_to, subjects_dir=subjects_dir)  # skips existing labels
+    for fname in filter(missing, paths["src"]):
+        src_name = Path(fname).name.removeprefix("{subject}-").removesuffix("-src.fif")
+        mne.scale_source_space(subject_to, src_name, subjects_dir=subjects_dir)
+    elapsed = timedelta(seconds=round(time.time() - t0))
+    print(f"{subject_to} materialized in {elapsed}")
+
+
+def scale_unit(unit):
+    """Scale the surrogate MRI to one subject (and meas_date), then make its BEMs.
+
+    Log messages are returned rather than written, so that the parent process can
+    merge them into the log in subject order (whatever the value of ``--jobs``).
+    """
+    subject_to, surrogate = unit["subject_to"], unit["surrogate"]
+    labels = dict(
+        subject=str(unit["int_subj"]), session=unit["session"], task=unit["task"]
+    )
+    log = StringIO()
+    log.write(unit["age_msg"])
+    t0 = time.time()
     # terminal message
     msg = "PROCESSING SUBJECT"
     msg_width = len(msg) + max(map(len, subjects)) + 5
     print("#" * msg_width)
-    print(f"# {msg} {subject: <4} #")
+    print(f"# {msg} {subject_to: <4} #")
     print("#" * msg_width)
+    try:
+        fiducials, _ = get_fiducials(surrogate, unit["int_subj"], unit["session"])
+        with stage("header-read", **labels):
+            info = read_info_cached(unit["raw_fname"])
+
+        # run automated coreg
+        with stage("icp", **labels):
+            coreg = mne.coreg.Coregistration(
+                info, subject=surrogate, subjects_dir=subjects_dir, fiducials=fiducials
+            )
+            coreg.set_scale_mode("3-axis")
+            coreg.set_fid_match("matched")  # TODO consider using "nearest"?
+            coreg.fit_fiducials()
+            n_pts = coreg.compute_dig_mri_distances().size
+            # do ICP fitting, and drop far-away points
+            coreg.fit_icp(n_iterations=10)
+            for dist in (10e-3, 5e-3):  # 10mm, 5mm
+                coreg.omit_head_shape_points(distance=dist)
+                # if any points were actually dropped, refit
+                if new_n_pts := coreg.compute_dig_mri_distances().size < n_pts:
+                    coreg.fit_icp(n_iterations=10)
+                    n_pts = new_n_pts
+
+        # scale the MRI (and save it to `subjects_dir`). This step takes a while.
+        with stage("scale-mri", **labels):
+            if pipeline_only:
+                scale_mri_pipeline_only(surrogate, subject_to, coreg.scale, fiducials)
+            else:
+                mne.scale_mri(
+                    subject_from=surrogate,
+                    subject_to=subject_to,
+                    scale=coreg.scale,
+                    overwrite=True,
+                    labels=True,
+                    annot=True,
+                    subjects_dir=subjects_dir,
+                    mri_fiducials=fiducials,
+                    verbose=True,
+                )
+        # save the trans file
+        trans_fpath = subjects_dir / subject_to / f"{subject_to}_trans.fif"
+        mne.write_trans(trans_fpath, coreg.trans, overwrite=True)
+
+        # make BEM solution. We only need 1-layer, but the 6mo surrogate only has
+        # 3-layer so let's use that for everyone
+        print(f"Making BEM solution for {subject_to} ...")
+        bem_dir = subjects_dir / subject_to / "bem"
+        bem_in = bem_dir / f"{subject_to}-5120-5120-5120-bem.fif"
+        bem_inout_1 = bem_dir / f"{subject_to}-5120-bem.fif"
+        bem_out_3 = bem_dir / f"{subject_to}-5120-5120-5120-bem-sol.fif"
+        bem_out_1 = bem_dir / f"{subject_to}-5120-bem-sol.fif"
+        with stage("bem-solution", **labels):
+            solution = mne.make_bem_solution(bem_in)
+            mne.write_bem_solution(bem_out_3, solution)
+            # we also want a 1-layer BEM to satisify MNE-BIDS-Pipeline
+            # we could add a config value for MNE-BIDS-Pipeline, but the
+            bem_surfaces = mne.read_bem_surfaces(bem_in)[-1:]
+            mne.write_bem_surfaces(bem_inout_1, bem_surfaces)
+            assert bem_surfaces[0]["id"] == mne.io.constants.FIFF.FIFFV_BEM_SURF_ID_BRAIN, \
+                f"{bem_surfaces[0]["id"]=} != {mne.io.constants.FIFF.FIFFV_BEM_SURF_ID_BRAIN}"
+            solution_1 = mne.make_bem_solution(bem_inout_1)
+            mne.write_bem_solution(bem_out_1, solution_1)
+    except Exception:
+        # don't let one subject take down the other workers; report it at the end
+        log.write(f"{subject_to} FAILED:\n{traceback.format_exc()}\n")
+        failed = True
+    else:
+        failed = False
+    elapsed = timedelta(seconds=round(time.time() - t0))
+    print(f"{subject_to} {'FAILED' if failed else 'complete'} in {elapsed}")
+    return dict(log=log.getvalue(), elapsed=elapsed, failed=failed)
+
+
+def run_units(func, units, n_jobs):
+    """Process the units (serially or on a process pool), yielding results in order."""
+    if n_jobs == 1:
+        yield from map(func, units)
+        return
+    # fork (not spawn) so that workers inherit the config above without re-running
+    # this script's top-level code
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        yield from pool.map(func, units)
+
+
+# generate the MRI config files for scaling surrogate MRI to individual
+# subject's digitization points. First plan one unit per (subject, meas_date)...
+units = list()
+for subject in subjects:
+    if subjects_to_process and subject not in subjects_to_process:
+        continue
     # basics
     int_subj = int(subject.lstrip("bad_").rstrip("ab"))
     this_subj_dir = data_dir / subject / "raw_fif"
@@ -116,7 +370,7 @@ for subject in subjects:
     for task in ("am", "ids", "mmn"):
         raw_fname = this_subj_dir / f"{subject}_{task}_raw.fif"
         if raw_fname.exists():
-            info = mne.io.read_info(raw_fname, verbose=False)
+            info = read_info_cached(raw_fname)
             meas_date = info["meas_date"].date()
             meas_dates[meas_date].append(task)
 
@@ -132,146 +386,110 @@ for subject in subjects:
             f"{subject: <4} was {age} days ({gestational_or_birth} age) at recording "
             "(expected {low}-{high} days)\n"
         )
+        age_msg = ""
         # choose correct surrogate
         if session in "ab":
             surrogate = f"ANTS{3 if session == 'a' else 6}-0Months3T"
             target_age = _2mo if session == "a" else _6mo
             lo, hi = np.array([-7, 7]) + target_age
             if not lo <= age <= hi:
-                with open(mri_log, "a") as fid:
-                    fid.write(msg.format(low=int(lo), high=int(np.ceil(hi))))
+                age_msg = msg.format(low=int(lo), high=int(np.ceil(hi)))
         else:
             ix = np.argmin(np.abs(surrogate_age - age / days_per_month))
             surrogate = surrogates[surrogate_age_str[ix]]
 
         # Most subjs have all tasks on the same meas_date, so only specify task in
         # folder/filename if needed (like we did for ERM)
-        subject_to = f"{subject}_{tasks[0]}" if extra_session else subject
-
-        # The default fiducials from the surrogate are awful. Let's fix them
-        # with our manual points
-        fids_path = subjects_dir / surrogate / "bem" / f"{surrogate}-fiducials.fif"
-        fiducials = mne.coreg.get_mni_fiducials(surrogate, subjects_dir=subjects_dir)
-        assert fiducials[0]["ident"] == FIFF.FIFFV_POINT_LPA
-        assert fiducials[1]["ident"] == FIFF.FIFFV_POINT_NASION
-        assert fiducials[2]["ident"] == FIFF.FIFFV_POINT_RPA
-        for fi, f in enumerate(fiducials):
-            f["r"] = np.array(good_fiducials[surrogate][fi]) * 1e-3
-            assert f["r"].shape == (3,), f"{f['r'].shape=}"
-            f["r"].setflags(write=False)
-            del f, fi
-
-        # shift the nasion
-        needs_shift = (
-            str(int_subj) in nasion_sub_ses and session in nasion_sub_ses[str(int_subj)]
-        )
-        if do_nasion_shift and needs_shift:
-            nasion = fiducials[1]  # guaranteed above
-            nasion["r"] = nasion["r"] + nasion_shift_xyz
-            nasion["r"].setflags(write=False)
-            del nasion
-
-        raw_fname = this_subj_dir / f"{subject}_{tasks[0]}_raw.fif"
-        info = mne.io.read_info(raw_fname, verbose=False)
-
-        if not scaling_already_done:
-            t0 = time.time()
-            # run automated coreg
-            coreg = mne.coreg.Coregistration(
-                info, subject=surrogate, subjects_dir=subjects_dir, fiducials=fiducials
+        units.append(
+            dict(
+                subject=subject,
+                subject_to=f"{subject}_{tasks[0]}" if extra_session else subject,
+                int_subj=int_subj,
+                session=session,
+                task=tasks[0] if extra_session else None,
+                surrogate=surrogate,
+                raw_fname=this_subj_dir / f"{subject}_{tasks[0]}_raw.fif",
+                age_msg=age_msg,
             )
-            coreg.set_scale_mode("3-axis")
-            coreg.set_fid_match("matched")  # TODO consider using "nearest"?
-            coreg.fit_fiducials()
-            n_pts = coreg.compute_dig_mri_distances().size
-            # do ICP fitting, and drop far-away points
-            coreg.fit_icp(n_iterations=10)
-            for dist in (10e-3, 5e-3):  # 10mm, 5mm
-                coreg.omit_head_shape_points(distance=dist)
-                # if any points were actually dropped, refit
-                if new_n_pts := coreg.compute_dig_mri_distances().size < n_pts:
-                    coreg.fit_icp(n_iterations=10)
-                    n_pts = new_n_pts
+        )
 
-            # scale the MRI (and save it to `subjects_dir`). This step takes a while.
-            mne.scale_mri(
-                subject_from=surrogate,
-                subject_to=subject_to,
-                scale=coreg.scale,
-                overwrite=True,
-                labels=True,
-                annot=True,
-                subjects_dir=subjects_dir,
-                mri_fiducials=fiducials,
-                verbose=True,
-            )
-            # save the trans file
-            trans_fpath = subjects_dir / subject_to / f"{subject_to}_trans.fif"
-            mne.write_trans(trans_fpath, coreg.trans, overwrite=True)
-
-            # make BEM solution. We only need 1-layer, but the 6mo surrogate only has
-            # 3-layer so let's use that for everyone
-            print("Making BEM solution ...")
-            bem_dir = subjects_dir / subject_to / "bem"
-            bem_in = bem_dir / f"{subject_to}-5120-5120-5120-bem.fif"
-            bem_inout_1 = bem_dir / f"{subject_to}-5120-bem.fif"
-            bem_out_3 = bem_dir / f"{subject_to}-5120-5120-5120-bem-sol.fif"
-            bem_out_1 = bem_dir / f"{subject_to}-5120-bem-sol.fif"
-            solution = mne.make_bem_solution(bem_in)
-            mne.write_bem_solution(bem_out_3, solution)
-            # we also want a 1-layer BEM to satisify MNE-BIDS-Pipeline
-            # we could add a config value for MNE-BIDS-Pipeline, but the
-            bem_surfaces = mne.read_bem_surfaces(bem_in)[-1:]
-            mne.write_bem_surfaces(bem_inout_1, bem_surfaces)
-            assert bem_surfaces[0]["id"] == mne.io.constants.FIFF.FIFFV_BEM_SURF_ID_BRAIN, \
-                f"{bem_surfaces[0]["id"]=} != {mne.io.constants.FIFF.FIFFV_BEM_SURF_ID_BRAIN}"
-            solution_1 = mne.make_bem_solution(bem_inout_1)
-            mne.write_bem_solution(bem_out_1, solution_1)
-            print(f"Subject complete in {timedelta(seconds=round(time.time() - t0))}")
+# ...then scale the MRIs and make the BEM solutions (the slow part). Logs are merged
+# in unit order, so the log doesn't depend on `--jobs`
+if scaling_already_done or args.materialize:
+    for unit in units:
+        if unit["age_msg"]:
+            with open(mri_log, "a") as fid:
+                fid.write(unit["age_msg"])
+    if args.materialize:
+        for _ in run_units(materialize_anat, units, n_jobs=n_jobs):
+            pass
+else:
+    t_start = time.time()
+    timings = list()
+    for unit, result in zip(units, run_units(scale_unit, units, n_jobs=n_jobs)):
+        if result["log"]:
+            with open(mri_log, "a") as fid:
+                fid.write(result["log"])
+        timings.append((unit["subject_to"], result["elapsed"], result["failed"]))
+    # timing summary
+    width = max((len(name) for name, *_ in timings), default=0)
+    print(f"\nScaled {len(timings)} anatomies with {n_jobs} job(s):")
+    for name, elapsed, failed in timings:
+        print(f"    {name: <{width}}  {elapsed}" + ("  FAILED" if failed else ""))
+    wall = timedelta(seconds=round(time.time() - t_start))
+    total = sum((elapsed for _, elapsed, _ in timings), timedelta())
+    print(f"Total: {total} of work in {wall} (wall clock)")
+    failures = [name for name, _, failed in timings if failed]
+    if failures:
+        raise RuntimeError(
+            f"Scaling failed for {len(failures)} unit(s) (tracebacks are in "
+            f"{mri_log.relative_to(prep_dir)}):\n{failures}"
+        )
 
-        # QC the coregistrations
-        if qc:
-            # load trans
-            trans = mne.read_trans(
-                subjects_dir / subject_to / f"{subject_to}_trans.fif"
-            )
-            # plot
-            mne.viz.plot_alignment(
-                info=info,
-                trans=trans,
-                subject=subject_to,
-                subjects_dir=subjects_dir,
-                surfaces=dict(head=0.9),
-                dig=True,
-                mri_fiducials=True,
-                meg=False,
-            )
-            # user interaction
-            spaces = " " * (len(subject) + 14)
-            response = input(
-                f"Now viewing {subject}; press <ENTER> to continue;\n"
-                f"{spaces}press C <ENTER> to run manual coreg\n"
-                f"{spaces}press X <ENTER> to quit\n"
-                + ("(Nasion shift applied)\n" if needs_shift and do_nasion_shift else "")
-            )
-            if response.lower().startswith("x"):
-                subject_break = True
-                break
-            elif response.lower().startswith("c"):
-                # run coregistration GUI to do it manually and compare
-                ui = mne.gui.coregistration(
-                    inst=raw_fname,
-                    subject=surrogate,
-                    subjects_dir=subjects_dir,
-                    mark_inside=True,
-                    block=False,
-                )
-                # set fiducials
-                ui.coreg._setup_fiducials(fiducials)
-                ui._update_distance_estimation()
-                ui._update_fiducials_label()
-                ui._update_fiducials()
-                ui._reset(keep_trans=True)
-                ui._update_fiducials()
-                #from mne.viz.backends._utils import _qt_app_exec
-                #_qt_app_exec(ui._renderer.figure.store["app"])
+# QC the coregistrations
+for unit in units if qc else ():
+    subject, subject_to, surrogate = unit["subject"], unit["subject_to"], unit["surrogate"]
+    raw_fname = unit["raw_fname"]
+    fiducials, needs_shift = get_fiducials(surrogate, unit["int_subj"], unit["session"])
+    info = read_info_cached(raw_fname)
+    # load trans
+    trans = mne.read_trans(subjects_dir / subject_to / f"{subject_to}_trans.fif")
+    # plot
+    mne.viz.plot_alignment(
+        info=info,
+        trans=trans,
+        subject=subject_to,
+        subjects_dir=subjects_dir,
+        surfaces=dict(head=0.9),
+        dig=True,
+        mri_fiducials=True,
+        meg=False,
+    )
+    # user interaction
+    spaces = " " * (len(subject) + 14)
+    response = input(
+        f"Now viewing {subject}; press <ENTER> to continue;\n"
+        f"{spaces}press C <ENTER> to run manual coreg\n"
+        f"{spaces}press X <ENTER> to quit\n"
+        + ("(Nasion shift applied)\n" if needs_shift and do_nasion_shift else "")
+    )
+    if response.lower().startswith("x"):
+        break
+    elif response.lower().startswith("c"):
+        # run coregistration GUI to do it manually and compare
+        ui = mne.gui.coregistration(
+            inst=raw_fname,
+            subject=surrogate,
+            subjects_dir=subjects_dir,
+            mark_inside=True,
+            block=False,
+        )
+        # set fiducials
+        ui.coreg._setup_fiducials(fiducials)
+        ui._update_distance_estimation()
+        ui._update_fiducials_label()
+        ui._update_fiducials()
+        ui._reset(keep_trans=True)
+        ui._update_fiducials()
+        #from mne.viz.backends._utils import _qt_app_exec
+        #_qt_app_exec(ui._renderer.figure.store["app"])
@@ -1,4 +1,6 @@
+import functools
 import json
+import os
 import re
 from ast import literal_eval
 from datetime import datetime
@@ -8,9 +10,15 @@ from warnings import warn
 import mne
 import numpy as np
 import pandas as pd
+from mne._fiff.open import fiff_open
+from mne._fiff.tag import read_tag
+from mne._fiff.tree import dir_tree_find
+from mne.io.constants import FIFF
 from pytz import timezone
 from scipy.stats.contingency import association, crosstab
 
+from utils import cache_dir, read_info_cached, root
+
 tz = "US/Pacific"  # where the recordings happened
 
 EVENT_OFFSETS = dict(
@@ -20,10 +28,24 @@ EVENT_OFFSETS = dict(
 )
 
 # path stuff
-root = Path("/storage/badbaby-redux").resolve()
 tab_dir = root / "expyfun-logs"
 orig_data = root / "data"
 outdir = root / "prep-dataset" / "qc"
+tab_catalog_file = cache_dir / "tab-catalog.pkl"
+
+# experiment names in the TAB file metadata → our task codes
+TAB_EXP_TYPES = dict(ids="ids", tone="am", syllable="mmn")
+_tab_catalog_columns = [
+    "fname",
+    "mtime_ns",
+    "size",
+    "participant",
+    "exp_name",
+    "tab_date",
+    "runfile",
+    "tab_events",
+    "error",
+]
 
 
 def parse_tab_values(value):
@@ -56,30 +78,197 @@ def ensure_events_match(fif_events, tab_events, assoc, require_ids_match=True):
         np.testing.assert_array_equal(fif_events, tab_events)
 
 
-def parse_mmn_events(raw_fname, offset=0):
+# dtypes of raw data buffers (FIF files are big-endian)
+_buffer_dtypes = {
+    FIFF.FIFFT_DAU_PACK16: ">i2",
+    FIFF.FIFFT_SHORT: ">i2",
+    FIFF.FIFFT_INT: ">i4",
+    FIFF.FIFFT_FLOAT: ">f4",
+    FIFF.FIFFT_DOUBLE: ">f8",
+}
+_tag_header_bytes = 16  # kind, type, size, next (int32 each)
+
+
+def _read_stim_data_mne(fname, picks):
+    """Read the STIM channels through MNE (slow, but handles split files)."""
+    raw = mne.io.read_raw_fif(fname, allow_maxshield="yes", preload=False)
+    return raw.get_data(picks=picks), raw.first_samp
+
+
+def read_stim_data(fname, info=None):
+    """Read only the STIM channels of a raw FIF file.
+
+    The data buffers are located via the FIF tag directory and accessed through a
+    memory map of the file, so the MEG channels are never decoded, scaled, or copied.
+    Pass ``info`` if the file's header has already been read.
+
+    Returns a dict mapping STIM channel names to integer traces, plus the raw file's
+    ``first_samp`` and ``sfreq``.
+    """
+    fname = Path(fname)
+    if info is None:
+        info = read_info_cached(fname)
+    picks = mne.pick_types(info, meg=False, stim=True, exclude=())
+    ch_names = [info["ch_names"][pick] for pick in picks]
+    cals = np.array([info["chs"][pick]["range"] * info["chs"][pick]["cal"] for pick in picks])
+    nchan = info["nchan"]
+    ff, tree, _ = fiff_open(fname)
+    with ff as fid:
+        for kind in (
+            FIFF.FIFFB_RAW_DATA, FIFF.FIFFB_CONTINUOUS_DATA, FIFF.FIFFB_IAS_RAW_DATA
+        ):
+            raw_node = dir_tree_find(tree, kind)
+            if raw_node:
+                break
+        # no data or split files: let MNE handle (or complain about) those
+        if len(raw_node) != 1 or dir_tree_find(tree, FIFF.FIFFB_REF):
+            data, first_samp = _read_stim_data_mne(fname, picks)
+            return dict(zip(ch_names, data.astype(np.int64))), first_samp, info["sfreq"]
+        # walk the tag directory the same way `mne.io.read_raw_fif` does
+        directory = list(raw_node[0]["directory"])
+        first_samp = 0
+        if directory and directory[0].kind == FIFF.FIFF_FIRST_SAMPLE:
+            first_samp = int(read_tag(fid, directory.pop(0).pos).data.item())
+        first_skip = 0
+        if directory and directory[0].kind == FIFF.FIFF_DATA_SKIP:
+            first_skip = int(read_tag(fid, directory.pop(0).pos).data.item())
+        buffers = list()  # (tag directory entry or None for skips, n_samples)
+        n_skip = 0
+        for ent in directory:
+            if ent.kind == FIFF.FIFF_DATA_SKIP:
+                n_skip = int(read_tag(fid, ent.pos).data.item())
+            elif ent.kind == FIFF.FIFF_DATA_BUFFER:
+                if ent.type not in _buffer_dtypes:
+                    raise RuntimeError(f"Cannot handle data buffers of type {ent.type}")
+                n_samp = ent.size // (np.dtype(_buffer_dtypes[ent.type]).itemsize * nchan)
+                # an initial skip only shifts `first_samp`; later ones are zero-filled
+                if first_skip > 0:
+                    first_samp += n_samp * first_skip
+                    first_skip = 0
+                if n_skip > 0:
+                    buffers.append((None, n_skip * n_samp))
+                    n_skip = 0
+                buffers.append((ent, n_samp))
+    # pull the STIM rows out of each buffer
+    data = np.zeros((len(picks), sum(n_samp for _, n_samp in buffers)))
+    mmap = np.memmap(fname, dtype=np.uint8, mode="r")
+    start = 0
+    for ent, n_samp in buffers:
+        if ent is not None:
+            dtype = np.dtype(_buffer_dtypes[ent.type])
+            offset = ent.pos + _tag_header_bytes
+            buffer = mmap[offset : offset + n_samp * nchan * dtype.itemsize]
+            data[:, start : start + n_samp] = buffer.view(dtype).reshape(n_samp, nchan)[
+                :, picks
+            ].T
+        start += n_samp
+    del mmap
+    data *= cals[:, np.newaxis]
+    return dict(zip(ch_names, data.astype(np.int64))), first_samp, info["sfreq"]
+
+
+def _stim_steps(trace):
+    """Find every change of value in a STIM trace, in one pass.
+
+    Returns the sample index of each step, and the values before and after it.
+    Mirrors the trigger-value handling of ``mne.find_events``.
+    """
+    trace = trace.astype(np.int64)
+    if trace.min() < 0:
+        warn(
+            "Trigger channel contains negative values, using absolute value. If data "
+            "were acquired on a Neuromag system with STI016 active, consider using "
+            "uint_cast=True to work around an acquisition bug"
+        )
+        trace = np.abs(trace)
+    idx = np.flatnonzero(np.diff(trace))
+    return idx + 1, trace[idx], trace[idx + 1]
+
+
+def _onset_events(steps, first_samp, shortest_event=0):
+    """Get events from stim steps, like ``mne.find_events(consecutive="increasing")``.
+
+    Every step up is an onset. Because ``find_events`` pads the end of the trace
+    with a step down to zero, no onset is ever orphaned, so nothing gets dropped.
+    """
+    idx, pre, post = steps
+    onsets = post > pre
+    if not onsets.any():
+        return np.empty((0, 3), dtype="int32")
+    events = np.c_[idx[onsets] + first_samp, pre[onsets], post[onsets]]
+    n_short_events = np.sum(np.diff(events[:, 0]) < shortest_event)
+    if n_short_events > 0:
+        raise ValueError(
+            f"You have {n_short_events} events shorter than the shortest_event. "
+            "These are very unusual and you may want to set min_duration to a "
+            "larger value e.g. x / raw.info['sfreq']. Where x = 1 sample shorter "
+            "than the shortest event length."
+        )
+    return events
+
+
+def _bit_onset_events(steps, first_samp, n_bits=8):
+    """Get per-bit onsets, like ``mne.find_events(mask=2**bit, mask_type="and")``.
+
+    All bits are handled at once, from the steps of the full STI101 trace. Returns one
+    events array per bit.
+    """
+    idx, pre, post = steps
+    shifts = np.arange(n_bits)[:, np.newaxis]
+    rising = (((pre >> shifts) & 1) == 0) & (((post >> shifts) & 1) == 1)
+    bit_events = list()
+    for bit, this_rising in enumerate(rising):
+        if not this_rising.any():
+            bit_events.append(np.empty((0, 3), dtype="int32"))
+            continue
+        onsets = idx[this_rising] + first_samp
+        events = np.zeros((onsets.size, 3), dtype=np.int64)
+        events[:, 0] = onsets
+        events[:, 2] = 2**bit
+        bit_events.append(events)
+    return bit_events
+
+
+def _decode_serial_codes(codes, sync_idx):
+    """Decode the expyfun serial (binary) trial codes between sync triggers.
+
+    Segment ``k`` runs from ``sync_idx[k - 1]`` (inclusive) to ``sync_idx[k]``
+    (exclusive); the first segment starts at the first trigger and the last one runs to
+    the end. Triggers 4-8 are serial bits (8 → 1, else 0), most significant bit first.
+    Returns the number of serial bits and the decoded value of each of the
+    ``len(sync_idx) + 1`` segments.
+    """
+    n_seg = len(sync_idx) + 1
+    segment = np.searchsorted(sync_idx, np.arange(len(codes)), side="right")
+    is_serial = np.logical_and(codes >= 4, codes <= 8)
+    segment = segment[is_serial]
+    bits = (codes[is_serial] == 8).astype(np.int64)
+    n_serial = np.bincount(segment, minlength=n_seg)
+    starts = np.cumsum(n_serial) - n_serial
+    rank = np.arange(segment.size) - starts[segment]
+    weighted = bits * 2 ** (n_serial[segment] - 1 - rank)
+    # pad so every start is a valid index; empty segments get fixed up afterwards
+    values = np.add.reduceat(np.append(weighted, 0), starts)
+    values[n_serial == 0] = 0
+    return n_serial, values
+
+
+def parse_mmn_events(raw_fname, offset=0, info=None):
     """Parse events from STIM channel for MMN experiment (which had wonky timing)."""
-    raw = mne.io.read_raw_fif(raw_fname, allow_maxshield="yes", preload=False)
-    raw.pick("stim").load_data()
-    orig_events = mne.find_events(raw, stim_channel="STI101", shortest_event=0)
+    stim_data, first_samp, _ = read_stim_data(raw_fname, info=info)
+    orig_events = _onset_events(_stim_steps(stim_data["STI101"]), first_samp)
     stim_idx = np.nonzero(orig_events[:, 2] == 1)[0]
-    trial_ids = list()
-    for ix, span in enumerate(np.array_split(orig_events, stim_idx, axis=0)):
-        # all spans except the first one should start with a stim trigger (event ID 1)
-        if ix == 0:
-            continue
-        assert span[0, 2] == 1, (ix, span)
-        # because of the wonky experiment script, we expect the stim played to match the
-        # trial ID *following* the stim trigger instead of the one *preceding* it
-        triggers = span[:, 2]
-        bit_idx = np.logical_and(triggers >= 4, triggers <= 8)
-        bits = triggers[bit_idx] // 8
-        if len(bits):
-            trial_id = int("".join(map(str, bits)), base=2)
-        else:  # final span may not have any trial ID triggers in it
-            assert ix == len(stim_idx), f"bad triggers in trial {ix}/{len(stim_idx)}"
-            trial_id = -1  # will change to 0 a few lines down
-        trial_ids.append(trial_id)
-    trial_ids = np.array(trial_ids)
+    # because of the wonky experiment script, we expect the stim played to match the
+    # trial ID *following* the stim trigger instead of the one *preceding* it. So the
+    # span starting at each stim trigger (event ID 1) holds the ID for that trial.
+    n_bits, trial_ids = _decode_serial_codes(orig_events[:, 2], stim_idx)
+    n_bits, trial_ids = n_bits[1:], trial_ids[1:]
+    # final span may not have any trial ID triggers in it
+    empty = np.nonzero(n_bits == 0)[0]
+    assert not len(empty) or empty[0] == len(stim_idx) - 1, (
+        f"bad triggers in trial {empty[0] + 1}/{len(stim_idx)}"
+    )
+    trial_ids[empty] = -1  # will change to 0 a few lines down
     # correct mysterious 0 ID that should have been a 4
     if set(trial_ids) == {2, 3, 0}:
         trial_ids[np.nonzero(trial_ids == 0)] = 4
@@ -91,23 +280,24 @@ def parse_mmn_events(raw_fname, offset=0):
     return events[valid_ix], orig_events
 
 
-def custom_extract_expyfun_events(fname, offset=0):
-    """Copied from mnefun; modified to delay preloading until after stim ch picking.
+def custom_extract_expyfun_events(fname, offset=0, info=None):
+    """Copied from mnefun; modified to read the stim data only once.
 
-    Also adds an event offset param, and removes all the button press stuff.
+    Also adds an event offset param, and removes all the button press stuff. Events
+    of each bit (and each STI00x channel) are found from one pass over the stim traces,
+    instead of one ``mne.find_events`` call per channel and bit mask.
     """
     # Read events
-    raw = mne.io.read_raw_fif(fname, allow_maxshield="yes", preload=False)
-    raw.pick("stim").load_data()
-    orig_events = mne.find_events(raw, stim_channel="STI101", shortest_event=0)
+    stim_data, first_samp, _ = read_stim_data(fname, info=info)
+    steps_101 = _stim_steps(stim_data["STI101"])
+    orig_events = _onset_events(steps_101, first_samp)
     events = list()
-    for ch in range(1, 9):
+    for ch, ev_101 in enumerate(_bit_onset_events(steps_101, first_samp), start=1):
         stim_channel = "STI%03d" % ch
-        ev_101 = mne.find_events(
-            raw, stim_channel="STI101", mask=2 ** (ch - 1), mask_type="and"
-        )
-        if stim_channel in raw.ch_names:
-            ev = mne.find_events(raw, stim_channel=stim_channel)
+        if stim_channel in stim_data:
+            ev = _onset_events(
+                _stim_steps(stim_data[stim_channel]), first_samp, shortest_event=2
+            )
             if not np.array_equal(ev_101[:, 0], ev[:, 0]):
                 warn("Event coding mismatch between STIM channels")
         else:
@@ -117,32 +307,14 @@ def custom_extract_expyfun_events(fname, offset=0):
     events = np.concatenate(events)
     events = events[np.argsort(events[:, 0])]
 
-    # check for the correct number of trials
+    # look at trial coding, double-check trial type (pre-1 trig)
     aud_idx = np.where(events[:, 2] == 1)[0]
-    breaks = np.concatenate(([0], aud_idx, [len(events)]))
-    # resps = []  # XXX REMOVED
-    event_nums = []
-    for ti in range(len(aud_idx)):
-        # XXX REMOVED ↓↓↓
-        # # pull out responses (they come *after* 1 trig)
-        # these = events[breaks[ti + 1] : breaks[ti + 2], :]
-        # resp = these[these[:, 2] > 8]
-        # resp = np.c_[
-        #     (resp[:, 0] - events[ti, 0]) / raw.info["sfreq"], np.log2(resp[:, 2]) - 3
-        # ]
-        # resps.append(resp if return_offsets else resp[:, 1])
-        # XXX REMOVED ↑↑↑
-
-        # look at trial coding, double-check trial type (pre-1 trig)
-        these = events[breaks[ti + 0] : breaks[ti + 1], 2]
-        serials = these[np.logical_and(these >= 4, these <= 8)]
-        # XXX CHANGED ↓↓↓
-        # en = np.sum(2 ** np.arange(len(serials))[::-1] * (serials == 8)) + 1
-        en = np.sum(2 ** np.arange(len(serials))[::-1] * (serials == 8)) + offset
-        event_nums.append(en)
+    # XXX CHANGED ↓↓↓ (trial codes now start at `offset` instead of 1)
+    _, event_nums = _decode_serial_codes(events[:, 2], aud_idx)
+    event_nums = event_nums[:-1] + offset
 
     these_events = events[aud_idx]
-    these_events[:, 2] = np.array(event_nums)
+    these_events[:, 2] = event_nums
     # XXX ADDED ↓↓↓
     bad_cabling = (
         "bad_305a_am_raw.fif",
@@ -150,17 +322,138 @@ def custom_extract_expyfun_events(fname, offset=0):
     if fname.name in bad_cabling:
         these_events[:, 2] += 2
     # XXX ADDED ↑↑↑
-    # return these_events, resps, orig_events  # XXX CHANGED
     return these_events, orig_events
 
 
+def _parse_tab_header(tab):
+    """Read the metadata (first line) of a TAB file.
+
+    Also returns whether the errant ``runfile`` metadata had to be patched.
+    """
+    with open(tab, "r") as fid:
+        header = fid.readline().lstrip("#").strip()
+    # handle errant metadata
+    runfile = "runfile" in header
+    if runfile:
+        header = re.sub('"runfile.*\'\\)"', "'1'", header)
+    metadata = json.loads(header.replace("'", '"'))
+    return metadata, runfile
+
+
+def _parse_tab_date(metadata):
+    """Get the (timezone-aware) datetime from the TAB file metadata."""
+    pattern = "%Y-%m-%d %H_%M_%S"
+    if "." in metadata["date"]:
+        pattern += ".%f"
+    return datetime.strptime(metadata["date"], pattern).replace(tzinfo=timezone(tz))
+
+
+def _decode_tab_events(tab, exp_type):
+    """Convert the expyfun trial_ids in a TAB file to (offset-free) event codes."""
+    # load the .tab file
+    tab_df = pd.read_csv(tab, comment="#", sep="\t")
+    tab_events = tab_df["value"].loc[tab_df["event"] == "trial_id"]
+    # convert pandas-unparseable values into something intelligible
+    tab_events = tab_events.map(parse_tab_values)
+    if exp_type == "am":
+        # all trials had same TTL ID of "2"
+        tab_events = np.full_like(tab_events, 2, dtype=int)
+    elif exp_type == "ids":
+        # TTL IDs ranged from 0-4
+        tab_events = tab_events.to_numpy().astype(int)
+    elif exp_type == "mmn":
+        # mapping comes from the original experiment run files (`mmn_expyfun.py`)
+        trial_id_map = {
+            "Dp01bw6-rms": 2,  # midpoint standard
+            "Dp01bw1-rms": 3,  # ba endpoint
+            "Dp01bw10-rms": 4,  # wa endpoint
+        }
+        tab_events = tab_events.map(trial_id_map).to_numpy()
+    else:
+        raise ValueError(f'Unrecognized experiment type "{exp_type}"')
+    return tab_events
+
+
+def _index_tab_file(tab, stat):
+    """Parse the metadata and events of one TAB file into a catalog row."""
+    row = dict(
+        fname=tab.name,
+        mtime_ns=stat.st_mtime_ns,
+        size=stat.st_size,
+        participant=None,
+        exp_name=None,
+        tab_date=None,
+        runfile=False,
+        tab_events=None,
+        error=None,
+    )
+    try:
+        metadata, row["runfile"] = _parse_tab_header(tab)
+        row["participant"] = metadata["participant"]
+        row["exp_name"] = metadata["exp_name"].lower()
+        row["tab_date"] = _parse_tab_date(metadata)
+        if row["exp_name"] in TAB_EXP_TYPES:
+            row["tab_events"] = _decode_tab_events(tab, TAB_EXP_TYPES[row["exp_name"]])
+    # don't let one broken file block indexing of the others; it's only an error if
+    # someone actually needs it (see `find_matching_tabs`)
+    except Exception as err:
+        row["error"] = f"{type(err).__name__}: {err}"
+    return row
+
+
+def refresh_tab_catalog():
+    """Build (or incrementally update) the catalog of expyfun TAB files.
+
+    Files whose mtime and size are unchanged since the last run are not re-read.
+    """
+    catalog = None
+    if tab_catalog_file.is_file():
+        catalog = pd.read_pickle(tab_catalog_file)
+    known = dict() if catalog is None else dict(
+        zip(catalog["fname"], zip(catalog["mtime_ns"], catalog["size"]))
+    )
+    rows = list()
+    keep = list()
+    for tab in sorted(tab_dir.glob("*.tab")):
+        stat = tab.stat()
+        if known.get(tab.name) == (stat.st_mtime_ns, stat.st_size):
+            keep.append(tab.name)
+        else:
+            rows.append(_index_tab_file(tab, stat))
+    # nothing new or changed or removed
+    if catalog is not None and not rows and len(keep) == len(catalog):
+        return catalog
+    new = pd.DataFrame(rows, columns=_tab_catalog_columns, dtype=object).astype(
+        dict(mtime_ns="int64", size="int64", runfile=bool)
+    )
+    if catalog is not None:
+        new = pd.concat(
+            (catalog.loc[catalog["fname"].isin(keep)], new), ignore_index=True
+        )
+    catalog = new.sort_values("fname", ignore_index=True)
+    tab_catalog_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = tab_catalog_file.with_suffix(f".{os.getpid()}.tmp")
+    catalog.to_pickle(tmp_file)
+    tmp_file.replace(tab_catalog_file)
+    return catalog
+
+
+@functools.lru_cache()
+def get_tab_catalog():
+    """Get the TAB file catalog (refreshed once per process)."""
+    return refresh_tab_catalog()
+
+
 def find_matching_tabs(events, subj, session, exp_type, meas_date, logfile):
     """Find the TAB file that matches each FIF, and verify the event sequences match."""
     rows = None
     # events from FIF (as parsed by `extract_expyfun_events`)
     fif_events = events[:, -1]
     # make sure subject and date matches in filename
-    candidate_tabs = sorted(tab_dir.glob(f"{subj}_{meas_date.date()}*.tab"))
+    tab_catalog = get_tab_catalog()
+    candidate_tabs = tab_catalog.loc[
+        tab_catalog["fname"].str.startswith(f"{subj}_{meas_date.date()}")
+    ]
     # get the unique events from FIF
     fif_ev_uniq, fif_ev_counts = np.unique(fif_events, return_counts=True)
     fif_ev_idx = np.argsort(fif_ev_counts)
@@ -193,29 +486,20 @@ def find_matching_tabs(events, subj, session, exp_type, meas_date, logfile):
         return row_with_na
     # find the correct .tab file
     tab_exp_types = list()
-    for tab in candidate_tabs:
-        # read the file metadata (first line of file)
-        with open(tab, "r") as fid:
-            header = fid.readline().lstrip("#").strip()
+    for tab in candidate_tabs.itertuples(index=False):
+        if tab.error is not None:
+            raise RuntimeError(f"Could not parse {tab_dir / tab.fname}: {tab.error}")
         # handle errant metadata
-        if "runfile" in header:
+        if tab.runfile:
             assert subj == "130"
-            header = re.sub('"runfile.*\'\\)"', "'1'", header)
-        metadata = json.loads(header.replace("'", '"'))
         # make sure metadata matches the experiment type we want
-        match = dict(ids="ids", tone="am", syllable="mmn")
-        tab_exp_type = metadata["exp_name"].lower()
+        tab_exp_type = tab.exp_name
         tab_exp_types.append(tab_exp_type)
-        if match[tab_exp_type] != exp_type:
+        if TAB_EXP_TYPES[tab_exp_type] != exp_type:
             continue
-        assert metadata["participant"] == subj
+        assert tab.participant == subj
         # find the timestamp diff between TAB file metadata and FIF `meas_date`
-        pattern = "%Y-%m-%d %H_%M_%S"
-        if "." in metadata["date"]:
-            pattern += ".%f"
-        tab_date = datetime.strptime(metadata["date"], pattern).replace(
-            tzinfo=timezone(tz)
-        )
+        tab_date = tab.tab_date
         time_diff = (tab_date - meas_date).total_seconds()
         # store the time diff in a pleasant string representation
         sign = "+" if np.sign(time_diff) >= 0 else "-"
@@ -224,28 +508,9 @@ def find_matching_tabs(events, subj, session, exp_type, meas_date, logfile):
             f"{int(abs(time_diff)) // 60:02d}:"  # minutes
             f"{abs(time_diff) % 60:.3f}"  # seconds & milliseconds
         )
-        # load the .tab file
-        tab_df = pd.read_csv(tab, comment="#", sep="\t")
-        # convert pandas-unparseable values into something intelligible
-        tab_df["value"] = tab_df["value"].map(parse_tab_values)
-        # convert expyfun trial_id to event code
-        tab_events = tab_df["value"].loc[tab_df["event"] == "trial_id"]
-        if exp_type == "am":
-            # all trials had same TTL ID of "2"
-            tab_events = np.full_like(tab_events, 2, dtype=int)
-        elif exp_type == "ids":
-            # TTL IDs ranged from 0-4
-            tab_events = tab_events.to_numpy().astype(int)
-        elif exp_type == "mmn":
-            # mapping comes from the original experiment run files (`mmn_expyfun.py`)
-            trial_id_map = {
-                "Dp01bw6-rms": 2,  # midpoint standard
-                "Dp01bw1-rms": 3,  # ba endpoint
-                "Dp01bw10-rms": 4,  # wa endpoint
-            }
-            tab_events = tab_events.map(trial_id_map).to_numpy()
-        else:
-            raise ValueError(f'Unrecognized experiment type "{exp_type}"')
+        # event codes were already decoded from the TAB file's trial_ids when it was
+        # indexed (copy, since they get modified in-place below)
+        tab_events = tab.tab_events.copy()
         # adjust for script bug by dropping first trial ID from TAB file
         # (corresponding change for FIF already done in `parse_mmn_events` func)
         if exp_type == "mmn" and fif_events.size == tab_events.size - 1:
@@ -277,7 +542,7 @@ def find_matching_tabs(events, subj, session, exp_type, meas_date, logfile):
                 tab_ev_counts=[tab_ev_counts],
                 tab_time=[tab_date],
                 time_diff=[time_diff_str],
-                tab_fname=[tab.name],
+                tab_fname=[tab.fname],
                 assoc=[assoc],
             )
         )
@@ -1,7 +1,7 @@
-from pathlib import Path
 import yaml
 
-root = Path("/storage/badbaby-redux").resolve()
+from utils import root
+
 indir = root / "local-data"
 outdir = root / "data"
 
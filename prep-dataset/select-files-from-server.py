@@ -1,7 +1,10 @@
 from pathlib import Path
+
+import pandas as pd
 import yaml
 
-root = Path("/storage/badbaby-redux").resolve()
+from utils import root
+
 indir = root / "server-data"
 outdir = root / "data"
 
@@ -188,6 +191,29 @@ pilots = list(
 for _file in pilots:
     _ = mapping.pop(_file)
 
+# SKIP EXACT DUPLICATES: files with the same content (per `find-duplicates.py`) as a
+# file already selected for the same target (from local-data, or earlier in this list).
+# Duplicates that would end up under *different* names are left for manual review.
+duplicates_file = Path("qc") / "fif-duplicates.csv"
+if duplicates_file.is_file():
+    duplicates = pd.read_csv(duplicates_file, index_col=False)
+    group_of = dict(zip(map(root.joinpath, duplicates["path"]), duplicates["group"]))
+    with open("files-from-local.yaml", "r") as fid:
+        from_local = yaml.load(fid, Loader=yaml.SafeLoader)
+    selected = {
+        (group_of[Path(source)], Path(target))
+        for source, target in from_local.items()
+        if Path(source) in group_of
+    }
+    for source in sorted(mapping):
+        if source not in group_of:
+            continue
+        key = (group_of[source], mapping[source])
+        if key in selected:
+            print(f"skipping duplicate: {source.relative_to(root)}")
+            _ = mapping.pop(source)
+        selected.add(key)
+
 
 # VALIDATE
 for source, target in mapping.items():
@@ -0,0 +1,214 @@
+"""Suggest bad channels ("prebads") for every raw file, for `mark-prebads.py`.
+
+Each file is read a chunk at a time (on a pool of ``--jobs`` workers), and these
+statistics are computed for each MEG channel:
+
+- variance: robust z-score of its (log) median chunk SD, among channels of its type
+- jumps: samples whose step from the previous one is ``jump_factor`` times the
+  channel's median step (flux jumps / spikes)
+- neighbour correlation: median (over chunks) of the median correlation with its
+  ``n_neighbours`` nearest same-type sensors, and its robust z-score
+- flat: the fraction of chunks with an SD below ``flat_std``
+
+Channels past the thresholds below are suggested, with the reasons, in
+``prebad-suggestions.yaml`` (laid out like ``prebads.yaml``), which `mark-prebads.py`
+preloads as bads for the annotator to confirm. All the scores are written to
+``qc/prebad-scores.csv``. The statistics are cached in ``prep-dataset/cache``, so
+changing the thresholds doesn't mean re-reading the data.
+"""
+
+import argparse
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from warnings import filterwarnings
+
+import mne
+import numpy as np
+import pandas as pd
+import yaml
+
+from utils import cached, root, stage, tasks
+
+parser = argparse.ArgumentParser(description="Suggest bad channels for mark-prebads.py")
+parser.add_argument("SUBJECTS", type=str, nargs="*", help="Subject IDs to process")
+parser.add_argument(
+    "--jobs", "-j", type=int, default=1, help="Number of files to process in parallel"
+)
+args = parser.parse_args()
+subjects_to_process = set(f"bad_{subject}" for subject in args.SUBJECTS)
+
+# config: statistics (changing these invalidates the cache)
+chunk_seconds = 10.0
+jump_factor = 30.0
+n_neighbours = 6
+flat_std = 1e-14  # same as mark-prebads.py
+stat_params = (chunk_seconds, jump_factor, n_neighbours, flat_std)
+# config: thresholds
+max_variance_z = 5.0
+min_correlation_z = -5.0
+min_jumps = 3
+min_jumps_ratio = 10.0  # (to the median of the channel type, for artifacts seen by all)
+max_flat_fraction = 0.1
+
+# path stuff
+# (next to prebads.yaml, where `mark-prebads.py` looks for them)
+suggestions_path = Path(__file__).resolve().parent / "prebad-suggestions.yaml"
+outdir = Path("qc").resolve()
+outdir.mkdir(exist_ok=True)
+scores_path = outdir / "prebad-scores.csv"
+tasks_with_erm = dict(tasks, erm="ERM")
+pattern = (
+    r"bad_(?P<sub>\d{3})(?P<ses>[abc]?)_"
+    fr"(?P<task>{'|'.join(tasks_with_erm)})_raw\.fif"
+)
+raw_files = sorted(
+    raw_file
+    for raw_file in (root / "data").glob("bad_*/raw_fif/*_raw.fif")
+    if re.fullmatch(pattern, raw_file.name)
+    and (not subjects_to_process or raw_file.parts[-3] in subjects_to_process)
+)
+
+
+def keys(raw_file):
+    """Get the (subject, session, task) keys of a file in ``prebads.yaml``."""
+    sub, ses, task = re.fullmatch(pattern, raw_file.name).groups()
+    return f"sub-{sub}", f"ses-{ses or 'c'}", tasks_with_erm[task]
+
+
+def nearest_neighbours(info, picks, ch_types):
+    """Get the indices (into ``picks``) of each channel's nearest same-type sensors."""
+    pos = np.array([info["chs"][pick]["loc"][:3] for pick in picks])
+    dist = np.linalg.norm(pos[:, np.newaxis] - pos[np.newaxis], axis=-1)
+    # not itself, nor a co-located sensor (the other gradiometer of a pair)
+    dist[(dist < 1e-3) | (ch_types[:, np.newaxis] != ch_types[np.newaxis])] = np.inf
+    return np.argsort(dist, axis=1)[:, :n_neighbours]
+
+
+def _channel_stats(raw_file):
+    """Read a raw file a chunk at a time, and get per-chunk statistics of each channel."""
+    raw = mne.io.read_raw_fif(raw_file, allow_maxshield=True, verbose=False)
+    picks = mne.pick_types(raw.info, meg=True, exclude=())
+    ch_types = np.array(raw.get_channel_types(picks=picks))
+    neighbours = nearest_neighbours(raw.info, picks, ch_types)
+    n_chunk = int(round(chunk_seconds * raw.info["sfreq"]))
+    stds, corrs = list(), list()
+    jumps = np.zeros(len(picks), int)
+    previous = np.empty((len(picks), 0))
+    for start in range(0, raw.n_times, n_chunk):
+        data = raw.get_data(picks=picks, start=start, stop=start + n_chunk)
+        # steps (including the one from the previous chunk)
+        steps = np.abs(np.diff(np.concatenate([previous, data], axis=1), axis=1))
+        median_step = np.median(steps, axis=1, keepdims=True)
+        jumps += np.sum((steps > jump_factor * median_step) & (median_step > 0), axis=1)
+        previous = data[:, -1:].copy()  # (before `data` is normalized, below)
+        if data.shape[1] < n_chunk // 2 and start:
+            break  # (too short a remainder for the other statistics)
+        data -= data.mean(axis=1, keepdims=True)
+        stds.append(data.std(axis=1))
+        # correlation with each neighbour (the median of which isn't swayed by a bad
+        # neighbour, as the correlation with an average of them would be)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            data /= np.linalg.norm(data, axis=1, keepdims=True)
+        corr = np.array([np.sum(data * data[these], axis=1) for these in neighbours.T])
+        corrs.append(np.median(np.nan_to_num(corr), axis=0))
+    return dict(
+        ch_names=[raw.ch_names[pick] for pick in picks],
+        ch_types=ch_types,
+        std=np.array(stds),
+        corr=np.array(corrs),
+        jumps=jumps,
+    )
+
+
+def channel_stats(raw_file):
+    """Get the per-chunk statistics of a file (in a worker process), via the cache."""
+    # suppress messages about IAS / MaxShield
+    filterwarnings(
+        action="ignore",
+        message="This file contains raw Internal Active Shielding data",
+        category=RuntimeWarning,
+        module="mne",
+    )
+    sub, ses, task = keys(raw_file)
+    with stage("prebad-stats", subject=sub[4:], session=ses[4:], task=task):
+        return cached("prebad-stats", raw_file, _channel_stats, params=stat_params)
+
+
+def run_files(raw_files, n_jobs):
+    """Get the statistics (serially or on a process pool), yielding them in order."""
+    if n_jobs == 1:
+        yield from map(channel_stats, raw_files)
+        return
+    # fork (not spawn) so that workers don't re-run this script's top-level code
+    mp_context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context) as pool:
+        yield from pool.map(channel_stats, raw_files)
+
+
+def robust_z(values):
+    """Z-score with the median and the (scaled) median absolute deviation."""
+    median = np.median(values)
+    mad = 1.4826 * np.median(np.abs(values - median))
+    return (values - median) / mad if mad > 0 else np.zeros_like(values)
+
+
+def score(stats):
+    """Score each channel of a file, and give the reasons to suggest it as bad."""
+    df = pd.DataFrame(dict(ch_name=stats["ch_names"], ch_type=stats["ch_types"]))
+    df["std"] = np.median(stats["std"], axis=0)
+    df["correlation"] = np.median(stats["corr"], axis=0)
+    df["jumps"] = stats["jumps"]
+    df["flat_fraction"] = np.mean(stats["std"] < flat_std, axis=0)
+    log_std = np.log10(np.maximum(df["std"], 1e-30))
+    for ch_type, rows in df.groupby("ch_type").groups.items():
+        df.loc[rows, "variance_z"] = robust_z(log_std[rows].to_numpy())
+        df.loc[rows, "correlation_z"] = robust_z(df.loc[rows, "correlation"].to_numpy())
+        df.loc[rows, "type_median_jumps"] = df.loc[rows, "jumps"].median()
+    reasons = list()
+    for row in df.itertuples():
+        why = list()
+        if row.flat_fraction >= max_flat_fraction:
+            why.append(f"flat {row.flat_fraction:.0%} of the time")
+        if abs(row.variance_z) >= max_variance_z:
+            why.append(f"variance z={row.variance_z:.1f}")
+        if row.correlation_z <= min_correlation_z:
+            why.append(
+                f"neighbour correlation {row.correlation:.2f} (z={row.correlation_z:.1f})"
+            )
+        if row.jumps >= max(min_jumps, min_jumps_ratio * row.type_median_jumps):
+            why.append(f"{row.jumps} jumps")
+        reasons.append("; ".join(why))
+    df["reasons"] = reasons
+    df["suggested"] = df["reasons"] != ""
+    return df.drop(columns="type_median_jumps")
+
+
+print(f"Computing channel statistics of {len(raw_files)} files")
+suggestions = dict()
+if suggestions_path.is_file():
+    with open(suggestions_path) as fid:
+        suggestions = yaml.safe_load(fid) or dict()
+scores = list()
+for raw_file, stats in zip(raw_files, run_files(raw_files, n_jobs=args.jobs)):
+    sub, ses, task = keys(raw_file)
+    df = score(stats)
+    suggested = df[df["suggested"]]
+    suggestions.setdefault(sub, dict()).setdefault(ses, dict())[task] = dict(
+        zip(suggested["ch_name"], suggested["reasons"])
+    )
+    df.insert(0, "file", raw_file.name)
+    scores.append(df)
+    print(f"{raw_file.name}: {len(suggested)} suggested {list(suggested['ch_name'])}")
+
+# write the suggestions (keeping those of files not processed this time)
+with open(suggestions_path, "w") as fid:
+    yaml.safe_dump(suggestions, fid, default_flow_style=False)
+if scores_path.is_file():
+    done = {raw_file.name for raw_file in raw_files}
+    old_scores = pd.read_csv(scores_path)
+    scores.insert(0, old_scores[~old_scores["file"].isin(done)])
+if scores:
+    scores = pd.concat(scores, ignore_index=True).sort_values(["file", "ch_name"])
+    scores.to_csv(scores_path, index=False)
@@ -0,0 +1,80 @@
+"""Summarize the per-stage timings recorded with ``$BADBABY_PROFILE``.
+
+Run e.g. ``BADBABY_PROFILE=qc/profile.jsonl python bidsify.py --jobs 8`` (and/or
+``rescale-coreg.py``, ``check-dev-head-t.py``), then ``python summarize-profile.py
+qc/profile.jsonl`` to see which stages (and which subjects) the time goes to.
+"""
+
+import argparse
+from pathlib import Path
+
+import pandas as pd
+
+parser = argparse.ArgumentParser(description="Summarize per-stage timings")
+parser.add_argument("PROFILE", type=Path, help="JSON-lines file from $BADBABY_PROFILE")
+parser.add_argument(
+    "--top", type=int, default=10, help="How many of the slowest to list"
+)
+parser.add_argument("--script", help="Only summarize the stages of this script")
+parser.add_argument(
+    "--csv", type=Path, help="Also write the per-stage summary to this CSV file"
+)
+args = parser.parse_args()
+
+df = pd.read_json(args.PROFILE, lines=True, dtype=dict(subject=str, session=str))
+if args.script:
+    df = df[df["script"] == args.script]
+if df.empty:
+    raise SystemExit(f"No stages recorded in {args.PROFILE}")
+for key in ("subject", "session", "task"):
+    if key not in df:
+        df[key] = None
+df["unit"] = (
+    df["subject"].fillna("?").astype(str)
+    + df["session"].fillna("").astype(str)
+    + df["task"].fillna("").map(lambda task: f" {task}" if task else "")
+)
+pd.set_option("display.width", 120)
+pd.set_option("display.max_columns", None)
+
+# per stage: where the time goes overall, and how variable it is
+stages = df.groupby(["script", "stage"]).agg(
+    n=("wall", "size"),
+    total_wall=("wall", "sum"),
+    median_wall=("wall", "median"),
+    max_wall=("wall", "max"),
+    total_cpu=("cpu", "sum"),
+    max_rss_mb=("peak_rss_mb", "max"),
+    n_failed=("failed", "sum"),
+)
+stages["share"] = stages["total_wall"] / stages["total_wall"].sum()
+# CPU / wall well below 1 means waiting (on I/O, or on a lock)
+stages["cpu_per_wall"] = stages["total_cpu"] / stages["total_wall"]
+stages.sort_values("total_wall", ascending=False, inplace=True)
+print(f"{len(df)} stages from {args.PROFILE}\n\nBy stage:")
+print(stages.round(3).to_string())
+
+print(f"\nSlowest {args.top} stages:")
+slowest = df.nlargest(args.top, "wall")
+print(
+    slowest[["unit", "script", "stage", "wall", "cpu", "peak_rss_mb"]]
+    .round(3)
+    .to_string(index=False)
+)
+
+print(f"\nSlowest {args.top} subjects (all stages):")
+by_subject = df.groupby(["subject", "session"], dropna=False).agg(
+    total_wall=("wall", "sum"),
+    max_rss_mb=("peak_rss_mb", "max"),
+    slowest_stage=("wall", lambda wall: df.loc[wall.idxmax(), "stage"]),
+)
+print(by_subject.nlargest(args.top, "total_wall").round(3).to_string())
+
+print(f"\nMost memory-hungry {args.top} stages:")
+print(
+    df.nlargest(args.top, "peak_rss_mb")[["unit", "script", "stage", "peak_rss_mb"]]
+    .to_string(index=False)
+)
+
+if args.csv:
+    stages.to_csv(args.csv)
@@ -0,0 +1,481 @@
+"""Write a small synthetic cohort with the layout of the badbaby data.
+
+Each subject folder gets ``data/bad_NNN{a,b}/raw_fif/bad_NNN{a,b}_{am,ids,mmn,erm}_raw.fif``
+with Neuromag-style channels, expyfun trigger sequences on STI101 (and STI001-STI008),
+HPI fit results, and digitization points. Each experimental recording gets a matching
+``expyfun-logs/*.tab`` file. The channels listed in ``prebads.yaml`` really are bad
+(flat, noisy, jumpy, or missing the environmental noise of their neighbours). Some
+subject folders have no ERM; ERMs recorded the day after those sessions go in
+``extra-data`` (so there are surrogates to find). With ``--anat``, there's also a
+(tiny) scaled MRI per subject folder, plus the calibration and metadata files that
+bidsify.py reads.
+
+Point the prep-dataset scripts at the result with ``BADBABY_ROOT=<root>`` (see
+`benchmark.py`). Usage: ``python synthetic.py ROOT [--subjects N] [--anat]``.
+"""
+
+import argparse
+import json
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+
+import mne
+import numpy as np
+import yaml
+from mne._fiff.write import start_and_end_file
+from mne.io.constants import FIFF
+from mne.transforms import Transform, apply_trans, rotation, translation
+from pytz import timezone
+
+from inventory import KINDS
+from score import TAB_EXP_TYPES, tz
+from utils import tasks
+
+first_date = datetime(2015, 10, 5)
+session_offsets = dict(a=timedelta(0), b=timedelta(days=120))  # ~2 and ~6 months old
+# local start time of each recording (ERM first)
+start_times = dict(erm=(9, 30), am=(10, 0), ids=(10, 25), mmn=(10, 50))
+missing_erm_every = 3  # every Nth subject folder has no ERM of its own
+trigger_seconds = 0.01  # expyfun's default trigger duration
+bit_gap_seconds = 0.03  # onset-to-onset of the serial trial ID bits
+# trial ID bits, and stimulus onset asynchrony (seconds), of each experiment
+n_bits = dict(am=2, ids=3, mmn=3)
+soa_range = dict(am=(1.0, 2.5), ids=(2.0, 3.0), mmn=(0.6, 0.7))
+mmn_stims = {2: "Dp01bw6-rms", 3: "Dp01bw1-rms", 4: "Dp01bw10-rms"}
+bad_channel_kinds = ("flat", "noisy", "jumpy", "uncorrelated")
+hpi_freqs = (83.0, 143.0, 203.0, 263.0, 323.0)  # Hz
+# coil positions (head coords, m) and digitized fiducials (LPA, nasion, RPA)
+hpi_head = np.array(
+    [[-0.03, 0.06, 0.03], [0.03, 0.06, 0.03], [-0.06, -0.01, 0.04],
+     [0.06, -0.01, 0.04], [0.0, -0.02, 0.08]]
+)
+fiducials = np.array([[-0.055, 0.0, 0.0], [0.0, 0.075, 0.0], [0.055, 0.0, 0.0]])
+
+
+def sensor_array(n_sensors):
+    """Place sensor triplets (1 MAG, 2 planar GRADs) on a helmet-like hemisphere.
+
+    Returns channel names, types, and ``loc`` arrays (in Neuromag channel order).
+    """
+    # Fibonacci lattice on the upper hemisphere, 12 cm radius (device coords)
+    ix = np.arange(n_sensors) + 0.5
+    elevation = np.arcsin(ix / n_sensors)
+    azimuth = np.pi * (1 + 5**0.5) * ix
+    normal = np.c_[
+        np.cos(elevation) * np.cos(azimuth),
+        np.cos(elevation) * np.sin(azimuth),
+        np.sin(elevation),
+    ]
+    names, types, locs = list(), list(), list()
+    for si, ez in enumerate(normal):
+        ex = np.cross([0.0, 0.0, 1.0], ez) if abs(ez[2]) < 0.999 else np.r_[1.0, 0, 0]
+        ex /= np.linalg.norm(ex)
+        ey = np.cross(ez, ex)
+        r0 = 0.12 * ez + [0, 0, 0.04]
+        for suffix, kind, (e1, e2) in (
+            ("3", "grad", (ex, ey)),
+            ("2", "grad", (ey, -ex)),
+            ("1", "mag", (ex, ey)),
+        ):
+            names.append(f"MEG{si + 1:03d}{suffix}")
+            types.append(kind)
+            locs.append(np.r_[r0, e1, e2, ez])
+    return names, types, locs
+
+
+def neuromag_info(meas_date, sfreq, n_sensors, rng, with_hpi=True):
+    """Make the measurement info of one recording.
+
+    Includes STI001-STI008 and STI101 (plus STI201, where the HPI on/off bits go), and
+    (unless ``with_hpi=False``, as for ERMs) digitized fiducials, HPI coils, and head
+    shape points, a dev_head_t, and HPI fit results like the acquisition software's.
+    """
+    names, types, locs = sensor_array(n_sensors)
+    stim_names = [f"STI{bit:03d}" for bit in range(1, 9)] + ["STI101", "STI201"]
+    info = mne.create_info(names + stim_names, sfreq, types + ["stim"] * len(stim_names))
+    with info._unlock():
+        for ch, loc in zip(info["chs"], locs):
+            ch["loc"][:] = loc
+        info["meas_date"] = meas_date
+        info["line_freq"] = 60.0
+        info["experimenter"] = "synthetic"
+        info["hpi_subsystem"] = dict(
+            ncoil=len(hpi_freqs),
+            event_channel="STI201",
+            hpi_coils=[
+                dict(event_bits=np.array([256 * 2**ci, 0, 256 * 2**ci, 256 * 2**ci]))
+                for ci in range(len(hpi_freqs))
+            ],
+        )
+    if not with_hpi:
+        return info
+    # digitization (with some between-session variability)
+    montage = mne.channels.make_dig_montage(
+        lpa=fiducials[0] + rng.normal(0, 0.002, 3),
+        nasion=fiducials[1] + rng.normal(0, 0.002, 3),
+        rpa=fiducials[2] + rng.normal(0, 0.002, 3),
+        hpi=hpi_head + rng.normal(0, 0.001, hpi_head.shape),
+        hsp=head_shape(rng),
+        coord_frame="head",
+    )
+    info.set_montage(montage)
+    # infant heads sit low and a bit forward in the adult-sized helmet
+    dev_head_t = translation(*rng.normal([0.0, -0.01, -0.06], 0.01)) @ rotation(
+        *np.deg2rad(rng.normal(0, 5, 3))
+    )
+    hpi_dig = sorted(
+        (dig for dig in info["dig"] if dig["kind"] == FIFF.FIFFV_POINT_HPI),
+        key=lambda dig: dig["ident"],
+    )
+    hpi_dev = apply_trans(
+        np.linalg.inv(dev_head_t), np.array([dig["r"] for dig in hpi_dig])
+    ) + rng.normal(0, 0.0005, (len(hpi_dig), 3))
+    order = np.arange(1, len(hpi_dig) + 1)
+    # the acquisition software doesn't reliably order the 2 coils not used for the fit
+    if rng.random() < 0.2:
+        order[[3, 4]] = order[[4, 3]]
+        hpi_dev[[3, 4]] = hpi_dev[[4, 3]]
+    n_meg = len(names)
+    with info._unlock():
+        info["dev_head_t"] = Transform("meg", "head", dev_head_t)
+        info["hpi_results"] = [
+            dict(
+                dig_points=[
+                    dict(
+                        kind=FIFF.FIFFV_POINT_HPI,
+                        ident=ci + 1,
+                        r=r,
+                        coord_frame=FIFF.FIFFV_COORD_UNKNOWN,
+                    )
+                    for ci, r in enumerate(hpi_dev)
+                ],
+                order=order,
+                used=np.arange(1, len(hpi_dig) + 1),
+                moments=rng.normal(0, 1e-8, (len(hpi_dig), 3)),
+                goodness=rng.uniform(0.985, 0.999, len(hpi_dig)),
+                good_limit=0.98,
+                dist_limit=0.005,
+                accept=1,
+                coord_trans=Transform("meg", "head", dev_head_t),
+            )
+        ]
+        info["hpi_meas"] = [
+            dict(
+                creator="synthetic",
+                sfreq=sfreq,
+                nchan=n_meg,
+                nave=1,
+                ncoil=len(hpi_freqs),
+                first_samp=0,
+                last_samp=int(sfreq) - 1,
+                hpi_coils=[
+                    dict(
+                        number=ci + 1,
+                        epoch=np.zeros((n_meg, 1)),
+                        # (only used when refitting coil locations)
+                        slopes=rng.normal(0, 1e-12, n_meg),
+                        corr_coeff=rng.uniform(0.98, 1.0, n_meg),
+                        coil_freq=freq,
+                    )
+                    for ci, freq in enumerate(hpi_freqs)
+                ],
+            )
+        ]
+    return info
+
+
+def head_shape(rng, n_points=60):
+    """Digitize some points on an infant-sized (upper) head surface."""
+    direction = rng.normal(0, 1, (n_points, 3))
+    direction[:, 2] = np.abs(direction[:, 2])
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    return direction * [0.06, 0.07, 0.065] + [0, 0.005, 0.01]
+
+
+def trigger_sequence(task, n_times, sfreq, rng):
+    """Make the expyfun trigger sequence of one recording.
+
+    Each trial's ID is stamped as serial bits (4 → 0, 8 → 1, most significant first),
+    then a 1 marks the stimulus onset. In the MMN experiment, the bits came *after*
+    the onset (preceded by one extra trial ID), which the TAB file also logs.
+
+    Returns the trigger onsets (samples), their values, and the logged trial IDs.
+    """
+    lead_in, lead_out = 2.0, 1.0
+    soa = soa_range[task]
+    onsets = list()
+    t = lead_in
+    while t < n_times / sfreq - lead_out - soa[1]:
+        onsets.append(t)
+        t += rng.uniform(*soa)
+    n_trials = len(onsets)
+    if task == "am":
+        trial_ids = np.full(n_trials, 2)
+    elif task == "ids":
+        trial_ids = rng.integers(0, 5, n_trials)
+    else:
+        trial_ids = rng.choice(list(mmn_stims), n_trials, p=[0.8, 0.1, 0.1])
+    times, values = list(), list()
+
+    def stamp(start, trial_id):
+        bits = np.binary_repr(trial_id, n_bits[task])
+        for bi, bit in enumerate(bits):
+            times.append(start + bi * bit_gap_seconds)
+            values.append(8 if bit == "1" else 4)
+
+    bits_seconds = n_bits[task] * bit_gap_seconds
+    if task == "mmn":
+        logged = np.r_[trial_ids[:1], trial_ids]  # the extra trial ID
+        stamp(onsets[0] - bits_seconds - 0.1, logged[0])
+        for onset, trial_id in zip(onsets, trial_ids):
+            times.append(onset)
+            values.append(1)
+            stamp(onset + 0.05, trial_id)
+    else:
+        logged = trial_ids
+        for onset, trial_id in zip(onsets, trial_ids):
+            stamp(onset - bits_seconds - 0.02, trial_id)
+            times.append(onset)
+            values.append(1)
+    samples = np.round(np.array(times) * sfreq).astype(int)
+    return samples, np.array(values), logged
+
+
+def stim_traces(samples, values, n_times, sfreq):
+    """Render trigger onsets on STI101 and (as 5 V pulses) on the STI00x channels."""
+    n_on = max(int(round(trigger_seconds * sfreq)), 1)
+    sti101 = np.zeros(n_times)
+    for sample, value in zip(samples, values):
+        sti101[sample : sample + n_on] = value
+    bits = sti101.astype(int)[np.newaxis] >> np.arange(8)[:, np.newaxis] & 1
+    return np.r_[5.0 * bits, sti101[np.newaxis]]
+
+
+def write_recording(fname, task, meas_date, seconds, sfreq, n_sensors, rng, bads=()):
+    """Write one raw FIF file. Returns the logged trial IDs (``None`` for ERMs).
+
+    The ``bads`` channels are each made bad in one of the ``bad_channel_kinds`` ways.
+    """
+    info = neuromag_info(meas_date, sfreq, n_sensors, rng, with_hpi=task != "erm")
+    n_times = int(round(seconds * sfreq))
+    picks = mne.pick_types(info, meg=True)
+    data = np.zeros((len(info["ch_names"]), n_times))
+    # sensor noise (with session-specific level), plus line noise
+    scale = np.where(
+        np.array(info.get_channel_types(picks)) == "mag", 1e-13, 2e-12
+    ) * rng.uniform(0.7, 1.5)
+    times = np.arange(n_times) / sfreq
+    data[picks] = rng.normal(0, 1, (len(picks), n_times)) * scale[:, np.newaxis]
+    line_noise = np.sin(2 * np.pi * 60 * times)
+    data[picks] += np.outer(scale * rng.uniform(1, 5), line_noise)
+    for name in bads:
+        ix = info["ch_names"].index(name)
+        this_scale = scale[np.flatnonzero(picks == ix)[0]]
+        kind = rng.choice(bad_channel_kinds)
+        if kind == "flat":
+            data[ix] = 0.0
+        elif kind == "noisy":
+            data[ix] *= 10
+        elif kind == "jumpy":  # flux jumps (steps)
+            for sample in rng.integers(0, n_times, rng.integers(3, 7)):
+                data[ix, sample:] += rng.choice([-1, 1]) * 50 * this_scale
+        else:
+            data[ix] = rng.normal(0, 1, n_times) * this_scale
+    trial_ids = None
+    if task != "erm":
+        samples, values, trial_ids = trigger_sequence(task, n_times, sfreq, rng)
+        stim_names = [f"STI{bit:03d}" for bit in range(1, 9)] + ["STI101"]
+        stim_picks = [info["ch_names"].index(name) for name in stim_names]
+        data[stim_picks] = stim_traces(samples, values, n_times, sfreq)
+    raw = mne.io.RawArray(data, info, verbose=False)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    raw.save(fname, overwrite=True, verbose=False)
+    return trial_ids
+
+
+def write_tab(tab_dir, participant, task, start, trial_ids):
+    """Write the expyfun log (TAB file) of one experimental recording."""
+    exp_name = {code: name for name, code in TAB_EXP_TYPES.items()}[task]
+    date = start.strftime("%Y-%m-%d %H_%M_%S.%f")
+    metadata = dict(
+        participant=participant,
+        session="1",
+        exp_name=exp_name.capitalize(),
+        date=date,
+        version="synthetic",
+    )
+    lines = ["#" + json.dumps(metadata).replace('"', "'"), "timestamp\tevent\tvalue"]
+    t = 5.0
+    for trial_id in trial_ids:
+        value = f"['{mmn_stims[trial_id]}']" if task == "mmn" else f"[{trial_id}]"
+        lines.append(f"{t:.6f}\ttrial_id\t{value}")
+        lines.append(f"{t + 0.01:.6f}\tplay\t[nan]")
+        lines.append(f"{t + 0.5:.6f}\ttrial_ok\t[nan]")
+        t += 1.0
+    tab_dir.mkdir(parents=True, exist_ok=True)
+    (tab_dir / f"{participant}_{date}.tab").write_text("\n".join(lines) + "\n")
+
+
+def write_anat(anat_dir, full_subj):
+    """Write a tiny stand-in for a scaled MRI: T1, trans, and source space."""
+    import nibabel as nib
+
+    mri_dir = anat_dir / full_subj / "mri"
+    mri_dir.mkdir(parents=True, exist_ok=True)
+    # 4 mm voxels, conformed (LIA) orientation, with an ellipsoid "head"
+    shape = (64, 64, 64)
+    affine = np.array(
+        [[-4.0, 0, 0, 128], [0, 0, 4.0, -128], [0, -4.0, 0, 128], [0, 0, 0, 1]]
+    )
+    ijk = np.indices(shape).reshape(3, -1).T
+    xyz = nib.affines.apply_affine(affine, ijk)
+    inside = np.sum((xyz / [60, 70, 65]) ** 2, axis=1) < 1
+    t1 = np.where(inside, 110, 0).reshape(shape).astype(np.uint8)
+    nib.save(nib.MGHImage(t1, affine), mri_dir / "T1.mgz")
+    # (the digitized head and the MRI are already aligned)
+    mne.write_trans(
+        anat_dir / full_subj / f"{full_subj}_trans.fif",
+        Transform("head", "mri", np.eye(4)),
+        overwrite=True,
+    )
+    src = mne.setup_volume_source_space(
+        pos=15.0, sphere=(0.0, 0.0, 0.0, 0.05), sphere_units="m", verbose=False
+    )
+    (anat_dir / full_subj / "bem").mkdir(exist_ok=True)
+    mne.write_source_spaces(
+        anat_dir / full_subj / "bem" / f"{full_subj}-oct-6-src.fif",
+        src,
+        overwrite=True,
+        verbose=False,
+    )
+
+
+def write_calibration(cal_dir, n_sensors):
+    """Write stand-ins for the fine-calibration and crosstalk files."""
+    names, _, locs = sensor_array(n_sensors)
+    cal_dir.mkdir(parents=True, exist_ok=True)
+    mne.preprocessing.write_fine_calibration(
+        cal_dir / "sss_cal.dat",
+        dict(ch_names=names, locs=locs, imb_cals=[np.ones(1)] * len(names)),
+    )
+    # bidsify.py only copies this one, so an empty FIF will do
+    with start_and_end_file(cal_dir / "ct_sparse.fif"):
+        pass
+
+
+def write_cohort(
+    root,
+    n_subjects=3,
+    sessions="ab",
+    kinds=KINDS,
+    seconds=30.0,
+    sfreq=1000.0,
+    n_sensors=102,
+    anat=False,
+    seed=0,
+):
+    """Write a synthetic cohort under ``root`` (see the module docstring).
+
+    Returns the raw files written, in order.
+    """
+    root = Path(root)
+    rng = np.random.default_rng(seed)
+    local_tz = timezone(tz)
+    fnames = list()
+    prebads = dict()
+    for si in range(n_subjects):
+        subj = str(101 + si)
+        for session in sessions:
+            full_subj = f"bad_{subj}{session}"
+            day = first_date + timedelta(weeks=si) + session_offsets[session]
+            folder = root / "data" / full_subj / "raw_fif"
+            folder_index = si * len(sessions) + sessions.index(session)
+            has_erm = folder_index % missing_erm_every != missing_erm_every - 1
+            has_recordings = False
+            # a couple of bad channels per recording
+            names = sensor_array(n_sensors)[0]
+            session_bads = {
+                name: sorted(rng.choice(names, 2, replace=False).tolist())
+                for name in [*tasks.values(), "ERM"]
+            }
+            prebads.setdefault(f"sub-{subj}", dict())[f"ses-{session}"] = session_bads
+            for task in sorted(kinds, key=lambda kind: start_times[kind]):
+                start = local_tz.localize(day.replace(hour=start_times[task][0]))
+                start += timedelta(minutes=start_times[task][1])
+                meas_date = start.astimezone(UTC)
+                if task == "erm" and not has_erm:
+                    # an ERM from a concurrent project, the next day
+                    fname = root / "extra-data" / f"extra_{day:%y%m%d}_erm_raw.fif"
+                    meas_date += timedelta(days=1)
+                else:
+                    fname = folder / f"{full_subj}_{task}_raw.fif"
+                bads = session_bads[tasks.get(task, "ERM")]
+                trial_ids = write_recording(
+                    fname, task, meas_date, seconds, sfreq, n_sensors, rng, bads
+                )
+                fnames.append(fname)
+                if trial_ids is not None:
+                    # expyfun starts logging a bit before the acquisition does
+                    tab_start = start - timedelta(seconds=rng.uniform(5, 30))
+                    write_tab(root / "expyfun-logs", subj, task, tab_start, trial_ids)
+                    has_recordings = True
+            if anat and has_recordings:
+                write_anat(root / "anat", full_subj)
+    # the metadata and configuration that the scripts expect to find
+    (root / "extra-data").mkdir(parents=True, exist_ok=True)
+    prep_dir = root / "prep-dataset"
+    (prep_dir / "qc").mkdir(parents=True, exist_ok=True)
+    (prep_dir / "bad-files.yaml").write_text("[]\n")
+    (prep_dir / "refit-options.yml").write_text("{}\n")
+    with open(prep_dir / "prebads.yaml", "w") as fid:
+        yaml.safe_dump(prebads, fid)
+    # (as if `make-hardlinks.py` had linked the files in ./data from ./local-data)
+    data_dir = root.resolve() / "data"
+    mapping = {
+        str(root.resolve() / "local-data" / fname.relative_to(data_dir)): str(fname)
+        for fname in sorted(data_dir.rglob("*_raw.fif"))
+    }
+    with open(prep_dir / "files-from-local.yaml", "w") as fid:
+        yaml.safe_dump(mapping, fid)
+    (prep_dir / "files-from-server.yaml").write_text("{}\n")
+    (root / "metadata").mkdir(exist_ok=True)
+    (root / "metadata" / "daysback.yaml").write_text("40000\n")
+    if anat:
+        write_calibration(root / "calibration", n_sensors)
+    return fnames
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic badbaby cohort")
+    parser.add_argument("root", type=Path, help="Where to write it")
+    parser.add_argument("--subjects", type=int, default=3, help="Number of subjects")
+    parser.add_argument(
+        "--sessions", default="ab", help="Sessions (subject folder suffixes)"
+    )
+    parser.add_argument(
+        "--kinds", nargs="+", default=KINDS, choices=KINDS, help="Recordings to write"
+    )
+    parser.add_argument(
+        "--seconds", type=float, default=30.0, help="Duration of each recording"
+    )
+    parser.add_argument("--sfreq", type=float, default=1000.0, help="Sampling rate")
+    parser.add_argument(
+        "--sensors", type=int, default=102, help="Number of MAG/GRAD/GRAD triplets"
+    )
+    parser.add_argument(
+        "--anat", action="store_true", help="Also write MRIs and calibration files"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    fnames = write_cohort(
+        args.root,
+        n_subjects=args.subjects,
+        sessions=args.sessions,
+        kinds=args.kinds,
+        seconds=args.seconds,
+        sfreq=args.sfreq,
+        n_sensors=args.sensors,
+        anat=args.anat,
+        seed=args.seed,
+    )
+    print(f"wrote {len(fnames)} raw files under {args.root}")
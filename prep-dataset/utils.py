@@ -1,25 +1,401 @@
-import functools
-from subprocess import check_call, check_output
-
-
-@functools.lru_cache()
-def _get_cp_args():
-    output = check_output(["cp", "--version"]).decode("utf-8")
-    ver = float(output.splitlines()[0].split()[-1])  # e.g., 9.8
-    if ver < 9:
-        return ["--no-clobber"]
-    else:
-        return ["--update=none"]
-
-
-def hardlink(source, target, dry_run=True):
-    """Create target dirs, then hardlink."""
-    target.parent.mkdir(parents=True, exist_ok=True)
-    # even with sudo `--preserve=all` doesn't work, so chown too
-    # Need to triage
-    cmd = ["cp", "-l"] + _get_cp_args() + [str(source), str(target)]
-    if not dry_run:
-        check_call(cmd)
+import grp
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import pickle
+import resource
+import socket
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+import mne
+from mne.io import read_info
+
+# where the data live ($BADBABY_ROOT points the scripts at another tree, e.g. a
+# synthetic cohort from `synthetic.py`)
+root = Path(os.environ.get("BADBABY_ROOT", "/storage/badbaby-redux")).resolve()
+# on-disk caches shared by the prep-dataset scripts (safe to delete at any time)
+cache_dir = Path(
+    os.environ.get("BADBABY_CACHE", Path(__file__).resolve().parent / "cache")
+).resolve()
+# opt-in per-stage timing: `stage` appends JSON lines to this file (if set), for
+# `summarize-profile.py`
+profile_file = os.environ.get("BADBABY_PROFILE")
+preview_sfreq = 80  # Hz (equiv to 40 Hz lowpass), for `make-previews.py`
+# `refit_hpi` kwargs that refit-options.yml entries override
+refit_hpi_defaults = dict(
+    locs=False, amplitudes=False, dist_limit=0.01, colinearity_limit=0.01
+)
+
+
+def _peak_rss():
+    """Get the peak RSS (in kB) of this process since the last `_reset_peak_rss`."""
+    try:
+        with open("/proc/self/status") as fid:
+            for line in fid:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # (not resettable: the peak over the lifetime of the process; kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as fid:
+            fid.write("5")
+    except OSError:
+        pass
+
+
+# the peak RSS seen so far in each open `stage` (outermost first)
+_open_stages = list()
+
+
+@contextmanager
+def stage(name, **labels):
+    """Time a named processing stage (a no-op unless ``$BADBABY_PROFILE`` is set).
+
+    Appends one JSON line per stage to ``$BADBABY_PROFILE``, with the ``labels`` (e.g.
+    subject, session, task), the wall and CPU seconds, and the peak RSS during the
+    stage (in MB). Stages can be nested; the peak of a stage includes its children's.
+    """
+    if not profile_file:
+        yield
+        return
+    if _open_stages:  # the peak so far belongs to the enclosing stage
+        _open_stages[-1] = max(_open_stages[-1], _peak_rss())
+    _reset_peak_rss()
+    _open_stages.append(0)
+    start = datetime.now()
+    wall, cpu = time.perf_counter(), time.process_time()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        peak = max(_open_stages.pop(), _peak_rss())
+        if _open_stages:
+            _open_stages[-1] = max(_open_stages[-1], peak)
+        record = dict(
+            script=Path(sys.argv[0]).name,
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            **labels,
+            stage=name,
+            start=start.isoformat(timespec="milliseconds"),
+            wall=round(wall, 4),
+            cpu=round(cpu, 4),
+            peak_rss_mb=round(peak / 1024, 1),
+            failed=failed,
+        )
+        # one short write per line in append mode, so workers don't interleave lines
+        with open(profile_file, "a") as fid:
+            fid.write(json.dumps(record, default=str) + "\n")
+
+
+def _link(source, target, dry_run, replace=False):
+    """Hardlink one file (replacing another file only if asked); say what happened."""
+    try:
+        if dry_run:
+            if target.exists():
+                raise FileExistsError(target)
+        else:
+            os.link(source, target)
+        return "created"
+    except FileExistsError:
+        if target.samefile(source):
+            return "identical"
+        if not replace:
+            return "conflict"
+        if not dry_run:
+            # link next to the target, then swap it in (so it never goes missing)
+            tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+            tmp.unlink(missing_ok=True)
+            os.link(source, tmp)
+            os.replace(tmp, target)
+        return "replaced"
+
+
+def link_files(links, group=None, n_jobs=8, dry_run=False, replace=False):
+    """Hardlink many files at once: create target dirs, then link on a thread pool.
+
+    ``links`` are ``(source, target)`` pairs, e.g. ``mapping.items()``. When a target
+    exists (or appears more than once in ``links``, in which case the first source
+    wins) it's ``"identical"`` if it is the same file as the source. Otherwise it's a
+    ``"conflict"`` and left alone, unless ``replace`` is set, in which case it's
+    ``"replaced"`` by a link to the (first) source. If ``group`` is given, the dirs and
+    links created are given that group ownership.
+
+    Returns a dict of lists of ``(source, target)`` pairs (in ``links`` order) for
+    each of ``"created"``, ``"replaced"``, ``"identical"``, and ``"conflict"``, plus
+    the list of ``"created_dirs"``.
+    """
+    items = [(Path(source), Path(target)) for source, target in links]
+    result = dict(
+        created=list(),
+        replaced=list(),
+        identical=list(),
+        conflict=list(),
+        created_dirs=list(),
+    )
+    # make the target dirs first (serially, parents first)
+    for parent in sorted({target.parent for _, target in items}):
+        missing = [path for path in (parent, *parent.parents) if not path.is_dir()]
+        for path in reversed(missing):
+            if path not in result["created_dirs"]:
+                if not dry_run:
+                    path.mkdir(exist_ok=True)
+                result["created_dirs"].append(path)
+    # link the first source of each target, then check any later ones against it
+    first = dict()
+    for source, target in items:
+        first.setdefault(target, source)
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        outcome = dict(
+            zip(
+                first.items(),
+                pool.map(
+                    lambda item: _link(item[1], item[0], dry_run, replace),
+                    first.items(),
+                ),
+            )
+        )
+    for source, target in items:
+        if (target, source) in outcome:
+            result[outcome[target, source]].append((source, target))
+        elif dry_run and outcome[target, first[target]] in ("created", "replaced"):
+            result[_link(source, first[target], dry_run=True)].append((source, target))
+        else:
+            result[_link(source, target, dry_run)].append((source, target))
+    if group is not None and not dry_run:
+        gid = grp.getgrnam(group).gr_gid
+        for path in result["created_dirs"]:
+            os.chown(path, -1, gid)
+        for _, target in result["created"] + result["replaced"]:
+            os.chown(target, -1, gid)
+    return result
+
+
+def surrogate_erm_links(surrogates, hardlinked, recipients=()):
+    """Plan the links of `link-surrogate-erms.py`, as ``(source, target)`` pairs.
+
+    ``surrogates`` is the table from ``qc/erm-surrogates.csv``, and ``hardlinked`` the
+    targets of `make-hardlinks.py`. Only those ERMs count as a recipient's own (not
+    surrogates linked by an earlier run), so a rerun plans the same targets. If
+    ``recipients`` are given, only their rows are planned.
+    """
+    data_dir = root / "data"
+    hardlinked = set(map(str, hardlinked))
+    n_dates = surrogates.groupby("recipient")["date"].nunique()
+    links = list()
+    for _, row in surrogates.iterrows():
+        recip = row["recipient"]
+        if recipients and str(recip) not in recipients:
+            continue
+        donor_file = row["donor"]
+        if donor_file.startswith("bad_"):
+            donor = "_".join(donor_file.split("_")[:2])
+            source = data_dir / donor / "raw_fif" / donor_file
+        else:
+            source = root / "extra-data" / donor_file
+        target_dir = data_dir / f"bad_{recip}" / "raw_fif"
+        # (counting the ERMs we're about to link there)
+        already_has_erm = any(
+            str(path) in hardlinked for path in target_dir.glob("*erm_raw.fif")
+        ) or any(target.parent == target_dir for _, target in links)
+        if already_has_erm or n_dates[recip] > 1:
+            target = target_dir / f"bad_{recip}_{row['exp']}_erm_raw.fif"
+        else:
+            target = target_dir / f"bad_{recip}_erm_raw.fif"
+        links.append((source, target))
+    return links
+
+
+def file_key(fname):
+    """Identify a file on disk by its path, inode, size, and mtime."""
+    fname = Path(fname).resolve()
+    stat = fname.stat()
+    return (str(fname), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _cache_path(kind, key):
+    """Get the cache file for a given (path-based) key."""
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+    return cache_dir / kind / f"{digest}.pkl"
+
+
+def cached(kind, fname, compute, params=()):
+    """Get ``compute(fname)`` for a file, via an on-disk cache.
+
+    Entries are keyed by path, inode, size, and mtime (plus any ``params`` that
+    ``compute`` depends on), so replacing or re-linking a file invalidates its entry.
+    """
+    path, *identity = file_key(fname)
+    identity += list(params)
+    cache_file = _cache_path(kind, path)
+    if cache_file.is_file():
+        with open(cache_file, "rb") as fid:
+            entry = pickle.load(fid)
+        if entry["key"] == identity:
+            return entry["value"]
+    value = compute(fname)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temp file first, so concurrent readers never see a partial entry
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, "wb") as fid:
+        pickle.dump(dict(key=identity, value=value), fid)
+    tmp_file.replace(cache_file)
+    return value
+
+
+def _read_info(fname):
+    return read_info(fname, verbose=False)
+
+
+def read_info_cached(fname):
+    """Read the measurement info of a FIF file, via an on-disk header cache.
+
+    On a cache hit the FIF file itself is never opened.
+    """
+    return cached("info", fname, _read_info)
+
+
+def refit_kwargs(refit_option):
+    """Get the (normalized) ``refit_hpi`` kwargs for a file's entry in refit-options.yml.
+
+    Our defaults are updated with the entry (minus its ``refit`` key), ints given for
+    options that default to a float (e.g. ``dist_limit: 1``) are cast to float, and
+    items are sorted, so equivalent options compare (and hash) equal. Integer options
+    (e.g. ``use``, ``ext_order``) and bools are left alone.
+    """
+    defaults = {
+        key: param.default
+        for key, param in inspect.signature(mne.chpi.refit_hpi).parameters.items()
+    } | refit_hpi_defaults
+    kwargs = refit_hpi_defaults | dict(refit_option or {})
+    kwargs.pop("refit", None)
+    kwargs.pop("verbose", None)
+    for key, value in kwargs.items():
+        if (
+            isinstance(defaults.get(key), float)
+            and isinstance(value, int)
+            and not isinstance(value, bool)
+        ):
+            kwargs[key] = float(value)
+    return tuple(sorted(kwargs.items()))
+
+
+def _refit_hpi(fname, kwargs, verbose):
+    info = read_info_cached(fname)
+    mne.chpi.refit_hpi(info, **dict(kwargs), verbose=verbose)
+    return dict(
+        dev_head_t=info["dev_head_t"],
+        hpi_meas=info["hpi_meas"],
+        hpi_results=info["hpi_results"],
+    )
+
+
+def refit_hpi_cached(fname, refit_option=None, info=None, verbose=None):
+    """Refit the HPI coils of a FIF file (``mne.chpi.refit_hpi``), via an on-disk cache.
+
+    Entries are keyed by the file's identity plus the normalized kwargs (see
+    `refit_kwargs`). Returns the new ``dev_head_t``, ``hpi_meas``, and ``hpi_results``
+    (whose last entry has the goodness of fit of each coil); if ``info`` is given, they
+    are also applied to it (in place, like ``refit_hpi`` does).
+    """
+    kwargs = refit_kwargs(refit_option)
+    result = cached(
+        "refit-hpi",
+        fname,
+        lambda fname: _refit_hpi(fname, kwargs, verbose),
+        params=kwargs,
+    )
+    if info is not None:
+        with info._unlock():
+            info.update(result)
+    return result
+
+
+def _sha256(fname, chunk_size=64 * 2**20):
+    """Hash a file, reading it through a memory map (a chunk at a time)."""
+    digest = hashlib.sha256()
+    with open(fname, "rb") as fid:
+        if Path(fname).stat().st_size:  # can't mmap an empty file
+            with mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                for start in range(0, len(mm), chunk_size):
+                    digest.update(view[start : start + chunk_size])
+                view.release()
+    return digest.hexdigest()
+
+
+def sha256(fname):
+    """Get the SHA-256 hex digest of a file's content, via an on-disk cache."""
+    return cached("sha256", fname, _sha256)
+
+
+def _preview_paths(fname):
+    """Get the data (.fif) and header (.json) files of a raw file's preview."""
+    stem = cache_dir / "previews" / Path(fname).name.removesuffix(".fif")
+    return stem.with_suffix(".fif"), stem.with_suffix(".json")
+
+
+def _preview_key(fname):
+    """Identify the source of a preview (not by inode, so it works on other hosts)."""
+    stat = Path(fname).stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def preview_is_current(fname):
+    """Check whether a raw file has a preview that's up to date."""
+    data_file, header_file = _preview_paths(fname)
+    if not header_file.is_file() or not data_file.is_file():
+        return False
+    header = json.loads(header_file.read_text())
+    return header["key"] == _preview_key(fname)
+
+
+def write_preview(fname, n_jobs=None):
+    """Write a low-rate float32 preview of the data channels of a raw FIF file.
+
+    The preview is itself a raw FIF file (with the original info, so channel locations
+    and SSP projectors included), which is read on demand rather than preloaded. A
+    small JSON header identifies the source it was made from.
+    """
+    raw = mne.io.read_raw_fif(fname, preload=True, allow_maxshield=True, verbose=False)
+    raw.pick("data")  # bads too
+    raw.resample(preview_sfreq, n_jobs=n_jobs, verbose=False)
+    header = dict(source=str(fname), key=_preview_key(fname))
+    data_file, header_file = _preview_paths(fname)
+    data_file.parent.mkdir(parents=True, exist_ok=True)
+    # write to temp files first (the header last), so readers never see partial ones
+    tmp_file = data_file.with_name(f"{data_file.stem}.{os.getpid()}.tmp_raw.fif")
+    raw.save(tmp_file, fmt="single", overwrite=True, verbose=False)
+    tmp_file.replace(data_file)
+    tmp_file = header_file.with_suffix(f".{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(header))
+    tmp_file.replace(header_file)
+
+
+def read_preview(fname):
+    """Open the preview of a raw FIF file (``None`` if it's missing or out of date).
+
+    The data aren't loaded; plotting reads just the part that's shown.
+    """
+    if not preview_is_current(fname):
+        return None
+    data_file, _ = _preview_paths(fname)
+    return mne.io.read_raw_fif(data_file, allow_maxshield=True, verbose=False)
 
 
 tasks = dict(